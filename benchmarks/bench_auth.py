@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк проверки сессионного токена webapp.py
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+Заполняет временную bot.db N пользователями и меряет verify_token:
+  • legacy — старая схема (перебор всех user_id × 3 дня × SHA-256)
+  • v2     — HMAC-токен v2.<uid>.<exp>.<sig>, без кэша
+  • cached — повторная проверка того же токена (кэш проверенных)
+
+Запуск:  python benchmarks/bench_auth.py [--sizes 1000,100000,1000000]
+"""
+
+import os, sys, time, sqlite3, hashlib, hmac, argparse, tempfile, statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123:bench")
+
+import webapp  # noqa: E402
+
+LEGACY_SALT = "puwe_webapp_v1"
+
+
+def legacy_verify(token):
+    """verify_token до v2 — для сравнения."""
+    rows = webapp.db.all("SELECT user_id FROM users")
+    for row in rows:
+        uid = row[0]
+        for offset in range(3):
+            day = int(time.time() // 86400) - offset
+            expected = hashlib.sha256(f"{uid}:{LEGACY_SALT}:{day}".encode()).hexdigest()
+            if hmac.compare_digest(expected, token):
+                return uid
+    return None
+
+
+def fill_db(path, n):
+    c = sqlite3.connect(path)
+    c.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, username TEXT DEFAULT '', "
+              "first_name TEXT DEFAULT '', premium_until INTEGER DEFAULT 0)")
+    have = c.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    c.executemany("INSERT INTO users (user_id) VALUES (?)", ((i,) for i in range(have + 1, n + 1)))
+    c.commit()
+    c.close()
+
+
+def per_call_us(fn, arg_list):
+    t = time.perf_counter()
+    for a in arg_list:
+        fn(a)
+    return (time.perf_counter() - t) / len(arg_list) * 1e6
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="1000,100000,1000000")
+    ap.add_argument("--calls", type=int, default=5000)
+    ap.add_argument("--legacy-max", type=int, default=100000,
+                    help="legacy меряем только до этого размера (дальше — секунды на вызов)")
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="bench_auth_")
+    db = os.path.join(tmp, "bot.db")
+    webapp.BOT_DB = db
+    webapp.db = webapp.Database(db, "webapp")
+
+    print(f"{'users':>10} | {'legacy µs':>12} | {'v2 µs':>8} | {'cached µs':>9}")
+    print("-" * 50)
+    for n in (int(x) for x in args.sizes.split(",")):
+        fill_db(db, n)
+        uids = [1 + (i * 7919) % n for i in range(args.calls)]
+
+        # разные токены — каждый проверяется впервые (кэш не помогает)
+        webapp._TOKEN_CACHE.clear()
+        fresh = [webapp.make_token(u, ttl=webapp.TOKEN_TTL + i) for i, u in enumerate(uids)]
+        assert all(webapp.verify_token(t) == u for t, u in zip(fresh[:10], uids[:10]))
+        webapp._TOKEN_CACHE.clear()
+        v2 = per_call_us(webapp.verify_token, fresh)
+
+        hot = [webapp.make_token(uids[0])] * args.calls
+        webapp.verify_token(hot[0])
+        cached = per_call_us(webapp.verify_token, hot)
+
+        if n <= args.legacy_max:
+            # худший случай для legacy — пользователь в конце таблицы
+            day = int(time.time() // 86400)
+            tok = hashlib.sha256(f"{n}:{LEGACY_SALT}:{day}".encode()).hexdigest()
+            legacy = statistics.median(per_call_us(legacy_verify, [tok]) for _ in range(3))
+            legacy_s = f"{legacy:12.0f}"
+        else:
+            legacy_s = f"{'—':>12}"
+        print(f"{n:>10} | {legacy_s} | {v2:8.2f} | {cached:9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест bot.py без Telegram и YouTube
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+Настоящий Application из bot.build_app() обрабатывает синтетические апдейты
+через свой update_processor — с теми же лимитами параллельности, что и в main()
+(UPDATE_CONCURRENCY), — а всё внешнее подменено локальным:
+  • Bot API      — benchmarks/stub_bot_api.py (HTTP, как облачный или --local-mode)
+  • yt-dlp       — плагин benchmarks/yt_dlp_plugins (fake.media + ytsearch)
+  • медиа        — HTTP-сервер с синтетическими байтами (без диска)
+bot.db и downloads/ создаются во временной папке.
+
+Сценарии (--mix, веса):
+  link   — ссылка в личке → выбор качества (callback v_…) → загрузка и заливка
+  search — /search yt <запрос>
+  pay    — pre_checkout_query + successful_payment
+  group  — ссылка в группе: видео и аудио параллельно
+  start  — /start (дешёвый фон)
+
+Отчёт: пропускная способность, p50/p95/p99 по типам апдейтов, SQL на апдейт,
+ожидание писателя и пула читателей SQLite, вызовы Bot API и исходы загрузок.
+
+Запуск:  python benchmarks/loadtest.py [--ops 500] [--users 200] [--concurrency 32]
+                                       [--mix link=40,search=20,pay=10,group=20,start=10]
+"""
+
+import os, sys, json, time, random, asyncio, logging, argparse, tempfile, shutil, threading, itertools
+from collections import Counter, defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT  = os.path.dirname(BENCH)
+sys.path.insert(0, BENCH)  # stub_bot_api и yt_dlp_plugins
+sys.path.insert(0, ROOT)
+
+import stub_bot_api  # noqa: E402
+
+USER_BASE = 7_000_000  # id пользователей теста (не пересекаются с ADMIN_IDS)
+WORDS = ["cats", "music", "news", "lofi", "football", "recipes", "travel", "gaming", "cars", "space"]
+
+
+# ══════════════════════════════════
+#  МЕДИАСЕРВЕР
+# ══════════════════════════════════
+class MediaHandler(BaseHTTPRequestHandler):
+    """/media/<имя>?size=N — N синтетических байт; Range поддерживается."""
+    protocol_version = "HTTP/1.1"
+    PATTERN = bytes(range(256)) * 256  # 64 КБ
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        size = int(parse_qs(url.query).get("size", ["0"])[0])
+        if not url.path.startswith("/media/") or size <= 0:
+            self.send_error(404); return
+        start, end = 0, size - 1
+        rng = self.headers.get("Range", "")
+        if rng.startswith("bytes="):
+            a, _, b = rng[6:].partition("-")
+            start = int(a or 0)
+            end = min(int(b), size - 1) if b else size - 1
+        self.send_response(206 if rng else 200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", end - start + 1)
+        self.send_header("Accept-Ranges", "bytes")
+        if rng:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        pos = start
+        try:
+            while pos <= end:
+                n = min(len(self.PATTERN), end - pos + 1)
+                self.wfile.write(self.PATTERN[:n])
+                pos += n
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def serve_media():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MediaHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ══════════════════════════════════
+#  АПДЕЙТЫ
+# ══════════════════════════════════
+class Updates:
+    def __init__(self, users, videos, unique):
+        self.users   = users
+        self.videos  = videos
+        self.unique  = unique
+        self._ids    = itertools.count(1)
+        self._msgs   = itertools.count(1)
+        self._unique = itertools.count(1)
+
+    def user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"U{uid}", "username": f"lt{uid}",
+                "language_code": "en"}
+
+    def random_uid(self):
+        return USER_BASE + random.randrange(self.users)
+
+    def video_url(self):
+        vid = f"u{next(self._unique)}" if self.unique else f"v{random.randrange(self.videos)}"
+        return f"https://fake.media/watch/{vid}"
+
+    def message(self, uid, text=None, chat=None, **extra):
+        msg = {"message_id": next(self._msgs), "date": int(time.time()),
+               "chat": chat or {"id": uid, "type": "private", "first_name": f"U{uid}"},
+               "from": self.user(uid), **extra}
+        if text is not None:
+            msg["text"] = text
+            if text.startswith("/"):
+                cmd = text.split()[0]
+                msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(cmd)}]
+        return {"update_id": next(self._ids), "message": msg}
+
+    def callback(self, uid, msg_id, data):
+        return {"update_id": next(self._ids), "callback_query": {
+            "id": str(next(self._ids)), "from": self.user(uid), "chat_instance": "lt", "data": data,
+            "message": {"message_id": msg_id, "date": int(time.time()), "text": "…",
+                        "chat": {"id": uid, "type": "private", "first_name": f"U{uid}"}}}}
+
+    def pre_checkout(self, uid, payload):
+        return {"update_id": next(self._ids), "pre_checkout_query": {
+            "id": str(next(self._ids)), "from": self.user(uid), "currency": "XTR",
+            "total_amount": 50, "invoice_payload": payload}}
+
+    def payment(self, uid, payload):
+        return self.message(uid, successful_payment={
+            "currency": "XTR", "total_amount": 50, "invoice_payload": payload,
+            "telegram_payment_charge_id": f"lt{next(self._ids)}", "provider_payment_charge_id": "lt"})
+
+
+# ══════════════════════════════════
+#  ПРОГОН
+# ══════════════════════════════════
+class Run:
+    def __init__(self, bot, app, upd: Updates):
+        self.bot, self.app, self.upd = bot, app, upd
+        self.lat    = defaultdict(list)   # тип апдейта → секунды
+        self.errors = Counter()
+
+    async def send(self, kind, raw):
+        from telegram import Update
+        update = Update.de_json(raw, self.app.bot)
+        t = time.perf_counter()
+        try:
+            # Как Application.__process_update_wrapper: лимит апдейтов и обход для cancel_*
+            await self.app.update_processor.process_update(update, self.app.process_update(update))
+        except Exception as e:
+            self.errors[f"{kind}: {type(e).__name__}"] += 1
+        self.lat[kind].append(time.perf_counter() - t)
+
+    def _pending_pick(self, uid):
+        """message_id сообщения «выбери качество», которое бот сохранил для uid."""
+        keys = [k for k, v in self.app.bot_data.items()
+                if k.startswith("dl_") and v.get("uid") == uid]
+        return max((int(k[3:]) for k in keys), default=None)
+
+    async def link(self):
+        uid = self.upd.random_uid()
+        await self.send("link", self.upd.message(uid, f"look {self.upd.video_url()}"))
+        msg_id = self._pending_pick(uid)
+        if msg_id is None:
+            return  # ответ из кэша file_id или ошибка — выбора качества не было
+        fmt = random.choice(["22", "18", "bestaudio"])
+        await self.send("link_pick", self.upd.callback(uid, msg_id, f"v_{msg_id}_{fmt}"))
+        self.app.bot_data.pop(f"dl_{msg_id}", None)
+
+    async def search(self):
+        uid = self.upd.random_uid()
+        words = random.sample(WORDS, 2)
+        await self.send("search", self.upd.message(uid, f"/search yt {' '.join(words)}"))
+
+    async def pay(self):
+        uid = self.upd.random_uid()
+        payload = json.dumps({"type": "monthly", "months": 1})
+        await self.send("pre_checkout", self.upd.pre_checkout(uid, payload))
+        await self.send("payment", self.upd.payment(uid, payload))
+
+    async def group(self):
+        uid = self.upd.random_uid()
+        chat = {"id": -1000000000000 - random.randrange(50), "type": "supergroup", "title": "LT"}
+        await self.send("group", self.upd.message(uid, self.upd.video_url(), chat=chat))
+
+    async def start(self):
+        await self.send("start", self.upd.message(self.upd.random_uid(), "/start"))
+
+
+def pct(values, q):
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, max(0, int(round(q * len(s) + 0.5)) - 1))]
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, w = part.partition("=")
+        if name.strip():
+            mix[name.strip()] = float(w or 1)
+    unknown = set(mix) - {"link", "search", "pay", "group", "start"}
+    if unknown:
+        raise SystemExit(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return mix
+
+
+async def drive(bot, args, stub_state):
+    from common import DB_LOCK_WAIT, DOWNLOADS_TOTAL
+
+    bot.db_init()
+    bot.reaper.watch(bot.DOWNLOADS_DIR, bot.FILE_MAX_AGE)
+    app = bot.build_app()
+    await app.initialize()
+    await bot.post_init(app)  # команды в stub, write-behind
+    run = Run(bot, app, Updates(args.users, args.videos, args.unique))
+
+    mix = parse_mix(args.mix)
+    plan = random.choices(list(mix), weights=list(mix.values()), k=args.ops)
+    queue = asyncio.Queue()
+    for name in plan:
+        queue.put_nowait(name)
+
+    async def worker():
+        while True:
+            try:
+                name = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await getattr(run, name)()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - t0
+    await bot.post_shutdown(app)  # сброс write-behind — входит в SQL-счётчики
+    await app.shutdown()
+
+    n_updates = sum(len(v) for v in run.lat.values())
+    ucs = bot.user_cache_stats()
+    lock = DB_LOCK_WAIT.summary(proc="bot")
+    report = {
+        "config": {k: getattr(args, k) for k in ("ops", "users", "videos", "unique", "concurrency",
+                                                  "mix", "media_kb", "api_delay_ms", "local_mode")},
+        "update_slots": app.update_processor.max_concurrent_updates
+                        if not isinstance(app.update_processor, bot.UpdateProcessor)
+                        else app.update_processor.limit,
+        "elapsed_s": elapsed,
+        "scenarios": dict(Counter(plan)),
+        "ops_per_s": args.ops / elapsed,
+        "updates": n_updates,
+        "updates_per_s": n_updates / elapsed,
+        "latency_ms": {
+            kind: {"n": len(v), "p50": pct(v, .5) * 1e3, "p95": pct(v, .95) * 1e3,
+                   "p99": pct(v, .99) * 1e3, "max": max(v) * 1e3}
+            for kind, v in sorted(run.lat.items())},
+        "errors": dict(run.errors),
+        "db": {
+            "sql_total": ucs["sql"], "sql_per_update": ucs["sql_avg"], "sql_max_update": ucs["sql_max"],
+            "user_cache_hit_rate": ucs["hit_rate"],
+            "lock_acquires": lock["count"],
+            "lock_wait_total_ms": lock["sum"] * 1e3,
+            "lock_wait_p99_ms": (DB_LOCK_WAIT.quantile(.99, proc="bot") or 0) * 1e3,
+            "pool": bot.db.stats(),
+        },
+        "write_behind": bot.wb.info(),
+        "bot_api": stub_state.stats(),
+        "downloads": {"|".join(k): v for k, v in DOWNLOADS_TOTAL.samples().items()},
+        "queue": bot.queue_stats(),
+    }
+    return report
+
+
+def print_report(r):
+    print(f"\n═══ {r['config']['ops']} ops, {r['updates']} updates in {r['elapsed_s']:.2f}s "
+          f"→ {r['ops_per_s']:.1f} ops/s, {r['updates_per_s']:.1f} updates/s")
+    print(f"    mix: {r['scenarios']}  concurrency {r['config']['concurrency']}, "
+          f"users {r['config']['users']}, update slots {r['update_slots']}")
+    print(f"\n{'update':<14}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind, l in r["latency_ms"].items():
+        print(f"{kind:<14}{l['n']:>6}{l['p50']:>10.1f}{l['p95']:>10.1f}{l['p99']:>10.1f}{l['max']:>10.1f}")
+    d = r["db"]
+    print(f"\nSQL: {d['sql_total']} total, {d['sql_per_update']:.2f}/update (max {d['sql_max_update']}), "
+          f"user cache hit {d['user_cache_hit_rate']:.0%}")
+    print(f"writer lock: {d['lock_acquires']} acquires, wait {d['lock_wait_total_ms']:.1f} ms total, "
+          f"p99 ≤ {d['lock_wait_p99_ms']:.2f} ms")
+    p = d["pool"]
+    print(f"readers: {p['reads']} reads on {p['readers']}/{p['readers_max']} conns, "
+          f"{p['pool_waits']} pool waits; query avg read {p['read_avg_ms']:.2f} ms, "
+          f"write {p['write_avg_ms']:.2f} ms")
+    wb = r["write_behind"]
+    print(f"write-behind: {wb['flushes']} flushes, ~{wb['per_flush']:.1f} rows/flush")
+    api = r["bot_api"]
+    top = ", ".join(f"{m}={n}" for m, n in Counter(api["calls"]).most_common(8))
+    print(f"Bot API: {sum(api['calls'].values())} calls ({top})")
+    print(f"uploads: {api['upload']}")
+    print(f"downloads: {r['downloads']}")
+    if r["errors"]:
+        print(f"errors: {r['errors']}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    ap.add_argument("--ops", type=int, default=500, help="сценариев всего")
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--videos", type=int, default=50, help="разных ссылок (повторы → кэш file_id)")
+    ap.add_argument("--unique", action="store_true", help="каждая ссылка новая (без кэша)")
+    ap.add_argument("--concurrency", type=int, default=32, help="одновременных сценариев")
+    ap.add_argument("--mix", default="link=40,search=20,pay=10,group=20,start=10")
+    ap.add_argument("--media-kb", type=int, default=512, help="размер файла 720p, КБ")
+    ap.add_argument("--api-delay-ms", type=float, default=0, help="задержка каждого ответа Bot API")
+    ap.add_argument("--local-mode", action="store_true", help="Bot API в --local (файлы путём)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", help="сохранить отчёт в файл")
+    ap.add_argument("--keep", action="store_true", help="не удалять временную папку")
+    ap.add_argument("-v", "--verbose", action="store_true", help="логи бота")
+    args = ap.parse_args()
+    random.seed(args.seed)
+
+    work = tempfile.mkdtemp(prefix="loadtest_")
+    os.chdir(work)  # bot.db и downloads/ у бота относительные
+    stub, stub_state = stub_bot_api.serve(delay_ms=args.api_delay_ms)
+    media = serve_media()
+    os.environ.update(
+        BOT_TOKEN="123456:loadtest",
+        BOT_API_URL=f"http://127.0.0.1:{stub.server_port}",
+        BOT_API_LOCAL="1" if args.local_mode else "0",
+        METRICS_PORT="0",
+        LOADTEST_MEDIA_URL=f"http://127.0.0.1:{media.server_port}",
+        LOADTEST_MEDIA_KB=str(args.media_kb),
+    )
+
+    import bot
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    try:
+        report = asyncio.run(drive(bot, args, stub_state))
+    finally:
+        stub.shutdown()
+        media.shutdown()
+        if not args.keep:
+            os.chdir(ROOT)
+            shutil.rmtree(work, ignore_errors=True)
+        else:
+            print(f"work dir: {work}")
+    print_report(report)
+    if args.json:
+        with open(os.path.join(ROOT, args.json) if not os.path.isabs(args.json) else args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
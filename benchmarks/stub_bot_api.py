@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Заглушка telegram-bot-api для проверки bot.py без Telegram
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+Отвечает на /bot<token>/<method> как Bot API: getMe, getUpdates, send*,
+edit*, delete* и т.п. Файлы принимает двумя способами:
+  • multipart-загрузка (облачный режим, лимит 50 МБ → 413 сверх него)
+  • file:///путь в local mode (лимит 2000 МБ, файл читается с диска)
+
+Служебные адреса:
+  POST /inject   — положить апдейт (JSON) в очередь getUpdates
+  GET  /stats    — счётчики вызовов и загруженных байт
+  POST /reset    — обнулить счётчики
+
+Запуск:  python benchmarks/stub_bot_api.py [--port 8081] [--delay-ms 0]
+Бот:     BOT_API_URL=http://127.0.0.1:8081 python bot.py
+"""
+
+import os, json, time, argparse, threading, itertools
+from collections import deque, Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl, unquote
+
+CLOUD_LIMIT = 50 * 1024 * 1024
+LOCAL_LIMIT = 2000 * 1024 * 1024
+FILE_FIELDS = ("video", "audio", "photo", "document", "animation", "voice", "thumbnail")
+
+BOT_INFO = {"id": 1000001, "is_bot": True, "first_name": "Stub", "username": "StubBot",
+            "can_join_groups": True, "can_read_all_group_messages": False,
+            "supports_inline_queries": False}
+
+
+class StubState:
+    def __init__(self, delay=0.0):
+        self.delay   = delay
+        self.lock    = threading.Condition()
+        self.updates = deque()
+        self.msg_ids = itertools.count(1)
+        self.upd_ids = itertools.count(1)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls  = Counter()
+            self.upload = Counter()   # path/multipart → файлов и байт
+            self.errors = Counter()
+
+    def inject(self, update):
+        with self.lock:
+            update.setdefault("update_id", next(self.upd_ids))
+            self.updates.append(update)
+            self.lock.notify_all()
+
+    def take(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                while self.updates and self.updates[0]["update_id"] < offset:
+                    self.updates.popleft()  # подтверждены через offset
+                if self.updates:
+                    return list(self.updates)[:100]
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return []
+                self.lock.wait(left)
+
+    def stats(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "upload": dict(self.upload),
+                    "errors": dict(self.errors), "queued": len(self.updates)}
+
+
+def parse_body(headers, raw):
+    """Параметры запроса (json / urlencoded / multipart) → (dict, {поле: байт}) ."""
+    ctype = headers.get("Content-Type", "")
+    if not raw:
+        return {}, {}
+    if ctype.startswith("application/json"):
+        return json.loads(raw), {}
+    if ctype.startswith("multipart/form-data"):
+        msg = BytesParser(policy=HTTP).parsebytes(
+            b"Content-Type: " + ctype.encode() + b"\r\n\r\n" + raw)
+        params, files = {}, {}
+        for part in msg.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            data = part.get_payload(decode=True) or b""
+            if part.get_filename():
+                files[name] = len(data)
+            else:
+                params[name] = data.decode()
+        return params, files
+    return dict(parse_qsl(raw.decode())), {}
+
+
+def _json_param(v):
+    if isinstance(v, str) and v[:1] in "[{":
+        try:
+            return json.loads(v)
+        except ValueError:
+            pass
+    return v
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    state: StubState = None
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _fail(self, code, desc):
+        self.state.errors[desc] += 1
+        self._reply(code, {"ok": False, "error_code": code, "description": desc})
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._reply(200, self.state.stats()); return
+        self.do_POST()
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if url.path == "/inject":
+            self.state.inject(json.loads(raw)); self._reply(200, {"ok": True}); return
+        if url.path == "/reset":
+            self.state.reset(); self._reply(200, {"ok": True}); return
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            self._fail(404, "Not Found"); return
+        method = parts[1]
+        try:
+            params, files = parse_body(self.headers, raw)
+        except ValueError:
+            self._fail(400, "Bad Request: can't parse body"); return
+        params.update(parse_qsl(url.query))
+        params = {k: _json_param(v) for k, v in params.items()}
+        with self.state.lock:
+            self.state.calls[method] += 1
+        if self.state.delay and method != "getUpdates":
+            time.sleep(self.state.delay)
+        try:
+            result = self.dispatch(method, params, files)
+        except StubError as e:
+            self._fail(e.code, e.desc); return
+        self._reply(200, {"ok": True, "result": result})
+
+    # ── файлы ──
+    def _account(self, value, files):
+        """Проверяет один файловый параметр, как это делает настоящий сервер."""
+        if isinstance(value, str) and value.startswith("attach://"):
+            value = files.get(value[9:], 0)
+        if isinstance(value, int):  # загружен multipart
+            if value > CLOUD_LIMIT:
+                raise StubError(413, "Request Entity Too Large")
+            kind, size = "multipart", value
+        elif isinstance(value, str) and value.startswith("file://"):
+            path = unquote(value[7:])
+            if not os.path.isfile(path):
+                raise StubError(400, "Bad Request: file not found")
+            size = os.path.getsize(path)
+            if size > LOCAL_LIMIT:
+                raise StubError(400, "Bad Request: file is too big")
+            kind = "path"
+        else:  # file_id / URL — без загрузки
+            kind, size = "file_id", 0
+        with self.state.lock:
+            self.state.upload[f"{kind}_files"] += 1
+            self.state.upload[f"{kind}_bytes"] += size
+        return size
+
+    def _message(self, params, **extra):
+        chat = params.get("chat_id", 0)
+        return dict({"message_id": next(self.state.msg_ids), "date": int(time.time()),
+                     "chat": {"id": int(chat) if str(chat).lstrip("-").isdigit() else 0,
+                              "type": "private"}}, **extra)
+
+    def _media(self, kind, size):
+        fid = f"stub-{kind}-{next(self.state.msg_ids)}"
+        obj = {"file_id": fid, "file_unique_id": fid, "file_size": size}
+        if kind == "photo":
+            return [dict(obj, width=1280, height=720)]
+        if kind in ("video", "animation"):
+            obj.update(width=1280, height=720, duration=1)
+        if kind in ("audio", "voice"):
+            obj.update(duration=1)
+        return obj
+
+    def dispatch(self, method, params, files):
+        st = self.state
+        if method == "getMe":
+            return BOT_INFO
+        if method == "getUpdates":
+            return st.take(int(params.get("offset") or 0), min(float(params.get("timeout") or 0), 30))
+        if method == "sendMediaGroup":
+            out = []
+            for item in params.get("media") or []:
+                size = self._account(item.get("media"), files)
+                out.append(self._message(params, **{item.get("type", "photo"):
+                                                    self._media(item.get("type", "photo"), size)},
+                                         caption=item.get("caption")))
+            return out
+        if method.startswith("send"):
+            field = next((f for f in FILE_FIELDS if f in params or f in files), None)
+            if field is None:
+                return self._message(params, text=params.get("text", ""))
+            size = self._account(params.get(field, files.get(field)), files)
+            return self._message(params, caption=params.get("caption"),
+                                 **{field: self._media(field, size)})
+        if method.startswith("edit"):
+            return self._message(params, text=params.get("text", ""))
+        if method == "getChat":
+            return {"id": int(params.get("chat_id") or 0), "type": "private"}
+        return True
+
+
+class StubError(Exception):
+    def __init__(self, code, desc):
+        super().__init__(desc)
+        self.code, self.desc = code, desc
+
+
+def serve(port=0, delay_ms=0.0):
+    """Стартует заглушку в фоне → (server, state). port=0 — любой свободный."""
+    state = StubState(delay_ms / 1000)
+    handler = type("Handler", (StubHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--delay-ms", type=float, default=0, help="задержка ответа на каждый вызов")
+    args = ap.parse_args()
+    server, state = serve(args.port, args.delay_ms)
+    print(f"stub Bot API on http://127.0.0.1:{server.server_port}  (BOT_API_URL for bot.py)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(json.dumps(state.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
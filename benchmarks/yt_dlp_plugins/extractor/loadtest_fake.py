@@ -0,0 +1,66 @@
+"""
+Подставной экстрактор yt-dlp для benchmarks/loadtest.py
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+Подхватывается yt-dlp как плагин, если папка benchmarks/ есть в sys.path.
+  • https://fake.media/watch/<id>  — видео с форматами 360p/720p + m4a,
+    байты отдаёт локальный медиасервер (LOADTEST_MEDIA_URL)
+  • ytsearchN:<запрос>             — выдача из fake.media вместо YouTube
+Размер файлов — LOADTEST_MEDIA_KB (на формат 720p; 360p и аудио меньше).
+"""
+
+import os, zlib
+
+from yt_dlp.extractor.common import InfoExtractor, SearchInfoExtractor
+
+
+def _media_base():
+    return os.environ.get("LOADTEST_MEDIA_URL", "http://127.0.0.1:8082").rstrip("/")
+
+
+def _sizes():
+    kb = int(os.environ.get("LOADTEST_MEDIA_KB", "512"))
+    return {"22": kb * 1024, "18": kb * 1024 // 2, "140": max(kb * 1024 // 8, 4096)}
+
+
+class LoadtestFakeIE(InfoExtractor):
+    IE_NAME = "loadtest:fake"
+    _VALID_URL = r"https?://fake\.media/watch/(?P<id>[\w-]+)"
+
+    def _real_extract(self, url):
+        vid = self._match_id(url)
+        base, sizes = _media_base(), _sizes()
+
+        def fmt(fid, ext, height=None, audio_only=False):
+            f = {"format_id": fid, "ext": ext, "protocol": "http", "filesize": sizes[fid],
+                 "url": f"{base}/media/{vid}_{fid}.{ext}?size={sizes[fid]}",
+                 "acodec": "mp4a.40.2", "tbr": sizes[fid] * 8 / 1000 / 30}
+            if audio_only:
+                f.update(vcodec="none", abr=128)
+            else:
+                f.update(vcodec="avc1.64001F", height=height, width=height * 16 // 9)
+            return f
+
+        return {
+            "id": vid,
+            "title": f"Load test video {vid}",
+            "duration": 30,
+            "width": 1280,
+            "height": 720,
+            "view_count": zlib.crc32(vid.encode()) % 100000,
+            "formats": [fmt("140", "m4a", audio_only=True), fmt("18", "mp4", 360), fmt("22", "mp4", 720)],
+        }
+
+
+class LoadtestSearchIE(SearchInfoExtractor):
+    """ytsearch: без сети — плагины yt-dlp проверяются раньше встроенных экстракторов."""
+    IE_NAME = "loadtest:search"
+    _SEARCH_KEY = "ytsearch"
+    _MAX_RESULTS = 100
+
+    def _search_results(self, query):
+        seed = zlib.crc32(query.encode())
+        for i in range(self._MAX_RESULTS):
+            vid = f"s{seed % 10000}_{i}"
+            yield self.url_result(f"https://fake.media/watch/{vid}", LoadtestFakeIE, vid,
+                                  title=f"{query} #{i + 1}", duration=30 + i,
+                                  view_count=1000 * (i + 1))
@@ -9,19 +9,31 @@
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 """
 
-import os, re, asyncio, time, sqlite3, json, logging, urllib.parse
+import os, re, asyncio, time, sqlite3, json, logging, itertools, urllib.parse
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
 from dotenv import load_dotenv
 load_dotenv()
 from datetime import datetime, date
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup,
-    LabeledPrice, BotCommand
+    LabeledPrice, BotCommand, InputMediaPhoto
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import (
     Application, MessageHandler, CallbackQueryHandler,
-    CommandHandler, ContextTypes, filters, PreCheckoutQueryHandler
+    CommandHandler, ContextTypes, filters, PreCheckoutQueryHandler, TypeHandler,
+    BaseUpdateProcessor
 )
 import yt_dlp
+from common import (
+    canonical_url, InfoCache, download_with_info, plan_format, TooLarge, flight,
+    Workspace, remove_output, SearchCache, reaper, MediaStore, StoreFull,
+    metrics, serve_metrics, store_metrics, platform_of, Database, AsyncDB, db_metrics,
+    GET_INFO_SECONDS, DOWNLOAD_SECONDS, DOWNLOADS_TOTAL, DOWNLOAD_BYTES,
+)
 
 logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s",
@@ -42,35 +54,25 @@ SITE_URL      = os.getenv("SITE_URL", "https://puwedown.bothost.tech")
 ADMIN_IDS     = {5268649092}
 DB_FILE        = "bot.db"
 DOWNLOADS_DIR  = "downloads"
-
-# ── Одноразові токени для логіну через бота ──
+FILE_MAX_AGE   = 3 * 3600  # в downloads/ старше — осиротело после падения/рестарта
+# Бюджет диска под downloads/: новые загрузки ждут, пока залитые файлы не удалят
+MEDIA_BUDGET     = int(os.getenv("MEDIA_BUDGET_MB", "4096")) << 20
+MEDIA_FREE_FLOOR = int(os.getenv("MEDIA_FREE_FLOOR_MB", "0")) << 20  # 0 — только бюджет
+MEDIA_ADMIT_WAIT = float(os.getenv("MEDIA_ADMIT_WAIT", "300"))
+PHOTO_EST        = 20 << 20  # резерв под пост с фото
+# Свой telegram-bot-api (--local): файлы уходят по пути на диске, лимит 2000 МБ вместо 50
+BOT_API_URL    = os.getenv("BOT_API_URL", "").rstrip("/")  # напр. http://127.0.0.1:8081
+LOCAL_MODE     = bool(BOT_API_URL) and os.getenv("BOT_API_LOCAL", "1") == "1"
+BOT_API_TIMEOUT = float(os.getenv("BOT_API_TIMEOUT", "600"))  # локальный сервер отвечает после заливки в Telegram
+# Prometheus-экспортёр: GET http://METRICS_HOST:METRICS_PORT/metrics (0 — выключен, напр. 9101)
+METRICS_PORT   = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST   = os.getenv("METRICS_HOST", "127.0.0.1")
+TG_LIMIT       = (1999 if LOCAL_MODE else 49) * 1024 * 1024  # облачный Bot API не принимает файлы >50 МБ
+
+# ── Одноразові токени для логіну через бота (таблиця login_tokens у bot.db) ──
 import secrets as _secrets, threading as _threading
-_LT_LOCK = _threading.Lock()
 LOGIN_TTL = 900  # 15 хвилин
-_LT_FILE  = os.path.join(os.path.dirname(__file__), "login_tokens.json")
-
-def _lt_load():
-    try:
-        if os.path.exists(_LT_FILE):
-            return json.loads(open(_LT_FILE, encoding="utf-8").read())
-    except: pass
-    return {}
-
-def _lt_save(data):
-    try:
-        with open(_LT_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f)
-    except: pass
-
-def create_login_token(uid: int) -> str:
-    token = _secrets.token_urlsafe(32)
-    with _LT_LOCK:
-        data = _lt_load()
-        data = {t: v for t, v in data.items()
-                if v["uid"] != uid and v["expires"] > time.time()}
-        data[token] = {"uid": uid, "expires": time.time() + LOGIN_TTL}
-        _lt_save(data)
-    return token
+_LT_FILE  = os.path.join(os.path.dirname(__file__), "login_tokens.json")  # старе сховище, мігрується
 
 # ── Stars pricing ──
 TRIAL_STARS    = 5
@@ -86,6 +88,14 @@ VIDEO_URL_PATTERN = re.compile(r"https?://(?:www\.)?\S+")
 FREE_SEARCH_DL_DAY   = 3
 PREMIUM_SEARCH_DL_DAY = 12
 
+# ── Кэш file_id: повторные ссылки отдаём без yt-dlp ──
+FILE_CACHE_TTL = 30 * 86400  # 30 дней, потом перезаливаем
+
+# ── Кэш метаданных (extract_info) ──
+INFO_CACHE_SIZE   = int(os.getenv("INFO_CACHE_SIZE", "256"))
+INFO_CACHE_SHARED = os.getenv("INFO_CACHE_SHARED", "1") == "1"  # общий с сайтом через bot.db
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "512"))
+
 
 def calc_price(months: int) -> int:
     return MONTHLY_BASE + MONTHLY_EXTRA * (months - 1)
@@ -95,26 +105,271 @@ def calc_price(months: int) -> int:
 #  DATABASE  (WAL режим — быстрее при параллельных запросах)
 # ══════════════════════════════════════════════
 
-# Один глобальный коннект вместо открытия нового на каждый запрос
-_DB_CONN = None
-_DB_LOCK = _threading.Lock()
+# Читатели из пула (WAL — параллельно), запись через один коннект — см. common.Database.
+# Из корутин SQL идёт через adb.run(...) в свой пул потоков, event loop не ждёт диск.
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+
 
-def _conn() -> sqlite3.Connection:
-    global _DB_CONN
-    if _DB_CONN is None:
-        c = sqlite3.connect(DB_FILE, check_same_thread=False)
-        c.row_factory = sqlite3.Row
-        # WAL = читатели не блокируют писателя и наоборот
-        c.execute("PRAGMA journal_mode=WAL")
-        c.execute("PRAGMA synchronous=NORMAL")
-        c.execute("PRAGMA cache_size=10000")
-        _DB_CONN = c
-    return _DB_CONN
+# ── Кэш строк users ──
+# tx()/is_premium()/клавиатуры читают одну и ту же строку по многу раз за апдейт.
+# Строки живут в LRU (dict), db_* функции обновляют их на месте (write-through).
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "5000"))
+USER_CACHE_TTL  = int(os.getenv("USER_CACHE_TTL", "300"))  # страховка от правок БД снаружи
+
+_UC: OrderedDict = OrderedDict()  # uid -> (loaded_at, row dict)
+_UC_LOCK  = _threading.Lock()
+_UC_STATS = {"hit": 0, "ctx_hit": 0, "miss": 0, "sql": 0, "updates": 0, "sql_upd": 0, "sql_max": 0}
+
+# Контекст текущего апдейта (ставит TypeHandler в группе -1): прочитанные строки и счётчик SQL
+_REQ: ContextVar = ContextVar("bot_update", default=None)
+
+
+def _count_sql(_stmt):
+    _UC_STATS["sql"] += 1
+    req = _REQ.get()
+    if req is not None:
+        req["sql"] += 1
+
+
+db  = Database(DB_FILE, "bot", readers=DB_READERS, trace=_count_sql)
+adb = AsyncDB(db)
+db_metrics(db)
+
+
+def _uc_peek(uid: int) -> dict | None:
+    with _UC_LOCK:
+        ent = _UC.get(uid)
+        if not ent:
+            return None
+        if time.monotonic() - ent[0] > USER_CACHE_TTL:
+            del _UC[uid]
+            return None
+        _UC.move_to_end(uid)
+        return ent[1]
+
+
+def _uc_store(uid: int, row: dict):
+    with _UC_LOCK:
+        _UC[uid] = (time.monotonic(), row)
+        _UC.move_to_end(uid)
+        while len(_UC) > USER_CACHE_SIZE:
+            _UC.popitem(last=False)
+
+
+def _uc_update(uid: int, **fields):
+    # Та же dict лежит и в контексте апдейта — обновляется сразу везде
+    with _UC_LOCK:
+        ent = _UC.get(uid)
+        if ent:
+            ent[1].update(fields)
+
+
+def _uc_add(uid: int, field: str, n: int):
+    with _UC_LOCK:
+        ent = _UC.get(uid)
+        if ent:
+            ent[1][field] = (ent[1].get(field) or 0) + n
+
+
+def _uc_drop(uid: int):
+    with _UC_LOCK:
+        _UC.pop(uid, None)
+    req = _REQ.get()
+    if req is not None:
+        req["rows"].pop(uid, None)
+
+
+def user_cache_stats() -> dict:
+    st = dict(_UC_STATS)
+    reads = st["hit"] + st["ctx_hit"] + st["miss"]
+    st.update(size=len(_UC), maxsize=USER_CACHE_SIZE,
+              hit_rate=(st["hit"] + st["ctx_hit"]) / reads if reads else 0.0,
+              sql_avg=st["sql_upd"] / st["updates"] if st["updates"] else 0.0)
+    return st
+
+
+# ── Отложенная запись (write-behind) ──
+# last_seen/имя и счётчики загрузок копятся в памяти и пишутся одной транзакцией
+# раз в WB_FLUSH_MS или после WB_MAX_OPS операций. Платежи пишутся сразу.
+WB_FLUSH_MS = int(os.getenv("WB_FLUSH_MS", "500"))
+WB_MAX_OPS  = int(os.getenv("WB_MAX_OPS", "200"))
+
+
+class WriteBehind:
+    def __init__(self, flush_ms: int, max_ops: int):
+        self.interval = flush_ms / 1000
+        self.max_ops  = max_ops
+        self.lock     = _threading.Lock()
+        self.seen     = {}  # uid -> (username, first_name, last_seen)
+        self.dl       = {}  # uid -> +downloads
+        self.sdl      = {}  # (uid, date_str) -> +count
+        self.ops      = 0
+        # Забранное flush() до коммита: читатели видят его поверх БД, пока транзакция идёт
+        self.inflight = ({}, {}, {})
+        self._flushing = _threading.Lock()  # одна транзакция сброса за раз
+        self.stats    = {"ops": 0, "flushes": 0, "rows": 0, "errors": 0, "last_ms": 0.0, "max_ms": 0.0}
+        self._loop    = None
+        self._wake    = None
+        self._task    = None
+
+    # ── запись в буфер ──
+    def _added(self) -> bool:
+        # вызывается под self.lock
+        self.ops += 1
+        self.stats["ops"] += 1
+        return self.ops >= self.max_ops
+
+    def _kick(self):
+        if self._task is None:
+            self.flush()  # флашера нет (скрипты) — пишем сразу
+        else:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def touch(self, uid: int, username: str, first_name: str, ts: int):
+        with self.lock:
+            self.seen[uid] = (username, first_name, ts)
+            full = self._added()
+        if full:
+            self._kick()
+
+    def add_dl(self, uid: int, n: int = 1):
+        with self.lock:
+            self.dl[uid] = self.dl.get(uid, 0) + n
+            full = self._added()
+        if full:
+            self._kick()
+
+    def add_sdl(self, uid: int, day: str, n: int = 1):
+        with self.lock:
+            self.sdl[(uid, day)] = self.sdl.get((uid, day), 0) + n
+            full = self._added()
+        if full:
+            self._kick()
+
+    # ── чтение поверх БД ──
+    def pending_sdl(self, uid: int, day: str) -> int:
+        with self.lock:
+            return self.sdl.get((uid, day), 0) + self.inflight[2].get((uid, day), 0)
+
+    def overlay(self, uid: int, row: dict) -> dict:
+        """Строка из БД + ещё не записанные изменения (в т.ч. сбрасываемые сейчас)."""
+        with self.lock:
+            seen = self.seen.get(uid) or self.inflight[0].get(uid)
+            if seen:
+                row["username"], row["first_name"], row["last_seen"] = seen
+                row["blocked"] = 0
+            dl = self.dl.get(uid, 0) + self.inflight[1].get(uid, 0)
+            if dl:
+                row["downloads"] = (row.get("downloads") or 0) + dl
+        return row
+
+    # ── сброс ──
+    def flush(self) -> int:
+        with self._flushing:
+            return self._flush()
+
+    def _flush(self) -> int:
+        with self.lock:
+            seen, dl, sdl = self.seen, self.dl, self.sdl
+            self.seen, self.dl, self.sdl, self.ops = {}, {}, {}, 0
+            self.inflight = (seen, dl, sdl)
+        n = len(seen) + len(dl) + len(sdl)
+        if not n:
+            return 0
+        t = time.monotonic()
+        try:
+            with db.write() as c:
+                c.executemany(
+                    "UPDATE users SET username=?, first_name=?, last_seen=?, blocked=0 WHERE user_id=?",
+                    [(un, fn, ts, uid) for uid, (un, fn, ts) in seen.items()],
+                )
+                c.executemany("UPDATE users SET downloads=downloads+? WHERE user_id=?",
+                              [(k, uid) for uid, k in dl.items()])
+                c.executemany(
+                    "INSERT INTO search_downloads (user_id, date_str, count) VALUES (?,?,?) "
+                    "ON CONFLICT(user_id, date_str) DO UPDATE SET count=count+excluded.count",
+                    [(uid, day, k) for (uid, day), k in sdl.items()],
+                )
+            with self.lock:
+                self.inflight = ({}, {}, {})
+        except Exception as e:
+            # Возвращаем в буфер (более свежие значения не затираем) — повторим в следующий раз
+            logger.error(f"Write-behind flush failed ({n} rows): {e}")
+            self.stats["errors"] += 1
+            with self.lock:
+                for uid, v in seen.items():
+                    self.seen.setdefault(uid, v)
+                for uid, k in dl.items():
+                    self.dl[uid] = self.dl.get(uid, 0) + k
+                for key, k in sdl.items():
+                    self.sdl[key] = self.sdl.get(key, 0) + k
+                self.inflight = ({}, {}, {})
+            return 0
+        ms = (time.monotonic() - t) * 1000
+        self.stats["flushes"] += 1
+        self.stats["rows"] += n
+        self.stats["last_ms"] = ms
+        self.stats["max_ms"] = max(self.stats["max_ms"], ms)
+        return n
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await adb.run(self.flush)
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка бота: флашер гасим, остаток пишем синхронно."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        self.flush()
+
+    def info(self) -> dict:
+        with self.lock:
+            pending = len(self.seen) + len(self.dl) + len(self.sdl)
+        st = dict(self.stats, pending=pending)
+        st["per_flush"] = st["rows"] / st["flushes"] if st["flushes"] else 0.0
+        return st
+
+
+wb = WriteBehind(WB_FLUSH_MS, WB_MAX_OPS)
+
+
+async def update_begin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    _REQ.set({"rows": {}, "sql": 0})
+    # Строку автора читаем заранее в пуле БД: хэндлеры (tx, is_premium, db_upsert)
+    # берут её из памяти и не делают SQL на event loop
+    u = update.effective_user
+    if u:
+        await warm_users(u.id)
+
+
+async def update_end(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    req = _REQ.get()
+    if req is None:
+        return
+    _REQ.set(None)
+    _UC_STATS["updates"] += 1
+    _UC_STATS["sql_upd"] += req["sql"]
+    _UC_STATS["sql_max"] = max(_UC_STATS["sql_max"], req["sql"])
+    logger.debug(f"Update {update.update_id}: {req['sql']} SQL, rows {list(req['rows'])}")
 
 
 def db_init():
-    with _DB_LOCK:
-        c = _conn()
+    with db.write() as c:
         c.executescript("""
         CREATE TABLE IF NOT EXISTS users (
             user_id       INTEGER PRIMARY KEY,
@@ -153,23 +408,130 @@ def db_init():
             count      INTEGER DEFAULT 0,
             UNIQUE(user_id, date_str)
         );
+        CREATE TABLE IF NOT EXISTS file_cache (
+            cache_key  TEXT    PRIMARY KEY,
+            kind       TEXT    DEFAULT 'video',
+            file_ids   TEXT    DEFAULT '[]',
+            hits       INTEGER DEFAULT 0,
+            created_at INTEGER DEFAULT 0,
+            used_at    INTEGER DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id           INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id     INTEGER,
+            text         TEXT,
+            status       TEXT    DEFAULT 'running',
+            cursor       INTEGER DEFAULT 0,
+            total        INTEGER DEFAULT 0,
+            sent         INTEGER DEFAULT 0,
+            failed       INTEGER DEFAULT 0,
+            blocked      INTEGER DEFAULT 0,
+            progress_msg INTEGER DEFAULT 0,
+            created_at   INTEGER DEFAULT 0,
+            finished_at  INTEGER DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS login_tokens (
+            token      TEXT    PRIMARY KEY,
+            user_id    INTEGER,
+            expires_at REAL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_login_tokens_exp  ON login_tokens(expires_at);
+        CREATE INDEX IF NOT EXISTS idx_login_tokens_user ON login_tokens(user_id);
         CREATE INDEX IF NOT EXISTS idx_premium ON users(premium_until);
         """)
+        # Миграция: пользователи, заблокировавшие бота, не попадают в рассылки
+        cols = {r[1] for r in c.execute("PRAGMA table_info(users)")}
+        if "blocked" not in cols:
+            c.execute("ALTER TABLE users ADD COLUMN blocked INTEGER DEFAULT 0")
+        _lt_migrate(c)
     logger.info("DB ready")
 
 
+def _lt_migrate(c: sqlite3.Connection):
+    """Живые токены из login_tokens.json → таблица, файл удаляем."""
+    if not os.path.exists(_LT_FILE):
+        return
+    try:
+        with open(_LT_FILE, encoding="utf-8") as f:
+            data = json.load(f)
+        now = time.time()
+        c.executemany(
+            "INSERT OR IGNORE INTO login_tokens (token,user_id,expires_at) VALUES (?,?,?)",
+            [(t, v["uid"], v["expires"]) for t, v in data.items() if v.get("expires", 0) > now],
+        )
+        c.commit()
+        os.remove(_LT_FILE)
+        logger.info(f"login_tokens.json migrated ({len(data)} tokens)")
+    except Exception as e:
+        logger.warning(f"login_tokens.json migration failed: {e}")
+
+
+def create_login_token(uid: int) -> str:
+    """Одноразовый токен для входа на сайт; старые токены юзера и все
+    просроченные удаляются тут же (по индексам)."""
+    token = _secrets.token_urlsafe(32)
+    now = time.time()
+    with db.write() as c:
+        c.execute("DELETE FROM login_tokens WHERE user_id=? OR expires_at<?", (uid, now))
+        c.execute("INSERT INTO login_tokens (token,user_id,expires_at) VALUES (?,?,?)",
+                  (token, uid, now + LOGIN_TTL))
+    return token
+
+
 def db_get(uid: int):
-    with _DB_LOCK:
-        return _conn().execute("SELECT * FROM users WHERE user_id=?", (uid,)).fetchone()
+    req = _REQ.get()
+    # Сначала общий кэш: параллельный апдейт того же юзера мог создать строку или
+    # заменить её; контекст апдейта — запасной вариант, если запись вытеснена
+    row = _uc_peek(uid)
+    if row is not None:
+        _UC_STATS["hit"] += 1
+    elif req is not None and uid in req["rows"]:
+        _UC_STATS["ctx_hit"] += 1
+        return req["rows"][uid]
+    else:
+        _UC_STATS["miss"] += 1
+        r = db.one("SELECT * FROM users WHERE user_id=?", (uid,))
+        if r is None:
+            if req is not None:
+                req["rows"][uid] = None  # до db_upsert в этом апдейте — без повторных SELECT
+            return None
+        row = wb.overlay(uid, dict(r))
+        _uc_store(uid, row)
+    if req is not None:
+        req["rows"][uid] = row
+    return row
+
+
+async def warm_users(*uids):
+    """Строки users в кэш через пул БД — дальше tx()/is_premium() без SQL на event loop."""
+    miss = [uid for uid in uids if _uc_peek(uid) is None]
+    if miss:
+        await adb.run(lambda: [db_get(uid) for uid in miss])
+
+
+async def adb_upsert(uid: int, username: str, first_name: str):
+    """db_upsert из корутины: известный юзер — в write-behind буфер, новый — через пул БД."""
+    if _uc_peek(uid) is not None:
+        db_upsert(uid, username, first_name)
+        return
+
+    def _upsert_and_load():
+        db_upsert(uid, username, first_name)
+        db_get(uid)
+    await adb.run(_upsert_and_load)
 
 
 def db_upsert(uid: int, username: str, first_name: str):
     now = int(time.time())
-    with _DB_LOCK:
-        c = _conn()
+    if _uc_peek(uid) is not None:
+        # Пользователь точно есть в БД — обновление уходит в write-behind буфер
+        wb.touch(uid, username, first_name, now)
+        _uc_update(uid, username=username, first_name=first_name, last_seen=now, blocked=0)
+        return
+    with db.write() as c:
         if c.execute("SELECT 1 FROM users WHERE user_id=?", (uid,)).fetchone():
             c.execute(
-                "UPDATE users SET username=?, first_name=?, last_seen=? WHERE user_id=?",
+                "UPDATE users SET username=?, first_name=?, last_seen=?, blocked=0 WHERE user_id=?",
                 (username, first_name, now, uid),
             )
         else:
@@ -177,22 +539,19 @@ def db_upsert(uid: int, username: str, first_name: str):
                 "INSERT INTO users (user_id,username,first_name,joined_at,last_seen) VALUES (?,?,?,?,?)",
                 (uid, username, first_name, now, now),
             )
-        c.commit()
+    _uc_drop(uid)  # в контексте апдейта могла остаться отметка «нет строки»
 
 
 def db_set(uid: int, field: str, value):
     if field not in {"language", "auto_dl"}:
         return
-    with _DB_LOCK:
-        c = _conn()
-        c.execute(f"UPDATE users SET {field}=? WHERE user_id=?", (value, uid))
-        c.commit()
+    db.execute(f"UPDATE users SET {field}=? WHERE user_id=?", (value, uid))
+    _uc_update(uid, **{field: value})
 
 
 def db_add_premium(uid: int, days: int):
     now = int(time.time())
-    with _DB_LOCK:
-        c = _conn()
+    with db.write() as c:
         row = c.execute("SELECT premium_until FROM users WHERE user_id=?", (uid,)).fetchone()
         if not row:
             return
@@ -206,78 +565,52 @@ def db_add_premium(uid: int, days: int):
         else:
             new = now + days * 86400
         c.execute("UPDATE users SET premium_until=? WHERE user_id=?", (new, uid))
-        c.commit()
+    _uc_update(uid, premium_until=new)
 
 
 def db_mark_trial(uid: int):
-    with _DB_LOCK:
-        c = _conn()
-        c.execute("UPDATE users SET trial_used=1 WHERE user_id=?", (uid,))
-        c.commit()
+    db.execute("UPDATE users SET trial_used=1 WHERE user_id=?", (uid,))
+    _uc_update(uid, trial_used=1)
 
 
 def db_inc_dl(uid: int):
-    with _DB_LOCK:
-        c = _conn()
-        c.execute("UPDATE users SET downloads=downloads+1 WHERE user_id=?", (uid,))
-        c.commit()
+    wb.add_dl(uid)
+    _uc_add(uid, "downloads", 1)
 
 
 def db_add_stars(uid: int, stars: int):
-    with _DB_LOCK:
-        c = _conn()
-        c.execute("UPDATE users SET stars_spent=stars_spent+? WHERE user_id=?", (stars, uid))
-        c.commit()
+    db.execute("UPDATE users SET stars_spent=stars_spent+? WHERE user_id=?", (stars, uid))
+    _uc_add(uid, "stars_spent", stars)
 
 
 def db_log_tx(uid: int, stars: int, tx_type: str, months: int = 0, payload: str = ""):
-    with _DB_LOCK:
-        c = _conn()
-        c.execute(
-            "INSERT INTO transactions (user_id,stars,tx_type,months,payload,created_at) VALUES (?,?,?,?,?,?)",
-            (uid, stars, tx_type, months, payload, int(time.time())),
-        )
-        c.commit()
+    db.execute(
+        "INSERT INTO transactions (user_id,stars,tx_type,months,payload,created_at) VALUES (?,?,?,?,?,?)",
+        (uid, stars, tx_type, months, payload, int(time.time())),
+    )
 
 
 def db_add_ticket(uid: int, msg: str) -> int:
-    with _DB_LOCK:
-        c = _conn()
-        cur = c.execute(
-            "INSERT INTO support_tickets (user_id,message,created_at) VALUES (?,?,?)",
-            (uid, msg, int(time.time())),
-        )
-        c.commit()
-        return cur.lastrowid
+    return db.execute(
+        "INSERT INTO support_tickets (user_id,message,created_at) VALUES (?,?,?)",
+        (uid, msg, int(time.time())),
+    ).lastrowid
 
 
 def db_get_search_dl_count(uid: int) -> int:
     today = date.today().isoformat()
-    with _DB_LOCK:
-        row = _conn().execute(
-            "SELECT count FROM search_downloads WHERE user_id=? AND date_str=?",
-            (uid, today)
-        ).fetchone()
-        return row[0] if row else 0
+    row = db.one("SELECT count FROM search_downloads WHERE user_id=? AND date_str=?", (uid, today))
+    return (row[0] if row else 0) + wb.pending_sdl(uid, today)
 
 
 def db_inc_search_dl(uid: int):
-    today = date.today().isoformat()
-    with _DB_LOCK:
-        c = _conn()
-        c.execute(
-            "INSERT INTO search_downloads (user_id, date_str, count) VALUES (?,?,1) "
-            "ON CONFLICT(user_id, date_str) DO UPDATE SET count=count+1",
-            (uid, today)
-        )
-        c.commit()
+    wb.add_sdl(uid, date.today().isoformat())
 
 
 def db_stats() -> dict:
     now = int(time.time())
     today = int(datetime.now().replace(hour=0, minute=0, second=0).timestamp())
-    with _DB_LOCK:
-        c = _conn()
+    with db.read() as c:
         total   = c.execute("SELECT COUNT(*) FROM users").fetchone()[0]
         premium = c.execute(
             "SELECT COUNT(*) FROM users WHERE premium_until=-1 OR premium_until>?", (now,)
@@ -290,17 +623,92 @@ def db_stats() -> dict:
     return dict(total=total, premium=premium, today=new_today, downloads=dls, stars=stars)
 
 
+def db_fc_get(key: str):
+    now = int(time.time())
+    row = db.one("SELECT * FROM file_cache WHERE cache_key=?", (key,))
+    if not row:
+        return None
+    if row["created_at"] < now - FILE_CACHE_TTL:
+        db.execute("DELETE FROM file_cache WHERE cache_key=? AND created_at<?",
+                   (key, now - FILE_CACHE_TTL))
+        return None
+    db.execute("UPDATE file_cache SET hits=hits+1, used_at=? WHERE cache_key=?", (now, key))
+    return row
+
+
+def db_fc_put(key: str, kind: str, file_ids: list):
+    now = int(time.time())
+    db.execute(
+        "INSERT INTO file_cache (cache_key,kind,file_ids,created_at,used_at) VALUES (?,?,?,?,?) "
+        "ON CONFLICT(cache_key) DO UPDATE SET kind=excluded.kind, file_ids=excluded.file_ids, "
+        "created_at=excluded.created_at, used_at=excluded.used_at",
+        (key, kind, json.dumps(file_ids), now, now),
+    )
+
+
+def db_fc_drop(key: str):
+    db.execute("DELETE FROM file_cache WHERE cache_key=?", (key,))
+
+
+def db_fc_stats() -> dict:
+    with db.read() as c:
+        size = c.execute("SELECT COUNT(*) FROM file_cache").fetchone()[0]
+        hits = c.execute("SELECT COALESCE(SUM(hits),0) FROM file_cache").fetchone()[0]
+    return dict(size=size, hits_total=hits)
+
+
 def db_all_uids() -> list:
-    with _DB_LOCK:
-        return [r[0] for r in _conn().execute("SELECT user_id FROM users").fetchall()]
+    return [r[0] for r in db.all("SELECT user_id FROM users")]
+
+
+def db_mark_blocked(uids: list):
+    if not uids:
+        return
+    with db.write() as c:
+        c.executemany("UPDATE users SET blocked=1 WHERE user_id=?", [(u,) for u in uids])
+    for u in uids:
+        _uc_update(u, blocked=1)
+
+
+# ── Рассылки: прогресс в БД, чтобы продолжить после рестарта ──
+def db_bc_create(admin_id: int, text: str) -> int:
+    with db.write() as c:
+        total = c.execute("SELECT COUNT(*) FROM users WHERE blocked=0").fetchone()[0]
+        cur = c.execute(
+            "INSERT INTO broadcasts (admin_id,text,total,created_at) VALUES (?,?,?,?)",
+            (admin_id, text, total, int(time.time())),
+        )
+    return cur.lastrowid
+
+
+def db_bc_get(bid: int):
+    return db.one("SELECT * FROM broadcasts WHERE id=?", (bid,))
+
+
+def db_bc_running() -> list:
+    return db.all("SELECT * FROM broadcasts WHERE status='running'")
+
+
+def db_bc_uids(after: int, limit: int) -> list:
+    """Следующая пачка получателей по возрастанию user_id (курсор рассылки)."""
+    return [r[0] for r in db.all(
+        "SELECT user_id FROM users WHERE blocked=0 AND user_id>? ORDER BY user_id LIMIT ?",
+        (after, limit),
+    )]
+
+
+def db_bc_save(bid: int, **fields):
+    fields = {k: v for k, v in fields.items()
+              if k in {"status", "cursor", "sent", "failed", "blocked", "progress_msg", "finished_at"}}
+    if not fields:
+        return
+    db.execute(f"UPDATE broadcasts SET {', '.join(f'{k}=?' for k in fields)} WHERE id=?",
+               (*fields.values(), bid))
 
 
 def db_by_username(username: str):
     u = username.lstrip("@").lower()
-    with _DB_LOCK:
-        return _conn().execute(
-            "SELECT * FROM users WHERE LOWER(username)=?", (u,)
-        ).fetchone()
+    return db.one("SELECT * FROM users WHERE LOWER(username)=?", (u,))
 
 
 # ══════════════════════════════════════════════
@@ -386,8 +794,70 @@ T = {
             "📥 Скачиваний: <b>{downloads}</b>\n"
             "⭐ Звёзд собрано: <b>{stars}</b>"
         ),
+        "stats_cache": (
+            "🗂 <b>Кэш file_id</b>\n"
+            "┣ Записей: <b>{fc_size}</b>  (повторов всего: {fc_hits_total})\n"
+            "┣ Попаданий: <b>{fc_hit}</b>  •  промахов: <b>{fc_miss}</b>  ({fc_ratio})\n"
+            "┗ Устаревших: <b>{fc_stale}</b>"
+        ),
+        "queued":      "🕒 В очереди: <b>#{pos}</b>\n<i>Загрузка начнётся автоматически</i>",
+        "queued_prem": "⚡ Приоритетная очередь: <b>#{pos}</b>\n<i>Загрузка начнётся автоматически</i>",
+        "cancelled":   "✖️ Загрузка отменена",
+        "cancel_btn":  "✖️ Отмена",
+        "grp_video":   "⬇️ Загружаю видео...",
+        "grp_audio":   "⬇️ Загружаю аудио...",
+        "stats_queue": (
+            "⚙️ <b>Очередь загрузок</b>  ({running}/{limit} активно)\n"
+            "┣ ⚡ Premium: ждут <b>{p_depth}</b> • готово {p_done} • отмен {p_cancelled}\n"
+            "┃   ожидание ~{p_wait:.1f}с (макс {p_wait_max:.0f}с) • загрузка ~{p_service:.1f}с\n"
+            "┗ 🆓 Free: ждут <b>{f_depth}</b> • готово {f_done} • отмен {f_cancelled}\n"
+            "    ожидание ~{f_wait:.1f}с (макс {f_wait_max:.0f}с) • загрузка ~{f_service:.1f}с"
+        ),
+        "stats_search": (
+            "🔍 <b>Кэш поиска</b>\n"
+            "┣ Запросов: <b>{size}/{maxsize}</b>  •  hit rate: <b>{hit_rate:.0%}</b>\n"
+            "┣ Свежие: <b>{hit}</b>  •  устаревшие: <b>{stale}</b>  •  промахов: <b>{miss}</b>\n"
+            "┗ Фоновые обновления: <b>{refreshes}</b> (ошибок {refresh_errors}, сейчас {refreshing})  •  "
+            "~{refresh_avg:.1f}с, макс {refresh_max:.1f}с  •  поиск без кэша ~{fetch_avg:.1f}с"
+        ),
+        "stats_flight": "🔗 Склеено одинаковых загрузок: <b>{saved}</b>  (уникальных {leaders}, сейчас {inflight})",
+        "stats_users": (
+            "👤 <b>Кэш пользователей</b>\n"
+            "┣ Записей: <b>{size}/{maxsize}</b>  •  hit rate: <b>{hit_rate:.0%}</b>\n"
+            "┣ Апдейт: <b>{ctx_hit}</b>  •  LRU: <b>{hit}</b>  •  SQLite: <b>{miss}</b>\n"
+            "┗ SQL на апдейт: ~<b>{sql_avg:.1f}</b> (макс {sql_max})  •  всего {sql}"
+        ),
+        "stats_wb": (
+            "✍️ Отложенная запись: в буфере <b>{pending}</b>  •  сбросов {flushes} (~{per_flush:.1f} строк)\n"
+            "    последний {last_ms:.1f} мс (макс {max_ms:.1f})  •  ошибок {errors}"
+        ),
+        "stats_media": (
+            "💾 <b>Диск загрузок</b>\n"
+            "┣ Занято: <b>{used:.0f}/{budget:.0f} МБ</b> (+резерв {reserved:.0f})  •  файлов {files}, заняты {pinned}\n"
+            "┣ Свободно на диске: <b>{free:.0f} МБ</b>  •  вытеснено {evictions} ({evicted_bytes:.0f} МБ)\n"
+            "┗ Ожиданий места: <b>{admission_waits}</b> (~{wait_avg:.1f} с, макс {wait_max:.1f})  •  отказов {rejected}"
+        ),
+        "stats_info": (
+            "🧠 <b>Кэш метаданных</b>\n"
+            "┣ Записей: <b>{size}/{maxsize}</b>  •  hit rate: <b>{hit_rate:.0%}</b>\n"
+            "┣ Память: <b>{hit}</b>  •  SQLite: <b>{db_hit}</b>  •  промахов: <b>{miss}</b>\n"
+            "┣ Вытеснено: <b>{evicted}</b>  •  истекло: <b>{expired}</b>\n"
+            "┗ Возраст: средний при попадании <b>{avg_hit_age:.0f}с</b>, старейший <b>{oldest_age:.0f}с</b>"
+        ),
         "bc_ask":  "📢 <b>Рассылка</b>\n\nОтправь текст (HTML разрешён):\n<i>Следующее сообщение уйдёт всем</i>",
-        "bc_done": "✅ Разослано <b>{n}</b> пользователям",
+        "bc_progress": (
+            "📢 <b>Рассылка #{bid}</b>\n\n"
+            "┣ Отправлено: <b>{sent}</b> / {total}\n"
+            "┣ Заблокировали бота: <b>{blocked}</b>  •  ошибок: <b>{failed}</b>\n"
+            "┗ Скорость: <b>{rate:.1f}</b> сообщ/с  •  осталось ~{eta}"
+        ),
+        "bc_done": (
+            "✅ <b>Рассылка #{bid} завершена</b>\n\n"
+            "┣ Отправлено: <b>{sent}</b> / {total}\n"
+            "┗ Заблокировали бота: <b>{blocked}</b>  •  ошибок: <b>{failed}</b>"
+        ),
+        "bc_stopped": "⛔ Рассылка #{bid} остановлена: отправлено <b>{sent}</b> / {total}",
+        "bc_stop_btn": "⛔ Остановить рассылку",
         "no_admin": "❌ Недостаточно прав",
         "gift_ask": (
             "🎁 <b>Кому подарить Premium?</b>\n\n"
@@ -485,8 +955,70 @@ T = {
             "📥 Downloads: <b>{downloads}</b>\n"
             "⭐ Stars collected: <b>{stars}</b>"
         ),
+        "stats_cache": (
+            "🗂 <b>file_id cache</b>\n"
+            "┣ Entries: <b>{fc_size}</b>  (total reuses: {fc_hits_total})\n"
+            "┣ Hits: <b>{fc_hit}</b>  •  misses: <b>{fc_miss}</b>  ({fc_ratio})\n"
+            "┗ Stale: <b>{fc_stale}</b>"
+        ),
+        "queued":      "🕒 Queued: <b>#{pos}</b>\n<i>Download will start automatically</i>",
+        "queued_prem": "⚡ Priority queue: <b>#{pos}</b>\n<i>Download will start automatically</i>",
+        "cancelled":   "✖️ Download cancelled",
+        "cancel_btn":  "✖️ Cancel",
+        "grp_video":   "⬇️ Downloading video...",
+        "grp_audio":   "⬇️ Downloading audio...",
+        "stats_queue": (
+            "⚙️ <b>Download queue</b>  ({running}/{limit} active)\n"
+            "┣ ⚡ Premium: waiting <b>{p_depth}</b> • done {p_done} • cancelled {p_cancelled}\n"
+            "┃   wait ~{p_wait:.1f}s (max {p_wait_max:.0f}s) • service ~{p_service:.1f}s\n"
+            "┗ 🆓 Free: waiting <b>{f_depth}</b> • done {f_done} • cancelled {f_cancelled}\n"
+            "    wait ~{f_wait:.1f}s (max {f_wait_max:.0f}s) • service ~{f_service:.1f}s"
+        ),
+        "stats_search": (
+            "🔍 <b>Search cache</b>\n"
+            "┣ Queries: <b>{size}/{maxsize}</b>  •  hit rate: <b>{hit_rate:.0%}</b>\n"
+            "┣ Fresh: <b>{hit}</b>  •  stale: <b>{stale}</b>  •  misses: <b>{miss}</b>\n"
+            "┗ Background refreshes: <b>{refreshes}</b> (errors {refresh_errors}, now {refreshing})  •  "
+            "~{refresh_avg:.1f}s, max {refresh_max:.1f}s  •  uncached search ~{fetch_avg:.1f}s"
+        ),
+        "stats_flight": "🔗 Coalesced duplicate downloads: <b>{saved}</b>  (unique {leaders}, in flight {inflight})",
+        "stats_users": (
+            "👤 <b>User cache</b>\n"
+            "┣ Entries: <b>{size}/{maxsize}</b>  •  hit rate: <b>{hit_rate:.0%}</b>\n"
+            "┣ Update: <b>{ctx_hit}</b>  •  LRU: <b>{hit}</b>  •  SQLite: <b>{miss}</b>\n"
+            "┗ SQL per update: ~<b>{sql_avg:.1f}</b> (max {sql_max})  •  total {sql}"
+        ),
+        "stats_wb": (
+            "✍️ Write-behind: pending <b>{pending}</b>  •  flushes {flushes} (~{per_flush:.1f} rows)\n"
+            "    last {last_ms:.1f} ms (max {max_ms:.1f})  •  errors {errors}"
+        ),
+        "stats_media": (
+            "💾 <b>Download disk</b>\n"
+            "┣ Used: <b>{used:.0f}/{budget:.0f} MB</b> (+reserved {reserved:.0f})  •  files {files}, in use {pinned}\n"
+            "┣ Free on disk: <b>{free:.0f} MB</b>  •  evicted {evictions} ({evicted_bytes:.0f} MB)\n"
+            "┗ Admission waits: <b>{admission_waits}</b> (~{wait_avg:.1f} s, max {wait_max:.1f})  •  rejected {rejected}"
+        ),
+        "stats_info": (
+            "🧠 <b>Metadata cache</b>\n"
+            "┣ Entries: <b>{size}/{maxsize}</b>  •  hit rate: <b>{hit_rate:.0%}</b>\n"
+            "┣ Memory: <b>{hit}</b>  •  SQLite: <b>{db_hit}</b>  •  misses: <b>{miss}</b>\n"
+            "┣ Evicted: <b>{evicted}</b>  •  expired: <b>{expired}</b>\n"
+            "┗ Age: avg on hit <b>{avg_hit_age:.0f}s</b>, oldest <b>{oldest_age:.0f}s</b>"
+        ),
         "bc_ask":  "📢 <b>Broadcast</b>\n\nSend message (HTML allowed):\n<i>Your next message goes to everyone</i>",
-        "bc_done": "✅ Sent to <b>{n}</b> users",
+        "bc_progress": (
+            "📢 <b>Broadcast #{bid}</b>\n\n"
+            "┣ Sent: <b>{sent}</b> / {total}\n"
+            "┣ Blocked the bot: <b>{blocked}</b>  •  errors: <b>{failed}</b>\n"
+            "┗ Speed: <b>{rate:.1f}</b> msg/s  •  ~{eta} left"
+        ),
+        "bc_done": (
+            "✅ <b>Broadcast #{bid} finished</b>\n\n"
+            "┣ Sent: <b>{sent}</b> / {total}\n"
+            "┗ Blocked the bot: <b>{blocked}</b>  •  errors: <b>{failed}</b>"
+        ),
+        "bc_stopped": "⛔ Broadcast #{bid} stopped: sent <b>{sent}</b> / {total}",
+        "bc_stop_btn": "⛔ Stop broadcast",
         "no_admin": "❌ Insufficient permissions",
         "gift_ask": (
             "🎁 <b>Who to gift Premium?</b>\n\n"
@@ -567,9 +1099,28 @@ SINGLE = (
     "/best"
 )
 
-def _yt_opts(out_tpl: str, fmt: str) -> dict:
+def _fallback_format(limit: int | None) -> str:
+    if limit is None:
+        return "best[ext=mp4]/best"
+    mb = limit // (1024 * 1024)
+    return f"best[ext=mp4][filesize<?{mb}M]/best[filesize<?{mb}M]"
+
+
+def _cancelled(cancel) -> bool:
+    return cancel is not None and cancel.is_set()
+
+
+def _cancel_hook(cancel):
+    """progress hook: бросает DownloadCancelled, как только задачу отменили."""
+    def _hook(d):
+        if _cancelled(cancel):
+            raise yt_dlp.utils.DownloadCancelled("cancelled by user")
+    return _hook
+
+
+def _yt_opts(out_tpl: str, fmt: str, cancel: _threading.Event = None) -> dict:
     """Базовые опции yt-dlp с максимальной скоростью."""
-    return {
+    opts = {
         "outtmpl":                       out_tpl,
         "format":                        fmt,
         "quiet":                         True,
@@ -583,49 +1134,82 @@ def _yt_opts(out_tpl: str, fmt: str) -> dict:
         "no_part":                       True,     # без .part файлов
         "noprogress":                    True,
         "skip_unavailable_fragments":    True,
+        "progress_hooks":                [_cancel_hook(cancel)],
     }
+    if "+" in fmt:
+        opts["merge_output_format"] = "mp4"  # склейка video+audio → mp4 для Telegram
+    return opts
+
+
+info_cache = InfoCache(INFO_CACHE_SIZE, DB_FILE if INFO_CACHE_SHARED else None)
+search_cache = SearchCache(SEARCH_CACHE_SIZE, DB_FILE if INFO_CACHE_SHARED else None)
+media_store  = MediaStore(DOWNLOADS_DIR, MEDIA_BUDGET, MEDIA_FREE_FLOOR,
+                          timeout=MEDIA_ADMIT_WAIT, reaper=reaper)
+store_metrics(media_store, "bot")
 
 
 class Downloader:
     def get_info(self, url: str):
+        with GET_INFO_SECONDS.time(cached="1"):
+            cached = info_cache.get(url)
+        if cached is not None:
+            return cached
         opts = {
             "quiet": True,
             "no_warnings": True,
             "check_formats": False,  # быстрее без проверки форматов
         }
         try:
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                return ydl.extract_info(url, download=False)
+            with GET_INFO_SECONDS.time(cached="0"), yt_dlp.YoutubeDL(opts) as ydl:
+                info = ydl.extract_info(url, download=False)
         except Exception:
             return None
-
-    async def download(self, url: str, fmt_id: str):
-        import glob
-        ts = int(time.time())
-        os.makedirs(DOWNLOADS_DIR, exist_ok=True)
-        out_tpl = f"{DOWNLOADS_DIR}/v_{ts}.%(ext)s"
+        if not info:
+            return None
+        return info_cache.put(url, info)
+
+    async def download(self, url: str, fmt_id: str, info: dict = None, limit: int | None = TG_LIMIT,
+                       cancel: _threading.Event = None):
+        """info — уже извлечённые метаданные (по умолчанию берутся из кэша),
+        тогда yt-dlp не повторяет экстракцию, а сразу качает формат.
+        Формат подбирается под limit байт заранее; если ничего не влезает — TooLarge.
+        cancel — выставленный Event прерывает загрузку (через progress hook)."""
+        if info is None:
+            info = info_cache.get(url)
+        plan = est = None
+        platform, t0 = platform_of(url), time.perf_counter()
+        if info is not None:
+            try:
+                plan, est = plan_format(info, fmt_id, limit, audio=fmt_id == "bestaudio")
+            except TooLarge:
+                DOWNLOADS_TOTAL.inc(platform=platform, mode="bot", outcome="too_large")
+                raise
+            if plan:
+                logger.info(f"Format plan {fmt_id} → {plan} (~{(est or 0) / 1048576:.0f} MB)")
+        ws = Workspace(DOWNLOADS_DIR)
+        out_tpl = ws.tpl("v.%(ext)s")
 
         def _find_downloaded() -> str | None:
-            for ext in ("mp4", "mkv", "webm", "mp3", "m4a"):
-                p = f"{DOWNLOADS_DIR}/v_{ts}.{ext}"
-                if os.path.exists(p) and os.path.getsize(p) > 1024:
-                    return p
-            matches = glob.glob(f"{DOWNLOADS_DIR}/v_{ts}.*")
-            for p in sorted(matches):
-                if os.path.getsize(p) > 1024 and not p.endswith(".part"):
-                    return p
-            return None
+            files = ws.files()
+            return files[0] if files else None
 
         def _try_download(fmt: str) -> str | None:
-            opts = _yt_opts(out_tpl, fmt)
+            nonlocal info
+            ws.reset()
+            opts = _yt_opts(out_tpl, fmt, cancel)
+            opts.update(ws.hook_opts())
             try:
-                yt_dlp.YoutubeDL(opts).download([url])
+                download_with_info(opts, url, info)
             except Exception:
                 pass
             found = _find_downloaded()
-            if found:
+            if found or _cancelled(cancel):
                 return found
+            if info is not None:
+                info_cache.drop(url)
+                info = None
             # Fallback: android_embedded для YouTube 403
+            ws.reset()
             opts2 = dict(opts)
             opts2["extractor_args"] = {"youtube": {"player_client": ["android_embedded"]}}
             try:
@@ -634,94 +1218,78 @@ class Downloader:
                 pass
             return _find_downloaded()
 
-        # ── Аудио ──
-        if fmt_id == "bestaudio":
-            return await asyncio.to_thread(
-                _try_download,
-                "bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio"
-            )
+        def _admitted(fmt: str) -> str | None:
+            # Место на диске резервируется на время загрузки (оценка или лимит канала)
+            with media_store.admit(est or limit, cancel):
+                return _try_download(fmt)
 
-        # ── Видео ──
-        file = await asyncio.to_thread(_try_download, SINGLE)
+        try:
+            # ── Аудио ──
+            if fmt_id == "bestaudio":
+                file = await asyncio.to_thread(
+                    _admitted,
+                    plan or "bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio"
+                )
+            else:
+                # ── Видео ──
+                file = await asyncio.to_thread(_admitted, plan or SINGLE)
+
+                # ── Fallback ──
+                if not file and not _cancelled(cancel):
+                    file = await asyncio.to_thread(_admitted, _fallback_format(limit))
+        except StoreFull as e:
+            logger.warning(f"Download {url} not admitted: {e}")
+            DOWNLOADS_TOTAL.inc(platform=platform, mode="bot", outcome="rejected")
+            ws.cleanup()
+            return None
 
-        # ── Fallback ──
+        DOWNLOAD_SECONDS.observe(time.perf_counter() - t0, platform=platform, mode="bot")
         if not file:
-            file = await asyncio.to_thread(_try_download, "best[ext=mp4]/best")
-
+            DOWNLOADS_TOTAL.inc(platform=platform, mode="bot",
+                                outcome="cancelled" if _cancelled(cancel) else "error")
+            ws.cleanup()
+            return None
+        DOWNLOADS_TOTAL.inc(platform=platform, mode="bot", outcome="ok")
+        DOWNLOAD_BYTES.inc(os.path.getsize(file), platform=platform, mode="bot")
+        # Занят, пока не зальём и не отпустим через discard()
+        media_store.add(file, pin=True)
         return file
 
-    async def download_photos(self, url: str) -> list:
-        ts = int(time.time())
-        os.makedirs(DOWNLOADS_DIR, exist_ok=True)
-        out = f"{DOWNLOADS_DIR}/p_{ts}_%(autonumber)s.%(ext)s"
+    async def download_photos(self, url: str, cancel: _threading.Event = None) -> list:
+        ws = Workspace(DOWNLOADS_DIR, prefix="photo_")
         opts = {
-            "outtmpl": out,
+            "outtmpl": ws.tpl("p_%(autonumber)s.%(ext)s"),
             "quiet": True,
             "no_warnings": True,
             "format": "best",
             "extract_flat": False,
+            "progress_hooks": [_cancel_hook(cancel)],
+            **ws.hook_opts(),
         }
-        await asyncio.to_thread(lambda: yt_dlp.YoutubeDL(opts).download([url]))
-        files = sorted([
-            os.path.join(DOWNLOADS_DIR, f)
-            for f in os.listdir(DOWNLOADS_DIR)
-            if f.startswith(f"p_{ts}_") and f.lower().endswith((".jpg", ".jpeg", ".png", ".webp"))
-        ])
+        def _run():
+            with media_store.admit(PHOTO_EST, cancel):
+                yt_dlp.YoutubeDL(opts).download([url])
+
+        platform, t0 = platform_of(url), time.perf_counter()
+        try:
+            await asyncio.to_thread(_run)
+        except (yt_dlp.utils.DownloadCancelled, StoreFull):
+            pass
+        files = sorted(p for p in ws.files(min_size=0)
+                       if p.lower().endswith((".jpg", ".jpeg", ".png", ".webp")))
+        DOWNLOAD_SECONDS.observe(time.perf_counter() - t0, platform=platform, mode="photo")
+        DOWNLOADS_TOTAL.inc(platform=platform, mode="photo", outcome="ok" if files else "error")
+        if files:
+            DOWNLOAD_BYTES.inc(sum(os.path.getsize(p) for p in files), platform=platform, mode="photo")
+        if not files:
+            ws.cleanup()
+        for p in files:
+            media_store.add(p, pin=True)
         return files
 
     def search_videos(self, query: str, platform: str, max_results: int = 5) -> list:
-        if platform == "yt":
-            search_url = f"ytsearch{max_results}:{query}"
-        else:
-            search_url = f"tiktoksearch{max_results}:{query}"
-
-        opts = {
-            "quiet": True,
-            "no_warnings": True,
-            "extract_flat": True,
-            "skip_download": True,
-            "check_formats": False,
-        }
-        results = []
-        try:
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                info = ydl.extract_info(search_url, download=False)
-                entries = info.get("entries", []) if info else []
-                for e in entries:
-                    if not e:
-                        continue
-                    url = e.get("url") or e.get("webpage_url")
-                    if not url:
-                        eid = e.get("id")
-                        if platform == "yt" and eid:
-                            url = f"https://www.youtube.com/watch?v={eid}"
-                        elif eid:
-                            url = f"https://www.tiktok.com/@{e.get('uploader','user')}/video/{eid}"
-                    if not url:
-                        continue
-                    view_count = e.get("view_count") or 0
-                    duration = e.get("duration") or 0
-                    dur_str = ""
-                    if duration:
-                        mins, secs = divmod(int(duration), 60)
-                        hrs, mins = divmod(mins, 60)
-                        dur_str = f"{hrs}:{mins:02d}:{secs:02d}" if hrs else f"{mins}:{secs:02d}"
-                    views_str = ""
-                    if view_count >= 1_000_000:
-                        views_str = f"{view_count/1_000_000:.1f}M 👁"
-                    elif view_count >= 1_000:
-                        views_str = f"{view_count//1_000}K 👁"
-                    elif view_count:
-                        views_str = f"{view_count} 👁"
-                    results.append({
-                        "title": (e.get("title") or "Unknown")[:60],
-                        "url": url,
-                        "duration": dur_str,
-                        "views": views_str,
-                    })
-        except Exception as ex:
-            logger.warning(f"Search error ({platform}): {ex}")
-        return results[:max_results]
+        results = search_cache.lookup(platform, query, max_results)
+        return [dict(r, title=r["title"][:60]) for r in results]
 
     def is_photo_post(self, info: dict) -> bool:
         if not info:
@@ -741,6 +1309,577 @@ class Downloader:
 dl = Downloader()
 
 
+# ══════════════════════════════════════════════
+#  DOWNLOAD QUEUE  (общий лимит + приоритет Premium)
+# ══════════════════════════════════════════════
+DL_CONCURRENCY = int(os.getenv("DL_CONCURRENCY", "4"))
+# После стольких Premium-задач подряд пропускаем одну бесплатную — чтобы не голодала
+PREMIUM_BURST  = int(os.getenv("PREMIUM_BURST", "3"))
+QUEUE_POLL_SEC = 3  # как часто обновлять позицию в статусе
+# Апдейтов одновременно. Загрузка ждёт своей очереди внутри хэндлера и держит слот,
+# поэтому слотов больше, чем DL_CONCURRENCY: остальные — места в очереди и быстрые апдейты
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "0")) or DL_CONCURRENCY * 16
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class DownloadJob:
+    def __init__(self, jid: int, uid: int, lane: str, group=None):
+        self.id       = jid
+        self.uid      = uid
+        self.lane     = lane
+        self.group    = group  # задачи одной группы отменяются вместе
+        self.ticket   = 0      # номер в своей полосе, см. DownloadScheduler.position
+        self.created  = time.monotonic()
+        self.started  = None
+        self.finished = False
+        self.turn     = asyncio.get_running_loop().create_future()
+        self.cancel   = _threading.Event()  # видит progress hook yt-dlp
+
+
+class DownloadScheduler:
+    """Все yt-dlp загрузки бота идут через эту очередь: не больше limit
+    одновременно, Premium-задачи обслуживаются первыми."""
+
+    def __init__(self, limit: int):
+        self.limit   = limit
+        self.lanes   = {"premium": deque(), "free": deque()}
+        self.jobs    = {}  # id -> DownloadJob (ждущие и активные)
+        self.running = 0
+        self._streak = 0
+        self._ids    = itertools.count(1)
+        # позиция = ticket - popped: ticket выдаётся при постановке, popped
+        # растёт при выдаче с головы — без пересчёта всей полосы
+        self._tickets = {lane: 0 for lane in self.lanes}
+        self._popped  = {lane: 0 for lane in self.lanes}
+        self.counters = {lane: {"done": 0, "cancelled": 0, "wait_sum": 0.0, "service_sum": 0.0,
+                                "wait_max": 0.0}
+                         for lane in self.lanes}
+
+    def _next(self) -> DownloadJob | None:
+        prem, free = self.lanes["premium"], self.lanes["free"]
+        if prem and (not free or self._streak < PREMIUM_BURST):
+            self._streak += 1
+            self._popped["premium"] += 1
+            return prem.popleft()
+        if free:
+            self._streak = 0
+            self._popped["free"] += 1
+            return free.popleft()
+        return None
+
+    def _enqueue(self, job: DownloadJob):
+        job.ticket = self._tickets[job.lane]
+        self._tickets[job.lane] += 1
+        self.lanes[job.lane].append(job)
+
+    def _unqueue(self, job: DownloadJob):
+        """Убирает ждущую задачу из середины полосы: стоящие за ней сдвигаются."""
+        lane = self.lanes[job.lane]
+        i = lane.index(job)
+        del lane[i]
+        for j in itertools.islice(lane, i, None):
+            j.ticket -= 1
+        self._tickets[job.lane] -= 1
+
+    def _dispatch(self):
+        while self.running < self.limit:
+            job = self._next()
+            if job is None:
+                return
+            self.running += 1
+            job.started = time.monotonic()
+            job.turn.set_result(True)
+
+    def position(self, job: DownloadJob) -> int:
+        """1-based позиция в очереди (0 — уже качается)."""
+        if job.started is not None:
+            return 0
+        ahead = job.ticket - self._popped[job.lane]
+        if job.lane == "free":
+            ahead += len(self.lanes["premium"])
+        return ahead + 1
+
+    def cancel(self, jid: int, uid: int) -> bool:
+        job = self.jobs.get(jid)
+        if not job or job.uid != uid:
+            return False
+        targets = [j for j in self.jobs.values()
+                   if j is job or (job.group is not None and j.group == job.group)]
+        for j in targets:
+            j.cancel.set()
+            if j.started is None and not j.turn.done():
+                self._unqueue(j)
+                j.turn.set_exception(JobCancelled())
+        return True
+
+    async def run(self, uid: int, factory, on_position=None, group=None):
+        """Ждёт своей очереди и выполняет factory(job) → coroutine.
+        on_position(job, pos) вызывается при смене позиции (0 — старт)."""
+        await warm_users(uid)
+        lane = "premium" if is_premium(uid) else "free"
+        job = DownloadJob(next(self._ids), uid, lane, group)
+        self.jobs[job.id] = job
+        self._enqueue(job)
+        self._dispatch()
+        try:
+            last = None
+            while not job.turn.done():
+                pos = self.position(job)
+                if pos != last and on_position:
+                    await on_position(job, pos)
+                last = pos
+                await asyncio.wait({job.turn}, timeout=QUEUE_POLL_SEC)
+            try:
+                job.turn.result()
+            except JobCancelled:
+                self.counters[lane]["cancelled"] += 1
+                raise
+
+            result = None
+            try:
+                if on_position:
+                    await on_position(job, 0)
+                result = await factory(job)
+            finally:
+                self._release(job)
+                c = self.counters[lane]
+                if job.cancel.is_set() and not result:
+                    c["cancelled"] += 1  # отменённая на ходу — не «done»
+                else:
+                    wait = job.started - job.created
+                    c["wait_sum"] += wait
+                    c["wait_max"] = max(c["wait_max"], wait)
+                    c["service_sum"] += time.monotonic() - job.started
+                    c["done"] += 1
+            if job.cancel.is_set() and not result:
+                raise JobCancelled()
+            return result
+        finally:
+            self.jobs.pop(job.id, None)
+            # сам хэндлер отменили (asyncio) — убираем из очереди / освобождаем слот
+            if job.started is None and job in self.lanes[lane]:
+                self._unqueue(job)
+            self._release(job)
+
+    def _release(self, job: DownloadJob):
+        if job.started is not None and not job.finished:
+            job.finished = True
+            self.running -= 1
+            self._dispatch()
+
+    def stats(self) -> dict:
+        out = {"running": self.running, "limit": self.limit}
+        for lane, c in self.counters.items():
+            n = c["done"] or 1
+            out[lane] = dict(
+                depth=len(self.lanes[lane]), done=c["done"], cancelled=c["cancelled"],
+                wait_avg=c["wait_sum"] / n, wait_max=c["wait_max"],
+                service_avg=c["service_sum"] / n,
+            )
+        return out
+
+
+scheduler = DownloadScheduler(DL_CONCURRENCY)
+
+metrics.gauge("puwe_queue_depth", "Ждут слота загрузки", ["proc", "lane"],
+              fn=lambda: {("bot", lane): len(q) for lane, q in scheduler.lanes.items()}, source="bot")
+metrics.gauge("puwe_ytdlp_active", "Загрузок yt-dlp сейчас", ["proc"],
+              fn=lambda: {("bot",): scheduler.running}, source="bot")
+
+
+def queue_stats() -> dict:
+    st = scheduler.stats()
+    out = {"running": st["running"], "limit": st["limit"]}
+    for lane, p in (("premium", "p"), ("free", "f")):
+        l = st[lane]
+        out.update({f"{p}_depth": l["depth"], f"{p}_done": l["done"], f"{p}_cancelled": l["cancelled"],
+                    f"{p}_wait": l["wait_avg"], f"{p}_wait_max": l["wait_max"],
+                    f"{p}_service": l["service_avg"]})
+    return out
+
+
+def kb_cancel(uid: int, jid: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[_btn(tx(uid, "cancel_btn"), f"cancel_{jid}")]])
+
+
+async def queued(uid: int, msg, factory, text_key: str = "downloading", group=None):
+    """scheduler.run с позицией в очереди и кнопкой отмены в статусе msg."""
+    async def _show(job, pos):
+        if pos:
+            key = "queued_prem" if job.lane == "premium" else "queued"
+            text = tx(uid, key, pos=pos)
+        else:
+            text = tx(uid, text_key)
+        try:
+            await msg.edit_text(text, parse_mode="HTML", reply_markup=kb_cancel(uid, job.id))
+        except Exception:
+            pass
+    return await scheduler.run(uid, factory, _show, group)
+
+
+class GroupStatus:
+    """Одно сообщение-статус на параллельные загрузки (видео + аудио группы).
+    У каждой ноги своя строка; кнопка отмены — от ещё идущей ноги
+    (scheduler.cancel снимает всю группу)."""
+    ICONS = {"video": "🎬", "audio": "🎵"}
+
+    def __init__(self, msg):
+        self.msg    = msg
+        self.lines  = {}  # нога -> текст
+        self.markup = {}  # нога -> кнопка отмены её задачи
+        self._lock  = asyncio.Lock()
+        self._shown = None
+
+    def leg(self, name: str) -> "_StatusLeg":
+        return _StatusLeg(self, name)
+
+    async def update(self, name: str, text: str, markup=None):
+        self.lines[name] = text
+        if markup is not None:
+            self.markup[name] = markup
+        await self._render()
+
+    async def done(self, name: str):
+        """Нога докачала (или упала): строку и кнопку убираем."""
+        self.lines.pop(name, None)
+        self.markup.pop(name, None)
+        if self.lines:
+            await self._render()
+
+    async def _render(self):
+        async with self._lock:
+            text = "\n\n".join(f"{self.ICONS.get(n, '')} {t}" for n, t in self.lines.items())
+            markup = next(reversed(self.markup.values()), None)
+            if not text or (text, markup) == self._shown:
+                return
+            self._shown = (text, markup)
+            try:
+                await self.msg.edit_text(text, parse_mode="HTML", reply_markup=markup)
+            except Exception:
+                pass
+
+
+class _StatusLeg:
+    """msg для queued()/fetch(): правки одной ноги уходят в общий GroupStatus."""
+
+    def __init__(self, status: GroupStatus, name: str):
+        self.status = status
+        self.name   = name
+
+    async def edit_text(self, text: str, parse_mode=None, reply_markup=None):
+        await self.status.update(self.name, text, reply_markup)
+
+
+async def fetch(uid: int, msg, url: str, fmt: str, factory, text_key: str = "downloading", group=None):
+    """queued() + single-flight: одновременные запросы той же ссылки и формата
+    (несколько групп, несколько юзеров) ждут одну загрузку и получают один файл.
+    После отправки файл отдаём через discard()."""
+    key = f"bot|{canonical_url(url)}|{fmt}"
+    while True:
+        call, leader = flight.join(key)
+        if leader:
+            try:
+                result = await queued(uid, msg, factory, text_key, group)
+            except BaseException as e:
+                flight.finish(call, error=e)
+                raise
+            flight.finish(call, result)
+            return result
+        try:
+            await msg.edit_text(tx(uid, text_key))
+        except Exception:
+            pass
+        try:
+            # shield: наша отмена не должна трогать общий Future остальных
+            return await asyncio.shield(asyncio.wrap_future(call.future))
+        except JobCancelled:
+            # Отменил тот, кто качал, а не мы — встаём в очередь сами
+            continue
+        except asyncio.CancelledError:
+            # Отменили нас: лидер уже посчитал нас держателем файла —
+            # отпускаем свою долю, как только результат будет готов
+            call.future.add_done_callback(_discard_result)
+            raise
+
+
+def discard(*paths):
+    """Удаляет файл (и папку задачи), когда его отпустили все получатели single-flight."""
+    for p in paths:
+        if p and flight.release(p):
+            remove_output(p)
+            media_store.forget(p)
+
+
+def _discard_result(future):
+    """discard() для результата single-flight, который никто не забрал."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    r = future.result()
+    discard(*(r if isinstance(r, list) else [r] if isinstance(r, str) else []))
+
+
+# ══════════════════════════════════════════════
+#  FILE_ID CACHE  (повторная отправка без скачивания)
+# ══════════════════════════════════════════════
+
+_FC_STATS = {"hit": 0, "miss": 0, "stale": 0}
+
+
+def fc_key(url: str, fmt: str) -> str:
+    return f"{canonical_url(url)}|{fmt}"
+
+
+def _sent_file(m) -> tuple:
+    """(kind, file_id) из отправленного сообщения."""
+    if m.video:
+        return "video", m.video.file_id
+    if m.audio:
+        return "audio", m.audio.file_id
+    if m.document:
+        return "document", m.document.file_id
+    if m.photo:
+        return "photo", m.photo[-1].file_id
+    return None, None
+
+
+async def fc_remember(url: str, fmt: str, sent):
+    """Запоминает file_id после первой заливки. sent — Message или список (альбом)."""
+    msgs = sent if isinstance(sent, (list, tuple)) else [sent]
+    kind, ids = None, []
+    for m in msgs:
+        k, fid = _sent_file(m)
+        if fid:
+            kind = kind or k
+            ids.append(fid)
+    if kind and ids:
+        try:
+            await adb.run(db_fc_put, fc_key(url, fmt), kind, ids)
+        except Exception as e:
+            logger.warning(f"file_id cache write error: {e}")
+
+
+async def fc_send(bot, chat_id: int, url: str, fmt: str, cap: str, send_kw: dict,
+                  probe: bool = False) -> bool:
+    """Отправляет файл по сохранённому file_id. True — отправлено, качать не нужно.
+    probe=True — проверка «на всякий случай» (фото-пост), промах не считаем."""
+    key = fc_key(url, fmt)
+    row = await adb.run(db_fc_get, key)
+    if not row:
+        if not probe:
+            _FC_STATS["miss"] += 1
+        return False
+    ids = json.loads(row["file_ids"])
+    kind = row["kind"]
+    try:
+        if kind == "photo" and len(ids) > 1:
+            media = [InputMediaPhoto(fid, caption=cap if i == 0 else None) for i, fid in enumerate(ids)]
+            await bot.send_media_group(chat_id, media, **send_kw)
+        elif kind == "photo":
+            await bot.send_photo(chat_id, ids[0], caption=cap, **send_kw)
+        elif kind == "audio":
+            await bot.send_audio(chat_id, ids[0], caption=cap, **send_kw)
+        elif kind == "document":
+            await bot.send_document(chat_id, ids[0], caption=cap, **send_kw)
+        else:
+            await bot.send_video(chat_id, ids[0], caption=cap, supports_streaming=True, **send_kw)
+    except BadRequest as e:
+        # Telegram больше не принимает этот file_id — забываем и качаем заново
+        logger.info(f"Stale file_id for {key}: {e}")
+        await adb.run(db_fc_drop, key)
+        _FC_STATS["stale"] += 1
+        return False
+    _FC_STATS["hit"] += 1
+    return True
+
+
+def fc_stats() -> dict:
+    s = db_fc_stats()
+    total = _FC_STATS["hit"] + _FC_STATS["miss"]
+    return dict(
+        fc_size=s["size"], fc_hits_total=s["hits_total"],
+        fc_hit=_FC_STATS["hit"], fc_miss=_FC_STATS["miss"], fc_stale=_FC_STATS["stale"],
+        fc_ratio=f"{_FC_STATS['hit'] * 100 / total:.0f}%" if total else "—",
+    )
+
+
+# ══════════════════════════════════════════════
+#  BROADCAST  (фоновая рассылка с лимитом скорости)
+# ══════════════════════════════════════════════
+BC_RATE         = float(os.getenv("BC_RATE", "25"))   # сообщ/с, у Telegram ~30 на бота
+BC_CONCURRENCY  = int(os.getenv("BC_CONCURRENCY", "8"))
+BC_BATCH        = 200  # курсор сохраняется после каждой пачки
+BC_PROGRESS_SEC = 5
+BC_RETRIES      = 3
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше burst подряд.
+    pause() останавливает всех отправителей (ответ RetryAfter от Telegram)."""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate   = rate
+        self.burst  = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.stamp  = time.monotonic()
+        self.paused_until = 0.0
+        self._lock  = asyncio.Lock()
+
+    def pause(self, sec: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + sec)
+        self.tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+bc_bucket = TokenBucket(BC_RATE)
+
+
+class Broadcast:
+    def __init__(self, row):
+        self.id       = row["id"]
+        self.admin_id = row["admin_id"]
+        self.text     = row["text"]
+        self.cursor   = row["cursor"]
+        self.total    = row["total"]
+        self.sent     = row["sent"]
+        self.failed   = row["failed"]
+        self.blocked  = row["blocked"]
+        self.msg_id   = row["progress_msg"]
+        self.stop     = False
+        self.task     = None
+        self._t0      = time.monotonic()
+        self._done0   = self.done
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    def rate(self) -> float:
+        dt = time.monotonic() - self._t0
+        return (self.done - self._done0) / dt if dt > 0 else 0.0
+
+    def fields(self) -> dict:
+        rate = self.rate()
+        left = max(0, self.total - self.done)
+        eta = time.strftime("%H:%M:%S", time.gmtime(left / rate)) if rate > 0 else "—"
+        return dict(bid=self.id, sent=self.sent, failed=self.failed, blocked=self.blocked,
+                    total=self.total, rate=rate, eta=eta)
+
+
+_BROADCASTS: dict[int, Broadcast] = {}  # активные рассылки
+
+
+def _retry_after(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+
+async def _bc_send(bot, b: Broadcast, uid: int) -> str:
+    """sent / blocked / failed / skipped."""
+    for _ in range(BC_RETRIES):
+        if b.stop:
+            return "skipped"
+        await bc_bucket.acquire()
+        try:
+            await bot.send_message(uid, b.text, parse_mode="HTML")
+            return "sent"
+        except RetryAfter as e:
+            bc_bucket.pause(_retry_after(e) + 1)
+        except Forbidden:
+            return "blocked"
+        except BadRequest as e:
+            return "blocked" if "chat not found" in str(e).lower() else "failed"
+        except Exception as e:
+            logger.debug(f"Broadcast {b.id} → {uid}: {e}")
+            return "failed"
+    return "failed"
+
+
+def kb_bc_stop(uid: int, bid: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[_btn(tx(uid, "bc_stop_btn"), f"bcstop_{bid}")]])
+
+
+async def bc_show(bot, b: Broadcast, final: str | None = None):
+    """Прогресс в чате админа; final — bc_done / bc_stopped."""
+    await warm_users(b.admin_id)
+    text = tx(b.admin_id, final or "bc_progress", **b.fields())
+    markup = None if final else kb_bc_stop(b.admin_id, b.id)
+    try:
+        if b.msg_id:
+            await bot.edit_message_text(text, b.admin_id, b.msg_id, parse_mode="HTML", reply_markup=markup)
+        else:
+            m = await bot.send_message(b.admin_id, text, parse_mode="HTML", reply_markup=markup)
+            b.msg_id = m.message_id
+            await adb.run(db_bc_save, b.id, progress_msg=b.msg_id)
+    except Exception as e:
+        if "not modified" not in str(e).lower():
+            logger.debug(f"Broadcast {b.id} progress: {e}")
+
+
+async def bc_run(bot, b: Broadcast):
+    _REQ.set(None)  # задача живёт дольше апдейта, который её запустил
+    sem = asyncio.Semaphore(BC_CONCURRENCY)
+
+    async def one(uid):
+        async with sem:
+            return uid, await _bc_send(bot, b, uid)
+
+    shown = 0.0
+    try:
+        while not b.stop:
+            uids = await adb.run(db_bc_uids, b.cursor, BC_BATCH)
+            if not uids:
+                break
+            blocked = []
+            for uid, res in await asyncio.gather(*(one(x) for x in uids)):
+                if res == "sent":
+                    b.sent += 1
+                elif res == "blocked":
+                    b.blocked += 1
+                    blocked.append(uid)
+                elif res == "failed":
+                    b.failed += 1
+            b.cursor = uids[-1]
+            await adb.run(db_mark_blocked, blocked)
+            await adb.run(db_bc_save, b.id, cursor=b.cursor, sent=b.sent, failed=b.failed, blocked=b.blocked)
+            if time.monotonic() - shown >= BC_PROGRESS_SEC:
+                await bc_show(bot, b)
+                shown = time.monotonic()
+    except Exception as e:
+        # status остаётся running — продолжим после рестарта
+        logger.error(f"Broadcast {b.id} crashed: {e}")
+        _BROADCASTS.pop(b.id, None)
+        return
+
+    status = "cancelled" if b.stop else "done"
+    await adb.run(db_bc_save, b.id, status=status, finished_at=int(time.time()))
+    _BROADCASTS.pop(b.id, None)
+    logger.info(f"Broadcast {b.id} {status}: sent={b.sent} blocked={b.blocked} failed={b.failed}")
+    await bc_show(bot, b, "bc_stopped" if b.stop else "bc_done")
+
+
+def bc_start(bot, row) -> Broadcast:
+    b = Broadcast(row)
+    _BROADCASTS[b.id] = b
+    b.task = asyncio.create_task(bc_run(bot, b))
+    return b
+
+
 # ══════════════════════════════════════════════
 #  KEYBOARDS
 # ══════════════════════════════════════════════
@@ -848,11 +1987,11 @@ def kb_admin(lang: str = "ru") -> InlineKeyboardMarkup:
 # ══════════════════════════════════════════════
 async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
-    db_upsert(u.id, u.username or "", u.first_name or "")
+    await adb_upsert(u.id, u.username or "", u.first_name or "")
 
     args = ctx.args or []
     if args and args[0] == "webapp":
-        token = create_login_token(u.id)
+        token = await adb.run(create_login_token, u.id)
         login_url = f"{SITE_URL}/login/{token}"
         text = (
             "🔑 <b>Ссылка для входа на сайт</b>\n\n"
@@ -890,13 +2029,13 @@ async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_help(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
-    db_upsert(u.id, u.username or "", u.first_name or "")
+    await adb_upsert(u.id, u.username or "", u.first_name or "")
     await update.message.reply_text(tx(u.id, "help"), parse_mode="HTML")
 
 
 async def cmd_sub(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
-    db_upsert(u.id, u.username or "", u.first_name or "")
+    await adb_upsert(u.id, u.username or "", u.first_name or "")
     user = db_get(u.id)
     pu = user["premium_until"] if user else 0
     now = int(time.time())
@@ -915,7 +2054,7 @@ async def cmd_sub(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_profile(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
-    db_upsert(u.id, u.username or "", u.first_name or "")
+    await adb_upsert(u.id, u.username or "", u.first_name or "")
     user = db_get(u.id)
     joined = (
         datetime.fromtimestamp(user["joined_at"]).strftime("%d.%m.%Y")
@@ -940,7 +2079,7 @@ async def cmd_profile(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_settings(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
-    db_upsert(u.id, u.username or "", u.first_name or "")
+    await adb_upsert(u.id, u.username or "", u.first_name or "")
     await update.message.reply_text(
         tx(u.id, "settings"), parse_mode="HTML", reply_markup=kb_settings(u.id)
     )
@@ -948,7 +2087,7 @@ async def cmd_settings(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_ticket(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
-    db_upsert(u.id, u.username or "", u.first_name or "")
+    await adb_upsert(u.id, u.username or "", u.first_name or "")
     if not is_premium(u.id):
         await update.message.reply_text(tx(u.id, "ticket_prem"), parse_mode="HTML")
         return
@@ -958,7 +2097,7 @@ async def cmd_ticket(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_search(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
-    db_upsert(u.id, u.username or "", u.first_name or "")
+    await adb_upsert(u.id, u.username or "", u.first_name or "")
     args = ctx.args
 
     if not args or len(args) < 2:
@@ -992,7 +2131,7 @@ async def cmd_search(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     prem = is_premium(u.id)
     limit = PREMIUM_SEARCH_DL_DAY if prem else FREE_SEARCH_DL_DAY
-    used = db_get_search_dl_count(u.id)
+    used = await adb.run(db_get_search_dl_count, u.id)
     lang = get_lang(u.id)
 
     lines = []
@@ -1031,14 +2170,29 @@ async def cmd_search(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await m.edit_text(text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup(kb_rows))
 
 
+def stats_text(uid: int) -> str:
+    return "\n\n".join([
+        tx(uid, "stats", **db_stats()),
+        tx(uid, "stats_cache", **fc_stats()),
+        tx(uid, "stats_info", **info_cache.stats()),
+        tx(uid, "stats_search", **search_cache.stats()),
+        tx(uid, "stats_queue", **queue_stats()),
+        tx(uid, "stats_flight", **flight.stats()),
+        tx(uid, "stats_users", **user_cache_stats()),
+        tx(uid, "stats_wb", **wb.info()),
+        tx(uid, "stats_media", **{k: v / 1048576 if k in ("budget", "used", "reserved", "free",
+                                                          "evicted_bytes") else v
+                                  for k, v in media_store.stats().items()}),
+    ])
+
+
 async def cmd_stats(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     if uid not in ADMIN_IDS:
         await update.message.reply_text(tx(uid, "no_admin"))
         return
-    s = db_stats()
     await update.message.reply_text(
-        tx(uid, "stats", **s), parse_mode="HTML", reply_markup=kb_admin(get_lang(uid))
+        await adb.run(stats_text, uid), parse_mode="HTML", reply_markup=kb_admin(get_lang(uid))
     )
 
 
@@ -1056,92 +2210,114 @@ async def cmd_admin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if uid not in ADMIN_IDS:
         await update.message.reply_text(tx(uid, "no_admin"))
         return
-    s = db_stats()
     await update.message.reply_text(
-        tx(uid, "stats", **s), parse_mode="HTML", reply_markup=kb_admin(get_lang(uid))
+        await adb.run(stats_text, uid), parse_mode="HTML", reply_markup=kb_admin(get_lang(uid))
     )
 
 
 # ══════════════════════════════════════════════
 #  DOWNLOAD HELPER
 # ══════════════════════════════════════════════
-async def do_download(ctx, msg, url: str, fmt_id: str, width: int, uid: int, chat_id: int, thread_id: int = None):
-    try:
-        file = await dl.download(url, fmt_id)
-        if not file:
-            await msg.edit_text(tx(uid, "err_dl", err="file not found"), parse_mode="HTML")
-            return
+async def send_promo(ctx, uid: int, chat_id: int, thread_id: int = None):
+    if is_premium(uid):
+        return
+    u_row = db_get(uid)
+    dl_count = (u_row["downloads"] + 1) if u_row else 1
+    if dl_count % 3 != 0:
+        return
+    lang = get_lang(uid)
+    promo_text = (
+        "💡 <b>Устал от вотермарка?</b>\n\n"
+        "С <b>Premium</b> ты получаешь:\n"
+        "┣ 🎫 Прямой чат с поддержкой\n"
+        "┣ ⚡ Приоритетная загрузка\n"
+        "┗ ⚙️ Расширенные настройки\n\n"
+        "🎁 Попробуй <b>7 дней за 5⭐</b> — это дешевле чашки кофе!"
+        if lang == "ru" else
+        "💡 <b>Скачивай быстрее с Premium!</b>\n\n"
+        "With <b>Premium</b> you get:\n"
+        "┣ 🎫 Direct chat with support\n"
+        "┣ ⚡ Priority downloads\n"
+        "┗ ⚙️ Advanced settings\n\n"
+        "🎁 Try <b>7 days for 5⭐</b> — cheaper than a coffee!"
+    )
+    promo_kwargs = {"parse_mode": "HTML", "reply_markup": InlineKeyboardMarkup([[
+        _btn("👑 Попробовать Premium" if lang == "ru" else "👑 Try Premium", "sub")
+    ]])}
+    if thread_id:
+        promo_kwargs["message_thread_id"] = thread_id
+    await ctx.bot.send_message(chat_id, promo_text, **promo_kwargs)
+
+
+def too_big_text(uid: int, size_mb: float) -> str:
+    limit_mb = TG_LIMIT / (1024 * 1024) + 1
+    if get_lang(uid) == "ru":
+        return (f"⚠️ Файл слишком большой ({size_mb:.0f} МБ) — Telegram не принимает файлы >{limit_mb:.0f} МБ.\n"
+                "Попробуй выбрать качество пониже.")
+    return (f"⚠️ File too large ({size_mb:.0f} MB) — Telegram doesn't accept files >{limit_mb:.0f} MB.\n"
+            "Try selecting a lower quality.")
 
-        final = file
-        await msg.edit_text(tx(uid, "sending"))
-
-        size_mb = os.path.getsize(final) / (1024 * 1024)
-        if size_mb > 49 and not final.endswith(".mp3"):
-            lang = get_lang(uid)
-            too_big = (
-                f"⚠️ Файл слишком большой ({size_mb:.0f} МБ) — Telegram не принимает файлы >50 МБ.\n"
-                "Попробуй выбрать качество пониже."
-                if lang == "ru" else
-                f"⚠️ File too large ({size_mb:.0f} MB) — Telegram doesn't accept files >50 MB.\n"
-                "Try selecting a lower quality."
-            )
-            await msg.edit_text(too_big, parse_mode="HTML")
-            for p in {file, final}:
-                try:
-                    if os.path.exists(p): os.remove(p)
-                except Exception: pass
-            return
 
+async def do_download(ctx, msg, url: str, fmt_id: str, width: int, uid: int, chat_id: int, thread_id: int = None):
+    try:
         cap = tx(uid, "done_cap", bot=BOT_USERNAME)
         send_kwargs = {"caption": cap}
         if thread_id:
             send_kwargs["message_thread_id"] = thread_id
-        with open(final, "rb") as fh:
-            if final.endswith(".mp3"):
-                await ctx.bot.send_audio(chat_id, fh, **send_kwargs)
-            else:
-                await ctx.bot.send_video(chat_id, fh, supports_streaming=True, **send_kwargs)
+
+        # ── Уже заливали — отдаём по file_id ──
+        if await fc_send(ctx.bot, chat_id, url, fmt_id, cap,
+                         {"message_thread_id": thread_id} if thread_id else {}):
+            try:
+                await msg.delete()
+            except Exception:
+                pass
+            await send_promo(ctx, uid, chat_id, thread_id)
+            db_inc_dl(uid)
+            return
 
         try:
-            await msg.delete()
-        except Exception:
-            pass
+            file = await fetch(uid, msg, url, fmt_id,
+                               lambda job: dl.download(url, fmt_id, cancel=job.cancel))
+        except TooLarge as e:
+            # Узнали заранее — ни одного байта не скачали
+            await msg.edit_text(too_big_text(uid, (e.size or 0) / (1024 * 1024)), parse_mode="HTML")
+            return
+        except JobCancelled:
+            await msg.edit_text(tx(uid, "cancelled"))
+            return
+        if not file:
+            await msg.edit_text(tx(uid, "err_dl", err="file not found"), parse_mode="HTML")
+            return
+
+        # Пин MediaStore и ссылку single-flight отпускаем при любом исходе отправки
+        try:
+            final = file
+            await msg.edit_text(tx(uid, "sending"))
+
+            size = os.path.getsize(final)
+            if size > TG_LIMIT and not final.endswith(".mp3"):
+                await msg.edit_text(too_big_text(uid, size / (1024 * 1024)), parse_mode="HTML")
+                return
+
+            with tg_file(final) as fh:
+                if final.endswith(".mp3"):
+                    sent = await ctx.bot.send_audio(chat_id, fh, **send_kwargs)
+                else:
+                    sent = await ctx.bot.send_video(chat_id, fh, supports_streaming=True, **send_kwargs)
+            await fc_remember(url, fmt_id, sent)
 
-        if not is_premium(uid):
-            u_row = db_get(uid)
-            dl_count = (u_row["downloads"] + 1) if u_row else 1
-            if dl_count % 3 == 0:
-                lang = get_lang(uid)
-                promo_text = (
-                    "💡 <b>Устал от вотермарка?</b>\n\n"
-                    "С <b>Premium</b> ты получаешь:\n"
-                    "┣ 🎫 Прямой чат с поддержкой\n"
-                    "┣ ⚡ Приоритетная загрузка\n"
-                    "┗ ⚙️ Расширенные настройки\n\n"
-                    "🎁 Попробуй <b>7 дней за 5⭐</b> — это дешевле чашки кофе!"
-                    if lang == "ru" else
-                    "💡 <b>Скачивай быстрее с Premium!</b>\n\n"
-                    "With <b>Premium</b> you get:\n"
-                    "┣ 🎫 Direct chat with support\n"
-                    "┣ ⚡ Priority downloads\n"
-                    "┗ ⚙️ Advanced settings\n\n"
-                    "🎁 Try <b>7 days for 5⭐</b> — cheaper than a coffee!"
-                )
-                promo_kwargs = {"parse_mode": "HTML", "reply_markup": InlineKeyboardMarkup([[
-                    _btn("👑 Попробовать Premium" if lang == "ru" else "👑 Try Premium", "sub")
-                ]])}
-                if thread_id:
-                    promo_kwargs["message_thread_id"] = thread_id
-                await ctx.bot.send_message(chat_id, promo_text, **promo_kwargs)
-
-        db_inc_dl(uid)
-        for p in {file, final}:
             try:
-                if os.path.exists(p):
-                    os.remove(p)
+                await msg.delete()
             except Exception:
                 pass
 
+            await send_promo(ctx, uid, chat_id, thread_id)
+
+            db_inc_dl(uid)
+        finally:
+            discard(file)
+
     except Exception as e:
         logger.exception("Download error")
         try:
@@ -1150,34 +2326,73 @@ async def do_download(ctx, msg, url: str, fmt_id: str, width: int, uid: int, cha
             pass
 
 
+TG_UPLOAD_SECONDS = metrics.histogram(
+    "puwe_tg_upload_seconds", "Отправка файла в Telegram (send_* целиком)", ["api"])
+TG_UPLOAD_BYTES   = metrics.counter("puwe_tg_upload_bytes_total", "Залито в Telegram, байт", ["api"])
+TG_UPLOAD_ERRORS  = metrics.counter("puwe_tg_upload_errors_total", "Неудачные отправки файлов", ["api"])
+_TG_API = "local" if LOCAL_MODE else "cloud"
+
+
+@contextmanager
+def tg_file(path: str, timed: bool = True):
+    """Что передавать в send_*: в LOCAL_MODE — абсолютный путь (сервер Bot API
+    читает файл сам, без multipart-копии через Python), иначе — открытый файл.
+    timed — блок with и есть отправка: время и байты идут в метрики."""
+    t = time.perf_counter()
+    try:
+        if LOCAL_MODE:
+            yield Path(path).resolve()
+        else:
+            with open(path, "rb") as fh:
+                yield fh
+    except BaseException:
+        if timed:
+            TG_UPLOAD_ERRORS.inc(api=_TG_API)
+        raise
+    if timed:
+        TG_UPLOAD_SECONDS.observe(time.perf_counter() - t, api=_TG_API)
+        TG_UPLOAD_BYTES.inc(os.path.getsize(path), api=_TG_API)
+
+
+async def send_photos(ctx, chat_id: int, url: str, photos: list, cap: str, send_kw: dict):
+    try:
+        if len(photos) == 1:
+            with tg_file(photos[0]) as fh:
+                sent = await ctx.bot.send_photo(chat_id, fh, caption=cap, **send_kw)
+        else:
+            media = []
+            for i, p in enumerate(photos):
+                with tg_file(p, timed=False) as fh:
+                    media.append(InputMediaPhoto(fh, caption=cap if i == 0 else None))
+            with TG_UPLOAD_SECONDS.time(api=_TG_API):
+                sent = await ctx.bot.send_media_group(chat_id, media, **send_kw)
+            TG_UPLOAD_BYTES.inc(sum(os.path.getsize(p) for p in photos), api=_TG_API)
+        await fc_remember(url, "photo", sent)
+    finally:
+        discard(*photos)
+
+
 # ══════════════════════════════════════════════
 #  MESSAGE HANDLER
 # ══════════════════════════════════════════════
 async def handle_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
     text = update.message.text or ""
-    db_upsert(u.id, u.username or "", u.first_name or "")
+    await adb_upsert(u.id, u.username or "", u.first_name or "")
     thread_id = update.message.message_thread_id
 
     if ctx.user_data.get("awaiting_broadcast") and u.id in ADMIN_IDS:
         ctx.user_data.pop("awaiting_broadcast")
-        uids = db_all_uids()
-        sent = 0
-        for uid in uids:
-            try:
-                await ctx.bot.send_message(uid, text, parse_mode="HTML")
-                sent += 1
-                await asyncio.sleep(0.04)
-            except Exception:
-                pass
-        await update.message.reply_text(tx(u.id, "bc_done", n=sent), parse_mode="HTML")
+        bid = await adb.run(db_bc_create, u.id, text)
+        bc_start(ctx.bot, await adb.run(db_bc_get, bid))
         return
 
     if ctx.user_data.get("awaiting_ticket"):
         ctx.user_data.pop("awaiting_ticket")
         if is_premium(u.id):
-            tid = db_add_ticket(u.id, text)
+            tid = await adb.run(db_add_ticket, u.id, text)
             await update.message.reply_text(tx(u.id, "ticket_sent"), parse_mode="HTML")
+            await warm_users(*ADMIN_IDS)
             for aid in ADMIN_IDS:
                 try:
                     await ctx.bot.send_message(
@@ -1195,9 +2410,9 @@ async def handle_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         to_user = None
         try:
             if target.lstrip("@").isdigit():
-                to_user = db_get(int(target.lstrip("@")))
+                to_user = await adb.run(db_get, int(target.lstrip("@")))
             else:
-                to_user = db_by_username(target)
+                to_user = await adb.run(db_by_username, target)
         except Exception:
             pass
 
@@ -1225,84 +2440,112 @@ async def handle_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     chat_type = update.effective_chat.type
     is_group = chat_type in ("group", "supergroup", "channel")
+    chat_id = update.message.chat_id
+    send_kw = {"message_thread_id": thread_id} if thread_id else {}
+    cap = tx(u.id, "done_cap", bot=BOT_USERNAME)
+
+    # Фото-пост уже отправляли — отдаём сразу, без yt-dlp
+    if await fc_send(ctx.bot, chat_id, url, "photo", cap, send_kw, probe=True):
+        db_inc_dl(u.id)
+        return
 
     if is_group:
-        send_kw = {"message_thread_id": thread_id} if thread_id else {}
+        # Видео и аудио из кэша file_id; качаем только то, чего нет
+        need_video = not await fc_send(ctx.bot, chat_id, url, "best", cap, send_kw)
+        need_audio = not await fc_send(ctx.bot, chat_id, url, "bestaudio", cap, send_kw)
+        if not need_video and not need_audio:
+            db_inc_dl(u.id)
+            return
+
         m = await update.message.reply_text("⏳ Скачиваю...", **send_kw)
+        t0 = time.monotonic()
         info = await asyncio.to_thread(dl.get_info, url)
         if not info:
             await m.edit_text(tx(u.id, "err_url"), parse_mode="HTML")
             return
 
         if dl.is_photo_post(info):
-            await m.edit_text(tx(u.id, "downloading"))
-            photos = await dl.download_photos(url)
+            try:
+                photos = await fetch(u.id, m, url, "photo", lambda job: dl.download_photos(url, job.cancel))
+            except JobCancelled:
+                await m.edit_text(tx(u.id, "cancelled"))
+                return
             if not photos:
                 await m.edit_text(tx(u.id, "err_url"), parse_mode="HTML")
                 return
-            cap = tx(u.id, "done_cap", bot=BOT_USERNAME)
             try:
                 await m.delete()
             except Exception:
                 pass
-            if len(photos) == 1:
-                with open(photos[0], "rb") as fh:
-                    await ctx.bot.send_photo(update.message.chat_id, fh, caption=cap, **send_kw)
-            else:
-                from telegram import InputMediaPhoto
-                media = []
-                for i, p in enumerate(photos):
-                    with open(p, "rb") as fh:
-                        media.append(InputMediaPhoto(fh, caption=cap if i == 0 else None))
-                await ctx.bot.send_media_group(update.message.chat_id, media, **send_kw)
-            for p in photos:
-                try:
-                    os.remove(p)
-                except Exception:
-                    pass
+            await send_photos(ctx, chat_id, url, photos, cap, send_kw)
             db_inc_dl(u.id)
             return
 
-        fmts = [f for f in info.get("formats", []) if f.get("height")]
-        best_video = max(fmts, key=lambda x: x.get("height", 0), default=None)
-        fmt_id = best_video["format_id"] if best_video else "best"
-        width = info.get("width", 1280)
-        cap = tx(u.id, "done_cap", bot=BOT_USERNAME)
-        chat_id = update.message.chat_id
-
-        await m.edit_text("⬇️ Загружаю видео...")
-        video_file = await dl.download(url, fmt_id)
-
-        await m.edit_text("⬇️ Загружаю аудио...")
-        audio_file = await dl.download(url, "bestaudio")
-
-        await m.edit_text("📤 Отправляю...")
-
-        if video_file:
-            final_video = video_file
-            size_mb = os.path.getsize(final_video) / (1024 * 1024)
-            if size_mb <= 49:
-                try:
-                    with open(final_video, "rb") as fh:
-                        await ctx.bot.send_video(chat_id, fh, caption=cap, supports_streaming=True, **send_kw)
-                except Exception as e:
-                    logger.warning(f"Group video send error: {e}")
-            for p in {video_file, final_video}:
-                try:
-                    if os.path.exists(p): os.remove(p)
-                except Exception:
-                    pass
-
-        if audio_file:
+        # Видео и аудио качаются параллельно из одного info; каждая нога сама
+        # отправляет свой файл (аудио — после видео). Отмена любой ноги отменяет
+        # обе (group), статус у них общий.
+        group = f"grp{chat_id}_{m.message_id}"
+        timing = {"info": time.monotonic() - t0}
+        status = GroupStatus(m)
+        state = {"cancelled": False}
+
+        async def _leg(name: str, fmt: str, after=None):
+            def factory(job):
+                return dl.download(url, fmt, info, cancel=job.cancel)
+            start = time.monotonic()
+            try:
+                path = await fetch(u.id, status.leg(name), url, fmt, factory,
+                                   text_key=f"grp_{name}", group=group)
+            except TooLarge as e:
+                logger.info(f"Group {name} skipped: {e}")
+                return None
+            except JobCancelled:
+                state["cancelled"] = True
+                raise
+            finally:
+                timing[f"{name}_dl"] = time.monotonic() - start
+                await status.done(name)
+            if not path:
+                return None
             try:
-                with open(audio_file, "rb") as fh:
-                    await ctx.bot.send_audio(chat_id, fh, caption=cap, **send_kw)
-            except Exception as e:
-                logger.warning(f"Group audio send error: {e}")
+                if after is not None:
+                    await asyncio.gather(after, return_exceptions=True)
+                if state["cancelled"] or os.path.getsize(path) > TG_LIMIT:
+                    return None
+                start = time.monotonic()
+                with tg_file(path) as fh:
+                    if name == "video":
+                        sent = await ctx.bot.send_video(chat_id, fh, caption=cap, supports_streaming=True, **send_kw)
+                    else:
+                        sent = await ctx.bot.send_audio(chat_id, fh, caption=cap, **send_kw)
+                timing[f"{name}_up"] = time.monotonic() - start
+                await fc_remember(url, fmt, sent)
+                return sent
+            finally:
+                discard(path)
+
+        legs = {}
+        if need_video:
+            legs["video"] = asyncio.create_task(_leg("video", "best"))
+        if need_audio:
+            legs["audio"] = asyncio.create_task(_leg("audio", "bestaudio", legs.get("video")))
+
+        results = await asyncio.gather(*legs.values(), return_exceptions=True)
+        for name, res in zip(legs, results):
+            if isinstance(res, BaseException) and not isinstance(res, JobCancelled):
+                logger.warning(f"Group {name} error: {res!r}")
+        cancelled = state["cancelled"]
+
+        timing["total"] = time.monotonic() - t0
+        logger.info("Group pipeline %s: %s", url,
+                    " ".join(f"{k}={v:.2f}s" for k, v in timing.items()))
+
+        if cancelled:
             try:
-                if os.path.exists(audio_file): os.remove(audio_file)
+                await m.edit_text(tx(u.id, "cancelled"))
             except Exception:
                 pass
+            return
 
         try:
             await m.delete()
@@ -1312,6 +2555,14 @@ async def handle_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         db_inc_dl(u.id)
         return
 
+    user_row = db_get(u.id)
+    auto_dl = bool(user_row and user_row["auto_dl"])
+
+    if auto_dl and await fc_send(ctx.bot, chat_id, url, "best", cap, send_kw):
+        await send_promo(ctx, u.id, chat_id, thread_id)
+        db_inc_dl(u.id)
+        return
+
     m = await update.message.reply_text(tx(u.id, "analyzing"))
     info = await asyncio.to_thread(dl.get_info, url)
 
@@ -1320,53 +2571,46 @@ async def handle_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
 
     if dl.is_photo_post(info):
-        await m.edit_text(tx(u.id, "downloading"))
-        photos = await dl.download_photos(url)
+        try:
+            photos = await fetch(u.id, m, url, "photo", lambda job: dl.download_photos(url, job.cancel))
+        except JobCancelled:
+            await m.edit_text(tx(u.id, "cancelled"))
+            return
         if not photos:
             await m.edit_text(tx(u.id, "err_url"), parse_mode="HTML")
             return
-        cap = tx(u.id, "done_cap", bot=BOT_USERNAME)
-        chat_id = update.message.chat_id
-        send_kw = {"message_thread_id": thread_id} if thread_id else {}
         try:
             await m.delete()
         except Exception:
             pass
-        if len(photos) == 1:
-            with open(photos[0], "rb") as fh:
-                await ctx.bot.send_photo(chat_id, fh, caption=cap, **send_kw)
-        else:
-            from telegram import InputMediaPhoto
-            media = []
-            for i, p in enumerate(photos):
-                with open(p, "rb") as fh:
-                    media.append(InputMediaPhoto(fh, caption=cap if i == 0 else None))
-            await ctx.bot.send_media_group(chat_id, media, **send_kw)
-        for p in photos:
-            try:
-                os.remove(p)
-            except Exception:
-                pass
+        await send_photos(ctx, chat_id, url, photos, cap, send_kw)
         db_inc_dl(u.id)
         return
 
-    user_row = db_get(u.id)
-
-    if user_row and user_row["auto_dl"]:
-        fmts = [f for f in info.get("formats", []) if f.get("height")]
-        best = max(fmts, key=lambda x: x.get("height", 0), default=None)
-        fmt_id = best["format_id"] if best else "best"
+    if auto_dl:
         await m.edit_text(tx(u.id, "downloading"))
-        await do_download(ctx, m, url, fmt_id, info.get("width", 1280), u.id, update.message.chat_id, thread_id)
+        await do_download(ctx, m, url, "best", info.get("width", 1280), u.id, chat_id, thread_id)
         return
 
     formats = []
     seen = set()
+    by_id = {f.get("format_id"): f for f in info.get("formats", [])}
     for f in sorted(info.get("formats", []), key=lambda x: x.get("height", 0) or 0, reverse=True):
         h = f.get("height")
-        if h and h not in seen and h >= 360:
-            formats.append(_btn(f"🎬 {h}p", f"v_{m.message_id}_{f['format_id']}"))
-            seen.add(h)
+        if not h or h in seen or h < 360:
+            continue
+        # Кнопка показывает то, что реально влезет в Telegram
+        try:
+            plan, est = plan_format(info, f["format_id"], TG_LIMIT)
+        except TooLarge:
+            continue
+        pf = by_id.get((plan or "").split("+")[0], f)
+        h = pf.get("height") or h
+        if h in seen or h < 360:
+            continue
+        label = f"🎬 {h}p" + (f" · ~{est / 1048576:.0f} MB" if est else "")
+        formats.append(_btn(label, f"v_{m.message_id}_{pf['format_id']}"))
+        seen.add(h)
         if len(formats) >= 4:
             break
 
@@ -1403,6 +2647,11 @@ async def callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if data == "noop":
         return
 
+    # ── Cancel queued / running download ──
+    if data.startswith("cancel_"):
+        scheduler.cancel(int(data.split("_")[1]), uid)
+        return
+
     # ── Search download ──
     if data.startswith("sdl_"):
         parts = data.split("_")
@@ -1425,7 +2674,7 @@ async def callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
         prem = is_premium(uid)
         limit = PREMIUM_SEARCH_DL_DAY if prem else FREE_SEARCH_DL_DAY
-        used = db_get_search_dl_count(uid)
+        used = await adb.run(db_get_search_dl_count, uid)
 
         if used >= limit:
             key = "search_limit_prem" if prem else "search_limit_free"
@@ -1433,45 +2682,58 @@ async def callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             return
 
         video = results[idx]
+        cap = tx(uid, "done_cap", bot=BOT_USERNAME)
+        send_kw = {}
+        if search_data.get("thread_id"):
+            send_kw["message_thread_id"] = search_data["thread_id"]
+
+        if await fc_send(ctx.bot, chat_id, video["url"], "best", cap, send_kw):
+            db_inc_search_dl(uid)
+            db_inc_dl(uid)
+            return
+
         msg = await ctx.bot.send_message(
             chat_id, tx(uid, "downloading"),
             message_thread_id=search_data.get("thread_id"),
         )
 
-        file = await dl.download(video["url"], "best")
+        try:
+            file = await fetch(uid, msg, video["url"], "best",
+                               lambda job: dl.download(video["url"], "best", cancel=job.cancel))
+        except TooLarge as e:
+            await msg.edit_text(too_big_text(uid, (e.size or 0) / (1024 * 1024)), parse_mode="HTML")
+            return
+        except JobCancelled:
+            await msg.edit_text(tx(uid, "cancelled"))
+            return
         if not file:
             await msg.edit_text(tx(uid, "err_dl", err="not found"), parse_mode="HTML")
             return
 
-        size_mb = os.path.getsize(file) / (1024 * 1024)
-        if size_mb > 49:
-            await msg.edit_text(f"⚠️ Файл {size_mb:.0f} МБ — слишком большой для Telegram.")
-            os.remove(file)
-            return
+        try:
+            size = os.path.getsize(file)
+            if size > TG_LIMIT:
+                await msg.edit_text(too_big_text(uid, size / (1024 * 1024)), parse_mode="HTML")
+                return
 
-        db_inc_search_dl(uid)
-        db_inc_dl(uid)
-        await msg.edit_text(tx(uid, "sending"))
+            db_inc_search_dl(uid)
+            db_inc_dl(uid)
+            await msg.edit_text(tx(uid, "sending"))
 
-        cap = tx(uid, "done_cap", bot=BOT_USERNAME)
-        send_kw = {}
-        if search_data.get("thread_id"):
-            send_kw["message_thread_id"] = search_data["thread_id"]
-        try:
-            with open(file, "rb") as fh:
-                await ctx.bot.send_video(chat_id, fh, caption=cap, supports_streaming=True, **send_kw)
-        except Exception:
-            with open(file, "rb") as fh:
-                await ctx.bot.send_document(chat_id, fh, caption=cap, **send_kw)
+            try:
+                with tg_file(file) as fh:
+                    sent = await ctx.bot.send_video(chat_id, fh, caption=cap, supports_streaming=True, **send_kw)
+            except Exception:
+                with tg_file(file) as fh:
+                    sent = await ctx.bot.send_document(chat_id, fh, caption=cap, **send_kw)
+            await fc_remember(video["url"], "best", sent)
 
-        try:
-            await msg.delete()
-        except Exception:
-            pass
-        try:
-            os.remove(file)
-        except Exception:
-            pass
+            try:
+                await msg.delete()
+            except Exception:
+                pass
+        finally:
+            discard(file)
         return
 
     # ── Video quality pick ──
@@ -1546,7 +2808,7 @@ async def callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     if data == "set_lang":
         new_lang = "en" if get_lang(uid) == "ru" else "ru"
-        db_set(uid, "language", new_lang)
+        await adb.run(db_set, uid, "language", new_lang)
         await q.edit_message_text(
             tx(uid, "settings"), parse_mode="HTML", reply_markup=kb_settings(uid)
         )
@@ -1554,13 +2816,13 @@ async def callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     if data == "set_auto":
         u = db_get(uid)
-        db_set(uid, "auto_dl", 0 if (u and u["auto_dl"]) else 1)
+        await adb.run(db_set, uid, "auto_dl", 0 if (u and u["auto_dl"]) else 1)
         await q.edit_message_reply_markup(reply_markup=kb_settings(uid))
         return
 
     if data == "back_main":
         u_obj = q.from_user
-        db_upsert(u_obj.id, u_obj.username or "", u_obj.first_name or "")
+        await adb_upsert(u_obj.id, u_obj.username or "", u_obj.first_name or "")
         await q.edit_message_text(
             tx(uid, "start", name=u_obj.first_name or "друг"),
             parse_mode="HTML",
@@ -1623,7 +2885,7 @@ async def callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("gpay_trial_"):
         to_uid = int(data.split("_")[2])
-        to_u = db_get(to_uid)
+        to_u = await adb.run(db_get, to_uid)
         to_name = (to_u["username"] or to_u["first_name"] or str(to_uid)) if to_u else str(to_uid)
         await ctx.bot.send_invoice(
             chat_id=uid,
@@ -1641,7 +2903,7 @@ async def callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         stars = calc_price(months)
         lang = get_lang(uid)
         mw = mword(months, lang)
-        to_u = db_get(to_uid)
+        to_u = await adb.run(db_get, to_uid)
         to_name = (to_u["username"] or to_u["first_name"] or str(to_uid)) if to_u else str(to_uid)
         await ctx.bot.send_invoice(
             chat_id=uid,
@@ -1655,7 +2917,7 @@ async def callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("gpay_life_"):
         to_uid = int(data.split("_")[2])
-        to_u = db_get(to_uid)
+        to_u = await adb.run(db_get, to_uid)
         to_name = (to_u["username"] or to_u["first_name"] or str(to_uid)) if to_u else str(to_uid)
         await ctx.bot.send_invoice(
             chat_id=uid,
@@ -1668,12 +2930,17 @@ async def callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
 
     if data == "admin_stats" and uid in ADMIN_IDS:
-        s = db_stats()
         await q.edit_message_text(
-            tx(uid, "stats", **s), parse_mode="HTML", reply_markup=kb_admin(get_lang(uid))
+            await adb.run(stats_text, uid), parse_mode="HTML", reply_markup=kb_admin(get_lang(uid))
         )
         return
 
+    if data.startswith("bcstop_") and uid in ADMIN_IDS:
+        b = _BROADCASTS.get(int(data[7:]))
+        if b:
+            b.stop = True
+        return
+
     if data == "admin_bc" and uid in ADMIN_IDS:
         ctx.user_data["awaiting_broadcast"] = True
         await q.edit_message_text(tx(uid, "bc_ask"), parse_mode="HTML")
@@ -1695,30 +2962,30 @@ async def successful_payment(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     p_type = payload["type"]
     lang = get_lang(uid)
 
-    db_add_stars(uid, stars)
-    db_log_tx(uid, stars, p_type, payload.get("months", 0), payment.invoice_payload)
+    await adb.run(db_add_stars, uid, stars)
+    await adb.run(db_log_tx, uid, stars, p_type, payload.get("months", 0), payment.invoice_payload)
 
     from_name = update.effective_user.first_name or "Аноним"
 
     if p_type == "trial":
-        db_add_premium(uid, TRIAL_DAYS)
-        db_mark_trial(uid)
+        await adb.run(db_add_premium, uid, TRIAL_DAYS)
+        await adb.run(db_mark_trial, uid)
         await update.message.reply_text(tx(uid, "paid_trial"), parse_mode="HTML")
 
     elif p_type == "monthly":
         months = payload["months"]
         mw = mword(months, lang)
-        db_add_premium(uid, months * 30)
+        await adb.run(db_add_premium, uid, months * 30)
         await update.message.reply_text(tx(uid, "paid_month", n=months, mw=mw), parse_mode="HTML")
 
     elif p_type == "lifetime":
-        db_add_premium(uid, -1)
+        await adb.run(db_add_premium, uid, -1)
         await update.message.reply_text(tx(uid, "paid_life"), parse_mode="HTML")
 
     elif p_type == "gift_trial":
         to_uid = payload["to_uid"]
-        db_add_premium(to_uid, TRIAL_DAYS)
-        to_u = db_get(to_uid)
+        await adb.run(db_add_premium, to_uid, TRIAL_DAYS)
+        to_u = await adb.run(db_get, to_uid)
         to_name = (to_u["username"] or to_u["first_name"] or str(to_uid)) if to_u else str(to_uid)
         period = f"7 {'дней' if lang == 'ru' else 'days'}"
         await update.message.reply_text(tx(uid, "gift_ok", to=to_name), parse_mode="HTML")
@@ -1731,8 +2998,8 @@ async def successful_payment(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         to_uid = payload["to_uid"]
         months = payload["months"]
         mw = mword(months, lang)
-        db_add_premium(to_uid, months * 30)
-        to_u = db_get(to_uid)
+        await adb.run(db_add_premium, to_uid, months * 30)
+        to_u = await adb.run(db_get, to_uid)
         to_name = (to_u["username"] or to_u["first_name"] or str(to_uid)) if to_u else str(to_uid)
         await update.message.reply_text(tx(uid, "gift_ok", to=to_name), parse_mode="HTML")
         try:
@@ -1742,8 +3009,8 @@ async def successful_payment(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     elif p_type == "gift_lifetime":
         to_uid = payload["to_uid"]
-        db_add_premium(to_uid, -1)
-        to_u = db_get(to_uid)
+        await adb.run(db_add_premium, to_uid, -1)
+        to_u = await adb.run(db_get, to_uid)
         to_name = (to_u["username"] or to_u["first_name"] or str(to_uid)) if to_u else str(to_uid)
         await update.message.reply_text(tx(uid, "gift_ok", to=to_name), parse_mode="HTML")
         try:
@@ -1776,7 +3043,7 @@ def webapp_start() -> str:
             spec.loader.exec_module(mod)
 
             port = int(os.getenv("WEBAPP_PORT", "80"))
-            mod.cleanup_old_files()
+            mod.setup()
             server = mod.ThreadedHTTPServer(("0.0.0.0", port), mod.Handler)
             _webapp_server = server
 
@@ -1862,14 +3129,66 @@ async def post_init(app: Application):
         BotCommand("help",      "📋 Справка"),
     ])
     logger.info("Commands registered")
+    wb.start()
 
+    # Незавершённые рассылки продолжаются с сохранённого курсора
+    for row in await adb.run(db_bc_running):
+        logger.info(f"Resuming broadcast {row['id']} from user_id>{row['cursor']}")
+        bc_start(app.bot, row)
 
-def main():
-    db_init()
-    os.makedirs(DOWNLOADS_DIR, exist_ok=True)
 
-    app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+async def post_shutdown(app: Application):
+    await wb.stop()
+    logger.info("Write-behind buffer flushed")
+
+
+class UpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов с лимитом UPDATE_CONCURRENCY.
+
+    Кнопка отмены (cancel_*) идёт мимо лимита: иначе, когда все слоты держат
+    ждущие загрузки, отменить их было бы нечем. Лимит PTB поэтому формальный,
+    настоящий — self._slots."""
+
+    def __init__(self, limit: int):
+        super().__init__(1 << 16)
+        self.limit  = limit
+        self._slots = asyncio.Semaphore(limit)
+
+    async def do_process_update(self, update, coroutine):
+        q = update.callback_query if isinstance(update, Update) else None
+        if q is not None and (q.data or "").startswith("cancel_"):
+            await coroutine
+            return
+        async with self._slots:
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def build_app() -> Application:
+    """Application со всеми хэндлерами (без запуска) — для main и benchmarks/loadtest.py."""
+    builder = (
+        Application.builder().token(BOT_TOKEN)
+        .post_init(post_init).post_shutdown(post_shutdown)
+        .concurrent_updates(UpdateProcessor(UPDATE_CONCURRENCY))
+    )
+    if BOT_API_URL:
+        # Свой telegram-bot-api: в local mode файлы передаются путём, до 2000 МБ
+        builder = (
+            builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+            .local_mode(LOCAL_MODE)
+            .read_timeout(BOT_API_TIMEOUT).media_write_timeout(BOT_API_TIMEOUT)
+        )
+        logger.info(f"Bot API: {BOT_API_URL} (local_mode={LOCAL_MODE}, limit {TG_LIMIT >> 20} MB)")
+    app = builder.build()
 
+    # Контекст апдейта: строка users читается один раз, SQL считается
+    app.add_handler(TypeHandler(Update, update_begin), group=-1)
+    app.add_handler(TypeHandler(Update, update_end),   group=99)
     app.add_handler(CommandHandler("start",        cmd_start))
     app.add_handler(CommandHandler("help",         cmd_help))
     app.add_handler(CommandHandler("search",       cmd_search))
@@ -1889,7 +3208,20 @@ def main():
     app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment))
     app.add_handler(CallbackQueryHandler(callback))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return app
+
+
+def main():
+    db_init()
+    reaper.watch(DOWNLOADS_DIR, FILE_MAX_AGE)
+    media_store.scan()
+    if METRICS_PORT:
+        try:
+            serve_metrics(METRICS_PORT, METRICS_HOST)
+        except OSError as e:  # порт занят — бот работает и без экспортёра
+            logger.warning(f"Metrics exporter on {METRICS_HOST}:{METRICS_PORT} failed: {e}")
 
+    app = build_app()
     logger.info("🤖 PuweDownloaderBot started!")
     app.run_polling(drop_pending_updates=True)
 
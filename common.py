@@ -0,0 +1,1721 @@
+#!/usr/bin/env python3
+"""
+PuweDownloader — общие компоненты bot.py и webapp.py
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+ • canonical_url — единый ключ ссылки для всех кэшей
+ • InfoCache     — LRU + TTL кэш метаданных yt-dlp
+                   (в памяти + общий SQLite-уровень для обоих процессов)
+ • download_with_info — скачивание из уже извлечённого info без повторной экстракции
+ • plan_format   — выбор формата под лимит размера канала ДО скачивания
+ • flight        — single-flight: одна загрузка на ссылку+формат на весь процесс
+ • Workspace     — своя папка на задачу, итоговые файлы сообщает yt-dlp (post_hooks)
+ • SearchCache   — кэш результатов поиска (LRU + SQLite, stale-while-revalidate)
+ • Reaper        — удаление файлов по сроку: один поток и min-heap дедлайнов
+ • MediaStore    — бюджет диска под загрузки: LRU-вытеснение и ожидание места
+ • metrics       — счётчики/гистограммы в формате Prometheus (/metrics, serve_metrics)
+ • Database      — SQLite: пул читающих коннектов + один писатель; AsyncDB — то же для asyncio
+"""
+
+import os, copy, shutil, tempfile, time, json, zlib, sqlite3, logging, threading, heapq, urllib.parse
+import asyncio, contextvars, functools
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+log = logging.getLogger("common")
+
+
+# ══════════════════════════════════
+#  CANONICAL URL
+# ══════════════════════════════════
+
+# Трекинг-параметры, которые не меняют контент
+_TRACKING_PARAMS = {
+    "si", "feature", "pp", "igshid", "igsh", "is_from_webapp", "sender_device",
+    "sender_web_id", "_t", "_r", "share_app_id", "share_link_id", "ref", "s",
+}
+
+
+def canonical_url(url: str) -> str:
+    """Приводит ссылку к одному виду: youtu.be, shorts, m., www., utm_* → один ключ."""
+    try:
+        p = urllib.parse.urlsplit(url.strip())
+    except ValueError:
+        return url.strip()
+    host = (p.hostname or "").lower()
+    for pre in ("www.", "m.", "mobile."):
+        if host.startswith(pre):
+            host = host[len(pre):]
+    path = p.path.rstrip("/") or "/"
+    query = urllib.parse.parse_qsl(p.query, keep_blank_values=True)
+
+    if host == "youtu.be":
+        host, query, path = "youtube.com", [("v", path.strip("/"))], "/watch"
+    elif host in ("youtube.com", "music.youtube.com"):
+        host = "youtube.com"
+        if path.startswith(("/shorts/", "/live/", "/embed/")):
+            query, path = [("v", path.split("/")[2])], "/watch"
+        else:
+            query = [(k, v) for k, v in query if k in ("v", "list")]
+    else:
+        query = [(k, v) for k, v in query
+                 if k.lower() not in _TRACKING_PARAMS and not k.lower().startswith("utm_")]
+
+    return urllib.parse.urlunsplit(("https", host, path, urllib.parse.urlencode(sorted(query)), ""))
+
+
+# ══════════════════════════════════
+#  INFO CACHE
+# ══════════════════════════════════
+
+# TTL по экстрактору: подписанные ссылки на потоки живут недолго
+INFO_TTL = {
+    "youtube":   1800,
+    "tiktok":    600,
+    "instagram": 600,
+}
+INFO_TTL_DEFAULT = 3600
+# Запас до истечения подписи (expire=...) — не отдаём почти протухшие ссылки
+EXPIRE_MARGIN = 300
+
+# Тяжёлые поля, которые не нужны ни кнопкам, ни скачиванию
+_HEAVY_KEYS = (
+    "thumbnails", "automatic_captions", "subtitles", "requested_subtitles",
+    "heatmap", "chapters", "description", "tags", "categories", "comments",
+)
+
+
+def slim_info(info: dict) -> dict:
+    """Урезанный, JSON-сериализуемый info dict (как в --write-info-json).
+    entries (плейлист, карусель) sanitize_info выбрасывает — урезаем их отдельно."""
+    import yt_dlp
+    entries = info.get("entries")
+    info = yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True)
+    for k in _HEAVY_KEYS:
+        info.pop(k, None)
+    if entries is not None:
+        info["entries"] = [slim_info(e) for e in entries if e]
+    return info
+
+
+def _stream_expiry(info: dict) -> float | None:
+    """Минимальный expire= из ссылок форматов (googlevideo и т.п.)."""
+    best = None
+    for e in info.get("entries") or []:
+        exp = _stream_expiry(e) if e else None
+        if exp is not None:
+            best = exp if best is None else min(best, exp)
+    for f in info.get("formats") or []:
+        u = f.get("url") or ""
+        if "expire" not in u:
+            continue
+        p = urllib.parse.urlsplit(u)
+        exp = urllib.parse.parse_qs(p.query).get("expire", [None])[0]
+        if exp is None and "/expire/" in p.path:
+            exp = p.path.split("/expire/", 1)[1].split("/", 1)[0]
+        try:
+            exp = float(exp)
+        except (TypeError, ValueError):
+            continue
+        best = exp if best is None else min(best, exp)
+    return best
+
+
+def stream_expired(info: dict, margin: float = 60) -> bool:
+    """Подписанные ссылки на потоки истекли (или вот-вот истекут)."""
+    exp = _stream_expiry(info)
+    return exp is not None and exp - margin < time.time()
+
+
+def info_ttl(info: dict) -> float:
+    extractor = (info.get("extractor_key") or info.get("extractor") or "").lower()
+    ttl = INFO_TTL_DEFAULT
+    for name, t in INFO_TTL.items():
+        if extractor.startswith(name):
+            ttl = t
+            break
+    exp = _stream_expiry(info)
+    if exp:
+        ttl = min(ttl, exp - time.time() - EXPIRE_MARGIN)
+    return ttl
+
+
+class InfoCache:
+    """LRU + TTL кэш extract_info(download=False) по каноническому URL.
+
+    Первый уровень — OrderedDict в памяти процесса, второй (опционально) —
+    таблица info_cache в общей SQLite базе, которую видят и бот, и сайт.
+    Возвращаемые dict'ы общие — не мутировать, копировать при необходимости.
+    """
+
+    def __init__(self, maxsize: int = 256, db_path: str | None = None):
+        self.maxsize  = maxsize
+        self._mem     = OrderedDict()   # key -> (created_at, expires_at, info)
+        self._lock    = threading.Lock()
+        self._db_path = db_path
+        self._db      = None
+        self._db_lock = threading.Lock()
+        self._puts    = 0
+        self._age_sum = 0.0
+        self.counters = {"hit": 0, "db_hit": 0, "miss": 0, "expired": 0, "evicted": 0, "stored": 0}
+
+    # ── SQLite tier ──
+    def _conn(self):
+        if self._db is None:
+            c = sqlite3.connect(self._db_path, check_same_thread=False, timeout=5)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            c.executescript("""
+            CREATE TABLE IF NOT EXISTS info_cache (
+                cache_key  TEXT PRIMARY KEY,
+                extractor  TEXT DEFAULT '',
+                data       BLOB,
+                created_at REAL DEFAULT 0,
+                expires_at REAL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_info_cache_exp ON info_cache(expires_at);
+            """)
+            self._db = c
+        return self._db
+
+    def _db_get(self, key: str):
+        try:
+            with self._db_lock:
+                row = self._conn().execute(
+                    "SELECT data, created_at, expires_at FROM info_cache WHERE cache_key=? AND expires_at>?",
+                    (key, time.time())).fetchone()
+            if not row:
+                return None
+            return row[1], row[2], json.loads(zlib.decompress(row[0]))
+        except Exception as e:
+            log.warning("info cache db read error: %s", e)
+            return None
+
+    def _db_put(self, key: str, created: float, expires: float, info: dict):
+        try:
+            blob = zlib.compress(json.dumps(info, ensure_ascii=False).encode(), 1)
+            with self._db_lock:
+                c = self._conn()
+                c.execute(
+                    "INSERT OR REPLACE INTO info_cache (cache_key,extractor,data,created_at,expires_at) "
+                    "VALUES (?,?,?,?,?)",
+                    (key, info.get("extractor_key", ""), blob, created, expires))
+                if self._puts % 100 == 0:
+                    c.execute("DELETE FROM info_cache WHERE expires_at<?", (time.time(),))
+                c.commit()
+        except Exception as e:
+            log.warning("info cache db write error: %s", e)
+
+    # ── In-process tier ──
+    def _remember(self, key, created, expires, info):
+        with self._lock:
+            self._mem[key] = (created, expires, info)
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.maxsize:
+                self._mem.popitem(last=False)
+                self.counters["evicted"] += 1
+
+    def get(self, url: str) -> dict | None:
+        key = canonical_url(url)
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry and entry[1] > now:
+                self._mem.move_to_end(key)
+                self.counters["hit"] += 1
+                self._age_sum += now - entry[0]
+                return entry[2]
+            if entry:
+                del self._mem[key]
+                self.counters["expired"] += 1
+
+        if self._db_path:
+            entry = self._db_get(key)
+            if entry:
+                self._remember(key, *entry)
+                with self._lock:
+                    self.counters["db_hit"] += 1
+                    self._age_sum += now - entry[0]
+                return entry[2]
+
+        with self._lock:
+            self.counters["miss"] += 1
+        return None
+
+    def put(self, url: str, info: dict) -> dict:
+        """Кладёт урезанный info и возвращает его (им и надо пользоваться дальше)."""
+        info = slim_info(info)
+        ttl = info_ttl(info)
+        if ttl <= 0:
+            return info
+        key = canonical_url(url)
+        created = time.time()
+        self._remember(key, created, created + ttl, info)
+        with self._lock:
+            self.counters["stored"] += 1
+            self._puts += 1
+        if self._db_path:
+            self._db_put(key, created, created + ttl, info)
+        return info
+
+    def drop(self, url: str):
+        key = canonical_url(url)
+        with self._lock:
+            self._mem.pop(key, None)
+        if self._db_path:
+            try:
+                with self._db_lock:
+                    c = self._conn()
+                    c.execute("DELETE FROM info_cache WHERE cache_key=?", (key,))
+                    c.commit()
+            except Exception as e:
+                log.warning("info cache db delete error: %s", e)
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            c = dict(self.counters)
+            ages = [now - e[0] for e in self._mem.values()]
+            hits = c["hit"] + c["db_hit"]
+            total = hits + c["miss"]
+            return dict(
+                size=len(self._mem), maxsize=self.maxsize,
+                hit=c["hit"], db_hit=c["db_hit"], miss=c["miss"],
+                expired=c["expired"], evicted=c["evicted"], stored=c["stored"],
+                hit_rate=(hits / total) if total else 0.0,
+                avg_hit_age=(self._age_sum / hits) if hits else 0.0,
+                oldest_age=max(ages) if ages else 0.0,
+            )
+
+
+# ══════════════════════════════════
+#  DOWNLOAD FROM INFO
+# ══════════════════════════════════
+def download_with_info(opts: dict, url: str, info: dict | None = None) -> bool:
+    """Качает выбранный формат прямо из готового info (путь --load-info-json):
+    без повторного extract_info. Если ссылки протухли или загрузка упала —
+    обычный download([url]) с переэкстракцией. True — хватило готового info."""
+    import yt_dlp
+    if info is not None and not stream_expired(info):
+        try:
+            with yt_dlp.YoutubeDL(opts) as ydl:
+                ydl.process_ie_result(copy.deepcopy(info), download=True)
+            return True
+        except yt_dlp.utils.DownloadCancelled:
+            raise
+        except Exception as e:
+            log.info("download from cached info failed (%s), re-extracting %s", e, url)
+    # no_part: после неудачной попытки на месте мог остаться огрызок — перезаписываем
+    with yt_dlp.YoutubeDL(dict(opts, overwrites=True) if info is not None else opts) as ydl:
+        ydl.download([url])
+    return False
+
+
+# ══════════════════════════════════
+#  FORMAT PLANNER
+# ══════════════════════════════════
+
+# ffmpeg есть — можно склеивать video-only + audio
+CAN_MERGE = shutil.which("ffmpeg") is not None
+
+
+class TooLarge(Exception):
+    """Ни один формат не влезает в лимит канала. size — оценка минимального, байт."""
+
+    def __init__(self, size: int | None, limit: int):
+        super().__init__(f"too large: ~{(size or 0) / 1048576:.0f} MB > {limit / 1048576:.0f} MB")
+        self.size  = size
+        self.limit = limit
+
+
+def estimate_size(f: dict, duration: float | None) -> int | None:
+    """filesize → filesize_approx → tbr × duration."""
+    size = f.get("filesize") or f.get("filesize_approx")
+    if size:
+        return int(size)
+    tbr = f.get("tbr") or ((f.get("vbr") or 0) + (f.get("abr") or 0))
+    if tbr and duration:
+        return int(tbr * 1000 / 8 * duration)
+    return None
+
+
+def estimate_selector(info: dict | None, selector: str) -> int | None:
+    """Оценка размера для селектора из format_id ("137+140"); иначе None."""
+    if not info or not selector:
+        return None
+    by_id = {f.get("format_id"): f for f in info.get("formats") or []}
+    total = 0
+    for fid in selector.split("+"):
+        f = by_id.get(fid)
+        size = estimate_size(f, info.get("duration")) if f else None
+        if size is None:
+            return None
+        total += size
+    return total
+
+
+def _has_video(f):
+    return f.get("vcodec") != "none" and f.get("ext") not in ("mp3", "m4a", "opus", "jpg", "png", "webp")
+
+
+def _has_audio(f):
+    return f.get("acodec") != "none"
+
+
+def _rank(f):
+    # выше, потом mp4 (Telegram стримит), потом битрейт
+    return (f.get("height") or 0, f.get("ext") == "mp4", f.get("tbr") or 0)
+
+
+def plan_format(info: dict, fmt_id: str = "best", limit: int | None = None,
+                audio: bool = False, can_merge: bool = CAN_MERGE):
+    """Подбирает формат, который влезет в limit байт (None — без лимита),
+    с учётом выбранной кнопки качества. Возвращает (селектор, оценка_байт)
+    или (None, None), если в info нет форматов — тогда решает сам yt-dlp.
+    Если ничего не влезает — TooLarge."""
+    formats = [f for f in info.get("formats") or [] if f.get("format_id")]
+    if not formats:
+        return None, None
+    dur = info.get("duration")
+    fits = lambda size: limit is None or (size is not None and size <= limit)
+
+    audios = sorted(
+        (f for f in formats if _has_audio(f) and not _has_video(f)),
+        key=lambda f: (f.get("ext") == "m4a", f.get("abr") or f.get("tbr") or 0), reverse=True)
+
+    if audio:
+        if not audios:
+            return None, None
+        for f in audios:
+            size = estimate_size(f, dur)
+            if fits(size):
+                return f["format_id"], size
+        unknown = [f for f in audios if estimate_size(f, dur) is None]
+        if unknown:
+            return unknown[0]["format_id"], None
+        raise TooLarge(min(estimate_size(f, dur) for f in audios), limit)
+
+    chosen = next((f for f in formats if f["format_id"] == fmt_id), None)
+    max_h = (chosen.get("height") or 0) if chosen else 0
+    max_h = max_h or float("inf")
+
+    # Кандидаты: (селектор, размер, ранг) — прогрессивные и, если есть ffmpeg, склейки
+    cands = []
+    for f in formats:
+        if not _has_video(f) or (f.get("height") or 0) > max_h:
+            continue
+        size = estimate_size(f, dur)
+        if _has_audio(f):
+            cands.append((f["format_id"], size, _rank(f)))
+        elif can_merge and audios:
+            a = audios[0]
+            if limit is not None and size is not None:
+                # лучшее аудио, которое влезает вместе с видео
+                a = next((x for x in audios
+                          if (estimate_size(x, dur) or 0) + size <= limit), audios[-1])
+            a_size = estimate_size(a, dur)
+            total = size + a_size if size is not None and a_size is not None else None
+            cands.append((f"{f['format_id']}+{a['format_id']}", total, _rank(f)))
+
+    if not cands:
+        return None, None
+
+    # Кнопку пользователя уважаем, если она влезает
+    if chosen:
+        for sel, size, _ in cands:
+            if sel.split("+")[0] == fmt_id and fits(size):
+                return sel, size
+
+    cands.sort(key=lambda c: c[2], reverse=True)
+    for sel, size, _ in cands:
+        if fits(size):
+            return sel, size
+    # Размер неизвестен — пусть решает проверка после скачивания
+    for sel, size, _ in cands:
+        if size is None:
+            return sel, None
+    raise TooLarge(min(c[1] for c in cands), limit)
+
+
+# ══════════════════════════════════
+#  SINGLE-FLIGHT
+# ══════════════════════════════════
+class Call:
+    def __init__(self, key: str):
+        self.key     = key
+        self.future  = Future()
+        self.waiters = 1
+
+
+class SingleFlight:
+    """Склеивает одновременные запросы с одним ключом в одну загрузку.
+
+    Первый (лидер) качает, остальные ждут тот же Future и получают тот же
+    файл или ту же ошибку. Файл результата удаляется только после того, как
+    его отпустили все получатели (release)."""
+
+    def __init__(self):
+        self._lock  = threading.Lock()
+        self._calls = {}  # key -> Call
+        self._refs  = {}  # path -> сколько получателей ещё держат файл
+        self.counters = {"leaders": 0, "saved": 0}
+
+    def join(self, key: str):
+        """(Call, leader). Лидер обязан вызвать finish()."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call:
+                call.waiters += 1
+                self.counters["saved"] += 1
+                return call, False
+            call = self._calls[key] = Call(key)
+            self.counters["leaders"] += 1
+            return call, True
+
+    def finish(self, call: Call, result=None, error: BaseException = None):
+        with self._lock:
+            self._calls.pop(call.key, None)
+            # Счётчик держателей — только для путей (str или список путей)
+            paths = result if isinstance(result, list) else [result] if isinstance(result, str) else []
+            if error is None:
+                for p in paths:
+                    self._refs[p] = self._refs.get(p, 0) + call.waiters
+        if error is not None:
+            call.future.set_exception(error)
+        else:
+            call.future.set_result(result)
+
+    def do(self, key: str, fn):
+        """Блокирующий вариант для потоков: (result, shared)."""
+        call, leader = self.join(key)
+        if leader:
+            try:
+                result = fn()
+            except BaseException as e:
+                self.finish(call, error=e)
+                raise
+            self.finish(call, result)
+            return result, False
+        return call.future.result(), True
+
+    def release(self, path: str) -> bool:
+        """Получатель закончил с файлом. True — он последний, можно удалять."""
+        with self._lock:
+            n = self._refs.get(path)
+            if n is None:
+                return True
+            if n <= 1:
+                del self._refs[path]
+                return True
+            self._refs[path] = n - 1
+            return False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counters, inflight=len(self._calls))
+
+
+flight = SingleFlight()
+
+
+# ══════════════════════════════════
+#  JOB WORKSPACE
+# ══════════════════════════════════
+class Workspace:
+    """Уникальная папка под одну задачу загрузки.
+
+    Имена файлов разных задач не пересекаются, итоговые пути приходят из
+    post_hooks yt-dlp (после склейки/постпроцессоров), а не из glob по общей
+    папке. cleanup() удаляет всё разом."""
+
+    def __init__(self, root: str, prefix: str = "job_"):
+        os.makedirs(root, exist_ok=True)
+        self.path  = tempfile.mkdtemp(prefix=prefix, dir=root)
+        self.id    = os.path.basename(self.path)
+        self._files = []
+        self._lock  = threading.Lock()
+
+    def tpl(self, name: str = "%(id)s.%(ext)s") -> str:
+        return os.path.join(self.path, name)
+
+    def post_hook(self, filepath: str):
+        """yt-dlp post_hooks: вызывается с финальным путём каждого файла."""
+        with self._lock:
+            if filepath not in self._files:
+                self._files.append(filepath)
+
+    def hook_opts(self) -> dict:
+        return {"post_hooks": [self.post_hook]}
+
+    def files(self, min_size: int = 1024) -> list:
+        with self._lock:
+            found = [p for p in self._files
+                     if os.path.isfile(p) and os.path.getsize(p) > min_size]
+        if found:
+            return found
+        # Хуки молчат (например, файл уже был) — смотрим только свою папку
+        try:
+            return sorted(
+                os.path.join(self.path, f) for f in os.listdir(self.path)
+                if not f.endswith((".part", ".ytdl"))
+                and os.path.getsize(os.path.join(self.path, f)) > min_size)
+        except OSError:
+            return []
+
+    def reset(self):
+        """Чистит папку перед повторной попыткой (no_part оставляет огрызки)."""
+        with self._lock:
+            self._files.clear()
+        for f in os.listdir(self.path):
+            try:
+                os.remove(os.path.join(self.path, f))
+            except OSError:
+                pass
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def remove_output(path: str):
+    """Удаляет файл результата и его папку задачи, если она опустела."""
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+    except OSError:
+        pass
+    try:
+        os.rmdir(os.path.dirname(path))  # только пустую
+    except OSError:
+        pass
+
+
+# ══════════════════════════════════
+#  REAPER
+# ══════════════════════════════════
+class Reaper:
+    """Удаляет файлы по истечении срока. Один поток на процесс спит до
+    ближайшего дедлайна из min-heap (deadline, seq, path) вместо потока на файл.
+
+    schedule/extend только сдвигают дедлайн вперёд; устаревшие записи кучи
+    отбрасываются лениво при сверке с _due. Пока файл отдаётся (holding),
+    он не удаляется, а после — живёт ещё linger секунд. Папка задачи ждёт,
+    пока занят хоть один файл внутри (holding или guards, напр. пин MediaStore).
+    watch(root, max_age) пересканирует папку по mtime: при старте (файлы,
+    пережившие рестарт) и затем каждые rescan_every секунд (осиротевшие)."""
+
+    def __init__(self, linger: float = 60, rescan_every: float = 600):
+        self.linger       = linger
+        self.rescan_every = rescan_every
+        self._cond   = threading.Condition()
+        self._heap   = []   # (deadline, seq, path)
+        self._due    = {}   # path -> актуальный deadline
+        self._holds  = {}   # path -> сколько отдач сейчас идёт
+        self._roots  = {}   # root -> max_age
+        self._seq    = 0
+        self._thread = None
+        self._next_scan = 0.0
+        self.counters = {"deleted": 0, "errors": 0, "rescans": 0}
+        self.on_delete = []  # callback(path) после удаления (MediaStore.forget)
+        self.guards    = []  # callback(path) → True, если path или что-то внутри занято
+
+    # ── планирование ──
+    def _push(self, path: str, deadline: float):
+        """Под self._cond. Дедлайн только растёт."""
+        if deadline <= self._due.get(path, 0):
+            return
+        self._due[path] = deadline
+        self._seq += 1
+        heapq.heappush(self._heap, (deadline, self._seq, path))
+        if self._heap[0][2] == path:
+            self._cond.notify()
+
+    def schedule(self, path: str, ttl: float):
+        """Удалить path через ttl секунд (или позже, если уже назначено позже)."""
+        with self._cond:
+            self._push(path, time.time() + ttl)
+        self._ensure_thread()
+
+    extend = schedule  # продление — тот же сдвиг дедлайна вперёд
+
+    def cancel(self, path: str):
+        with self._cond:
+            self._due.pop(path, None)
+
+    @contextmanager
+    def holding(self, path: str):
+        """Файл не удаляется, пока внутри блока; потом живёт ещё linger секунд."""
+        with self._cond:
+            self._holds[path] = self._holds.get(path, 0) + 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                n = self._holds.pop(path, 1) - 1
+                if n > 0:
+                    self._holds[path] = n
+                if path in self._due:
+                    self._push(path, time.time() + self.linger)
+
+    # ── папки ──
+    def watch(self, root: str, max_age: float):
+        """Следить за root: всё, что старше max_age по mtime, удаляется."""
+        os.makedirs(root, exist_ok=True)
+        with self._cond:
+            self._roots[root] = max_age
+        self._scan(root, max_age)
+        self._ensure_thread()
+
+    def _scan(self, root: str, max_age: float):
+        try:
+            names = os.listdir(root)
+        except OSError:
+            return
+        with self._cond:
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    continue
+                # Уже запланированное не трогаем: его срок задал владелец
+                if path not in self._due:
+                    self._push(path, mtime + max_age)
+            self.counters["rescans"] += 1
+
+    # ── поток ──
+    def _ensure_thread(self):
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self._next_scan = time.time() + self.rescan_every
+            self._thread = threading.Thread(target=self._run, name="reaper", daemon=True)
+            self._thread.start()
+
+    def _pop_expired(self) -> list:
+        """Под self._cond: пути с наступившим дедлайном; спит до ближайшего."""
+        now = time.time()
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, path = heapq.heappop(self._heap)
+            if self._due.get(path) != deadline:
+                continue  # продлён или отменён — запись устарела
+            if self._busy(path):
+                self._push(path, now + self.linger)
+                continue
+            del self._due[path]
+            expired.append(path)
+        if not expired:
+            wake = min(self._heap[0][0] if self._heap else float("inf"), self._next_scan)
+            self._cond.wait(max(0.05, wake - now))
+        return expired
+
+    def _busy(self, path: str) -> bool:
+        """Под self._cond: path или файл в папке path сейчас занят."""
+        prefix = path.rstrip(os.sep) + os.sep
+        if any(n and (p == path or p.startswith(prefix)) for p, n in self._holds.items()):
+            return True
+        for guard in self.guards:
+            try:
+                if guard(path):
+                    return True
+            except Exception as e:
+                log.warning("Reaper guard: %s", e)
+        return False
+
+    def _run(self):
+        while True:
+            with self._cond:
+                expired = self._pop_expired()
+                rescan = time.time() >= self._next_scan
+                if rescan:
+                    self._next_scan = time.time() + self.rescan_every
+                    roots = list(self._roots.items())
+            for path in expired:
+                self._delete(path)
+            if rescan:
+                for root, max_age in roots:
+                    self._scan(root, max_age)
+
+    def _delete(self, path: str):
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                remove_output(path)
+            else:
+                return
+            self.counters["deleted"] += 1
+            log.info("Reaper: deleted %s", path)
+        except OSError as e:
+            self.counters["errors"] += 1
+            log.warning("Reaper: %s: %s", path, e)
+            return
+        for cb in self.on_delete:
+            try:
+                cb(path)
+            except Exception as e:
+                log.warning("Reaper callback: %s", e)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(self.counters, pending=len(self._due),
+                        held=sum(1 for n in self._holds.values() if n),
+                        roots=len(self._roots))
+
+
+reaper = Reaper()
+
+
+# ══════════════════════════════════
+#  MEDIA STORE
+# ══════════════════════════════════
+class StoreFull(Exception):
+    """Место под загрузку так и не освободилось за отведённое время."""
+
+
+class MediaStore:
+    """Бюджет диска для папки загрузок.
+
+    Перед скачиванием admit(est) резервирует оценку размера; если бюджет
+    (или запас свободного места floor) исчерпан — вытесняет готовые файлы
+    по LRU, а если вытеснять нечего — ждёт, пока место освободится.
+    Закреплённые файлы (pin / holding — отдаются или заливаются) не вытесняются.
+    Удаления Reaper'а приходят через forget()."""
+
+    def __init__(self, root: str, budget: int, floor: int = 0, default_est: int = 100 << 20,
+                 timeout: float = 300, reaper: Reaper | None = None):
+        self.root        = root
+        self.budget      = budget
+        self.floor       = floor
+        self.default_est = default_est
+        self.timeout     = timeout
+        self.reaper      = reaper
+        self._cond     = threading.Condition()
+        self._files    = OrderedDict()  # path -> size, от давно не нужных к свежим
+        self._pins     = {}             # path -> сколько держателей
+        self._reserved = 0
+        self.counters = {"evictions": 0, "evicted_bytes": 0, "admitted": 0,
+                         "admission_waits": 0, "wait_total": 0.0, "wait_max": 0.0, "rejected": 0}
+        if reaper is not None:
+            reaper.on_delete.append(self.forget)
+            reaper.guards.append(self.pinned)
+
+    # ── учёт ──
+    def scan(self):
+        """Подхватывает файлы, оставшиеся с прошлого запуска (старые — первыми на вылет)."""
+        found = []
+        for dirpath, _, names in os.walk(self.root):
+            for n in names:
+                p = os.path.join(dirpath, n)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                found.append((st.st_mtime, p, st.st_size))
+        with self._cond:
+            for _, p, size in sorted(found):
+                self._files.setdefault(p, size)
+
+    def used(self) -> int:
+        with self._cond:
+            return sum(self._files.values()) + self._reserved
+
+    def add(self, path: str, pin: bool = False):
+        """Готовый файл под управлением стора; pin — занят до forget()/unpin()."""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self._cond:
+            self._files[path] = size
+            self._files.move_to_end(path)
+            if pin:
+                self._pins[path] = self._pins.get(path, 0) + 1
+
+    def unpin(self, path: str):
+        with self._cond:
+            n = self._pins.pop(path, 1) - 1
+            if n > 0:
+                self._pins[path] = n
+            self._cond.notify_all()
+
+    def forget(self, path: str):
+        """Файл (или папка задачи) удалён кем-то ещё."""
+        prefix = path.rstrip(os.sep) + os.sep
+        with self._cond:
+            for p in [p for p in self._files if p == path or p.startswith(prefix)]:
+                del self._files[p]
+                self._pins.pop(p, None)
+            self._cond.notify_all()
+
+    def pinned(self, path: str) -> bool:
+        """Закреплён path или файл внутри папки path."""
+        prefix = path.rstrip(os.sep) + os.sep
+        with self._cond:
+            return any(n and (p == path or p.startswith(prefix)) for p, n in self._pins.items())
+
+    def touch(self, path: str):
+        with self._cond:
+            if path in self._files:
+                self._files.move_to_end(path)
+
+    @contextmanager
+    def holding(self, path: str):
+        """Файл отдаётся: не вытесняется и не удаляется Reaper'ом."""
+        self.touch(path)
+        with self._cond:
+            self._pins[path] = self._pins.get(path, 0) + 1
+        try:
+            if self.reaper is not None:
+                with self.reaper.holding(path):
+                    yield
+            else:
+                yield
+        finally:
+            self.unpin(path)
+
+    # ── допуск ──
+    def _free(self) -> int:
+        try:
+            return shutil.disk_usage(self.root).free
+        except OSError:
+            return 1 << 62
+
+    def _fits(self, need: int) -> bool:
+        """Под self._cond."""
+        if sum(self._files.values()) + self._reserved + need > self.budget:
+            return False
+        return not self.floor or self._free() - need >= self.floor
+
+    def _pick_victim(self):
+        """Под self._cond: снимает с учёта самый давний незакреплённый файл → (path, size)."""
+        victim = next((p for p in self._files if not self._pins.get(p)), None)
+        if victim is None:
+            return None
+        size = self._files.pop(victim)
+        self.counters["evictions"] += 1
+        self.counters["evicted_bytes"] += size
+        return victim, size
+
+    def _evict(self, victim: str, size: int):
+        """Без лока: удаление большого файла не держит остальных в admit()/stats()."""
+        remove_output(victim)
+        if self.reaper is not None:
+            self.reaper.cancel(victim)
+        log.info("MediaStore: evicted %s (%.1f MB)", victim, size / 1048576)
+
+    @contextmanager
+    def admit(self, est: int | None = None, cancel: threading.Event | None = None):
+        """Резерв est байт на время загрузки. StoreFull — не дождались места."""
+        need = min(est or self.default_est, self.budget)
+        started = time.monotonic()
+        waited = False
+        while True:
+            with self._cond:
+                if self._fits(need):
+                    self._reserved += need
+                    self.counters["admitted"] += 1
+                    if waited:
+                        w = time.monotonic() - started
+                        self.counters["wait_total"] += w
+                        self.counters["wait_max"] = max(self.counters["wait_max"], w)
+                    break
+                picked = self._pick_victim()
+                if picked is None:
+                    if not waited:
+                        waited = True
+                        self.counters["admission_waits"] += 1
+                    left = self.timeout - (time.monotonic() - started)
+                    if left <= 0 or (cancel is not None and cancel.is_set()):
+                        self.counters["rejected"] += 1
+                        self.counters["wait_total"] += time.monotonic() - started
+                        raise StoreFull("Нет места под загрузку, попробуйте позже")
+                    # Освобождение будит через notify; место на диске могли освободить
+                    # и другие процессы — поэтому ещё и короткий таймаут
+                    self._cond.wait(min(left, 1.0))
+                    continue
+            self._evict(*picked)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._reserved -= need
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            c = dict(self.counters)
+            waits = c.pop("wait_total")
+            return dict(c, budget=self.budget, used=sum(self._files.values()),
+                        reserved=self._reserved, files=len(self._files),
+                        pinned=sum(1 for n in self._pins.values() if n),
+                        free=self._free(), floor=self.floor,
+                        wait_avg=round(waits / c["admission_waits"], 3) if c["admission_waits"] else 0.0,
+                        wait_max=round(c["wait_max"], 3))
+
+
+# ══════════════════════════════════
+#  SEARCH CACHE
+# ══════════════════════════════════
+SEARCH_FRESH = 600        # моложе — отдаём как есть
+SEARCH_STALE = 6 * 3600   # моложе — отдаём сразу и обновляем в фоне; старше — промах
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.casefold().split())
+
+
+def _fmt_duration(d) -> str:
+    if not d:
+        return ""
+    m, s = divmod(int(d), 60)
+    h, m = divmod(m, 60)
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
+
+
+def _fmt_views(v) -> str:
+    v = v or 0
+    if v >= 1_000_000:
+        return f"{v / 1_000_000:.1f}M 👁"
+    if v >= 1_000:
+        return f"{v // 1_000}K 👁"
+    return f"{v} 👁" if v else ""
+
+
+def compact_entry(e: dict, platform: str) -> dict | None:
+    """Плоская запись из extract_flat → то, что показывают бот и сайт."""
+    url = e.get("url") or e.get("webpage_url")
+    if not url:
+        eid = e.get("id")
+        if platform == "yt" and eid:
+            url = f"https://www.youtube.com/watch?v={eid}"
+        elif eid:
+            url = f"https://www.tiktok.com/@{e.get('uploader', 'user')}/video/{eid}"
+    if not url:
+        return None
+    thumb = e.get("thumbnail")
+    if not thumb and e.get("thumbnails"):
+        thumb = e["thumbnails"][-1].get("url")
+    return {"title": (e.get("title") or "Unknown")[:80], "url": url, "thumbnail": thumb,
+            "duration": _fmt_duration(e.get("duration")), "views": _fmt_views(e.get("view_count"))}
+
+
+def run_search(platform: str, query: str, n: int) -> list:
+    """Поиск через yt-dlp (extract_flat). Ошибки пробрасывает."""
+    import yt_dlp
+    search_url = f"ytsearch{n}:{query}" if platform == "yt" else f"tiktoksearch{n}:{query}"
+    opts = {"quiet": True, "no_warnings": True, "extract_flat": True,
+            "skip_download": True, "check_formats": False}
+    with SEARCH_SECONDS.time(platform=platform, source="full"), yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(search_url, download=False)
+    out = []
+    for e in (info or {}).get("entries") or []:
+        item = compact_entry(e, platform) if e else None
+        if item:
+            out.append(item)
+    return out[:n]
+
+
+def iter_search(platform: str, query: str, n: int):
+    """Ленивый поиск: (ydl, генератор компактных записей). Страницы
+    выдачи запрашиваются по мере чтения; ydl закрыть, когда генератор не нужен."""
+    import yt_dlp
+    search_url = f"ytsearch{n}:{query}" if platform == "yt" else f"tiktoksearch{n}:{query}"
+    ydl = yt_dlp.YoutubeDL({"quiet": True, "no_warnings": True, "extract_flat": True,
+                            "skip_download": True, "check_formats": False})
+    try:
+        info = ydl.extract_info(search_url, download=False, process=False) or {}
+    except Exception:
+        ydl.close()
+        raise
+
+    def gen():
+        for e in info.get("entries") or []:
+            item = compact_entry(e, platform) if e else None
+            if item:
+                yield item
+    return ydl, gen()
+
+
+class SearchCache:
+    """Кэш результатов поиска по нормализованному запросу.
+
+    Свежие записи отдаются как есть, устаревшие (до stale) — тоже сразу,
+    но в фоне запускается обновление (stale-while-revalidate). Запись на
+    больше результатов обслуживает и запросы на меньше: бот (5) читает то,
+    что нашёл сайт (100). Списки общие — не мутировать."""
+
+    def __init__(self, maxsize: int = 512, db_path: str | None = None,
+                 fresh: float = SEARCH_FRESH, stale: float = SEARCH_STALE, fetch=run_search):
+        self.maxsize  = maxsize
+        self.fresh    = fresh
+        self.stale    = stale
+        self.fetch    = fetch
+        self._mem     = OrderedDict()  # key -> (created_at, n, results)
+        self._lock    = threading.Lock()
+        self._db_path = db_path
+        self._db      = None
+        self._db_lock = threading.Lock()
+        self._puts    = 0
+        self._refreshing = set()
+        self.counters = {"hit": 0, "stale": 0, "miss": 0, "refreshes": 0, "refresh_errors": 0,
+                         "refresh_sum": 0.0, "refresh_max": 0.0, "fetches": 0, "fetch_sum": 0.0}
+
+    @staticmethod
+    def key(platform: str, query: str) -> str:
+        return f"{platform}|{normalize_query(query)}"
+
+    # ── SQLite tier ──
+    def _conn(self):
+        if self._db is None:
+            c = sqlite3.connect(self._db_path, check_same_thread=False, timeout=5)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            c.executescript("""
+            CREATE TABLE IF NOT EXISTS search_cache (
+                cache_key  TEXT PRIMARY KEY,
+                n          INTEGER DEFAULT 0,
+                data       BLOB,
+                created_at REAL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_search_cache_created ON search_cache(created_at);
+            """)
+            self._db = c
+        return self._db
+
+    def _db_get(self, key: str):
+        try:
+            with self._db_lock:
+                row = self._conn().execute(
+                    "SELECT created_at, n, data FROM search_cache WHERE cache_key=? AND created_at>?",
+                    (key, time.time() - self.stale)).fetchone()
+            if not row:
+                return None
+            return row[0], row[1], json.loads(zlib.decompress(row[2]))
+        except Exception as e:
+            log.warning("search cache db read error: %s", e)
+            return None
+
+    def _db_put(self, key: str, created: float, n: int, results: list):
+        try:
+            blob = zlib.compress(json.dumps(results, ensure_ascii=False).encode(), 1)
+            with self._db_lock:
+                c = self._conn()
+                c.execute("INSERT OR REPLACE INTO search_cache (cache_key,n,data,created_at) VALUES (?,?,?,?)",
+                          (key, n, blob, created))
+                if self._puts % 100 == 0:
+                    c.execute("DELETE FROM search_cache WHERE created_at<?", (time.time() - self.stale,))
+                c.commit()
+        except Exception as e:
+            log.warning("search cache db write error: %s", e)
+
+    # ── In-process tier ──
+    def _get(self, key: str):
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry and time.time() - entry[0] < self.stale:
+                self._mem.move_to_end(key)
+                return entry
+            if entry:
+                del self._mem[key]
+        if self._db_path:
+            entry = self._db_get(key)
+            if entry:
+                self._remember(key, entry)
+                return entry
+        return None
+
+    def _remember(self, key: str, entry: tuple):
+        with self._lock:
+            self._mem[key] = entry
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.maxsize:
+                self._mem.popitem(last=False)
+
+    def _store(self, key: str, n: int, results: list):
+        if not results:
+            return  # пустой ответ чаще всего ошибка/бан — не кэшируем
+        entry = (time.time(), n, results)
+        self._remember(key, entry)
+        with self._lock:
+            self._puts += 1
+        if self._db_path:
+            self._db_put(key, *entry)
+
+    def _refresh(self, key: str, platform: str, query: str, n: int):
+        t = time.monotonic()
+        try:
+            self._store(key, n, self.fetch(platform, query, n))
+            ok = True
+        except Exception as e:
+            log.info("search refresh failed for %r: %s", key, e)
+            ok = False
+        dt = time.monotonic() - t
+        with self._lock:
+            self._refreshing.discard(key)
+            c = self.counters
+            if ok:
+                c["refreshes"] += 1
+                c["refresh_sum"] += dt
+                c["refresh_max"] = max(c["refresh_max"], dt)
+            else:
+                c["refresh_errors"] += 1
+
+    def get(self, platform: str, query: str, n: int) -> list | None:
+        """Из кэша (свежее или устаревшее с фоновым обновлением) или None."""
+        key = self.key(platform, query)
+        entry = self._get(key)
+        if not entry or entry[1] < n:
+            with self._lock:
+                self.counters["miss"] += 1
+            return None
+        created, stored_n, results = entry
+        if time.time() - created < self.fresh:
+            with self._lock:
+                self.counters["hit"] += 1
+            return results
+        with self._lock:
+            self.counters["stale"] += 1
+            start = key not in self._refreshing
+            self._refreshing.add(key)
+        if start:
+            threading.Thread(target=self._refresh, args=(key, platform, query, stored_n),
+                             daemon=True).start()
+        return results
+
+    def put(self, platform: str, query: str, n: int, results: list):
+        """Результаты, найденные в обход lookup (например, постраничным поиском)."""
+        self._store(self.key(platform, query), n, results)
+
+    def lookup(self, platform: str, query: str, n: int) -> list:
+        """Результаты поиска (не больше n); при ошибке поиска — []."""
+        cached = self.get(platform, query, n)
+        if cached is not None:
+            return cached[:n]
+        key = self.key(platform, query)
+        t = time.monotonic()
+        try:
+            results = self.fetch(platform, query, n)
+        except Exception as e:
+            log.warning("Search error (%s): %s", platform, e)
+            return []
+        with self._lock:
+            self.counters["fetches"] += 1
+            self.counters["fetch_sum"] += time.monotonic() - t
+        self._store(key, n, results)
+        return results
+
+    def stats(self) -> dict:
+        with self._lock:
+            c = dict(self.counters)
+            size, refreshing = len(self._mem), len(self._refreshing)
+        total = c["hit"] + c["stale"] + c["miss"]
+        return dict(
+            size=size, maxsize=self.maxsize, hit=c["hit"], stale=c["stale"], miss=c["miss"],
+            hit_rate=(c["hit"] + c["stale"]) / total if total else 0.0,
+            refreshes=c["refreshes"], refresh_errors=c["refresh_errors"], refreshing=refreshing,
+            refresh_avg=c["refresh_sum"] / c["refreshes"] if c["refreshes"] else 0.0,
+            refresh_max=c["refresh_max"],
+            fetch_avg=c["fetch_sum"] / c["fetches"] if c["fetches"] else 0.0,
+        )
+
+
+# ══════════════════════════════════
+#  METRICS  (текстовый формат Prometheus, без зависимостей)
+# ══════════════════════════════════
+def _label_str(names, values) -> str:
+    if not names:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{n}="{esc(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def _num(v) -> str:
+    """Число без потери точности (байты бывают > 2^31)."""
+    if isinstance(v, float) and not v.is_integer():
+        return repr(v)
+    return str(int(v))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, doc: str, labels=()):
+        self.name   = name
+        self.doc    = doc
+        self.labels = tuple(labels)
+        self._lock  = threading.Lock()
+        self._values = {}  # tuple(label values) -> значение
+
+    def _key(self, kw) -> tuple:
+        return tuple(kw.get(n, "") for n in self.labels)
+
+    def samples(self) -> dict:
+        """{tuple(значения меток): значение} — копия для отчётов."""
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> list:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_label_str(self.labels, k)} {_num(v)}" for k, v in items]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, n: float = 1, **labels):
+        k = self._key(labels)
+        with self._lock:
+            self._values[k] = self._values.get(k, 0) + n
+
+
+class Gauge(_Metric):
+    """set/inc/dec или fn() → число либо {tuple(labels): число} при каждом сборе.
+    fn несколько — по одной на источник (бот и сайт в одном процессе), ряды сливаются."""
+    kind = "gauge"
+
+    def __init__(self, name, doc, labels=()):
+        super().__init__(name, doc, labels)
+        self.fns = {}  # source -> fn
+
+    def add_fn(self, fn, source: str = ""):
+        """Повторная регистрация того же source (перезапуск сайта) заменяет fn."""
+        with self._lock:
+            self.fns[source] = fn
+
+    def set(self, v: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = v
+
+    def inc(self, n: float = 1, **labels):
+        k = self._key(labels)
+        with self._lock:
+            self._values[k] = self._values.get(k, 0) + n
+
+    def dec(self, n: float = 1, **labels):
+        self.inc(-n, **labels)
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self) -> list:
+        with self._lock:
+            fns = list(self.fns.values())
+        if fns:
+            values = {}
+            for fn in fns:
+                try:
+                    v = fn()
+                except Exception as e:
+                    log.warning("Gauge %s: %s", self.name, e)
+                    continue
+                values.update(v if isinstance(v, dict) else {(): v})
+            with self._lock:
+                self._values = values
+        return super().render()
+
+
+# Секунды: от запроса к SQLite до многоминутной загрузки
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, v: float, **labels):
+        k = self._key(labels)
+        with self._lock:
+            st = self._values.get(k)
+            if st is None:
+                st = self._values[k] = [[0] * len(self.buckets), 0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if v <= b:
+                    st[0][i] += 1
+                    break
+            st[1] += v
+            st[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t, **labels)
+
+    def quantile(self, q: float, **labels) -> float | None:
+        """Оценка квантиля по бакетам (верхняя граница бакета), как histogram_quantile."""
+        with self._lock:
+            st = self._values.get(self._key(labels))
+            if not st or not st[2]:
+                return None
+            counts, n = list(st[0]), st[2]
+        acc = 0
+        for b, c in zip(self.buckets, counts):
+            acc += c
+            if acc >= q * n:
+                return b
+        return float("inf")
+
+    def summary(self, **labels) -> dict:
+        with self._lock:
+            st = self._values.get(self._key(labels))
+            return {"count": st[2], "sum": st[1]} if st else {"count": 0, "sum": 0.0}
+
+    def render(self) -> list:
+        with self._lock:
+            items = sorted((k, (list(c), s, n)) for k, (c, s, n) in self._values.items())
+        names = self.labels + ("le",)
+        out = []
+        for k, (counts, total, n) in items:
+            acc = 0
+            for b, c in zip(self.buckets, counts):
+                acc += c
+                out.append(f"{self.name}_bucket{_label_str(names, k + (f'{b:g}',))} {acc}")
+            out.append(f"{self.name}_bucket{_label_str(names, k + ('+Inf',))} {n}")
+            out.append(f"{self.name}_sum{_label_str(self.labels, k)} {_num(total)}")
+            out.append(f"{self.name}_count{_label_str(self.labels, k)} {n}")
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _add(self, m: _Metric) -> _Metric:
+        """Одно имя — одна метрика: повтор с тем же типом и метками отдаёт
+        существующую (модуль перезагружен), иначе ValueError."""
+        with self._lock:
+            old = self._metrics.setdefault(m.name, m)
+        if old is not m and (old.kind != m.kind or old.labels != m.labels):
+            raise ValueError(f"metric {m.name} already registered as {old.kind}{list(old.labels)}")
+        return old
+
+    def counter(self, name, doc, labels=()) -> Counter:
+        return self._add(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=(), fn=None, source: str = "") -> Gauge:
+        g = self._add(Gauge(name, doc, labels))
+        if fn is not None:
+            g.add_fn(fn, source)
+        return g
+
+    def histogram(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, doc, labels, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            ms = list(self._metrics.values())
+        lines = []
+        for m in ms:
+            lines += [f"# HELP {m.name} {m.doc}", f"# TYPE {m.name} {m.kind}", *m.render()]
+        return "\n".join(lines) + "\n"
+
+
+metrics = Registry()
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Общие для бота и сайта метрики конвейера
+GET_INFO_SECONDS = metrics.histogram(
+    "puwe_get_info_seconds", "Метаданные ссылки (cached=1 — из кэша)", ["cached"])
+SEARCH_SECONDS   = metrics.histogram(
+    "puwe_search_seconds", "Запрос поиска к yt-dlp", ["platform", "source"])
+DOWNLOAD_SECONDS = metrics.histogram(
+    "puwe_download_seconds", "Загрузка yt-dlp от старта до готового файла", ["platform", "mode"])
+DOWNLOADS_TOTAL  = metrics.counter(
+    "puwe_downloads_total", "Загрузки по платформе и исходу", ["platform", "mode", "outcome"])
+DOWNLOAD_BYTES   = metrics.counter(
+    "puwe_download_bytes_total", "Скачано yt-dlp, байт", ["platform", "mode"])
+DB_LOCK_WAIT     = metrics.histogram(
+    "puwe_db_lock_wait_seconds", "Ожидание пишущего коннекта SQLite", ["proc"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+
+_PLATFORMS = {"youtube.com": "youtube", "youtu.be": "youtube", "tiktok.com": "tiktok",
+              "instagram.com": "instagram", "twitter.com": "twitter", "x.com": "twitter",
+              "facebook.com": "facebook", "fb.watch": "facebook", "vk.com": "vk",
+              "reddit.com": "reddit", "soundcloud.com": "soundcloud"}
+
+
+def platform_of(url: str) -> str:
+    """Метка платформы по хосту ссылки (ограниченный набор — кардинальность метрик)."""
+    try:
+        host = (urllib.parse.urlsplit(url.strip()).hostname or "").lower()
+    except ValueError:
+        return "other"
+    parts = host.split(".")
+    for i in range(len(parts) - 1):
+        p = _PLATFORMS.get(".".join(parts[i:]))
+        if p:
+            return p
+    return "other"
+
+
+class TimedLock:
+    """threading.Lock, который пишет время ожидания захвата в DB_LOCK_WAIT."""
+
+    def __init__(self, proc: str):
+        self._lock = threading.Lock()
+        self.proc  = proc
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if self._lock.acquire(False):
+            DB_LOCK_WAIT.observe(0.0, proc=self.proc)
+            return True
+        t = time.perf_counter()
+        ok = self._lock.acquire(blocking, timeout)
+        DB_LOCK_WAIT.observe(time.perf_counter() - t, proc=self.proc)
+        return ok
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+def store_metrics(store: "MediaStore", proc: str):
+    """Гейджи диска загрузок и счётчики MediaStore."""
+    metrics.gauge("puwe_media_bytes", "Диск загрузок: used/reserved/budget/free", ["proc", "kind"],
+                  fn=lambda: {(proc, k): v for k, v in store.stats().items()
+                              if k in ("used", "reserved", "budget", "free")}, source=proc)
+    metrics.gauge("puwe_media_events", "MediaStore: вытеснения, ожидания места, отказы", ["proc", "event"],
+                  fn=lambda: {(proc, k): v for k, v in store.stats().items()
+                              if k in ("evictions", "evicted_bytes", "admission_waits", "rejected")},
+                  source=proc)
+
+
+def serve_metrics(port: int, host: str = "127.0.0.1", registry: Registry = metrics):
+    """Отдельный HTTP-экспортёр GET /metrics в фоновом потоке (для bot.py)."""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class _Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404); return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+            self.send_header("Content-Length", len(body))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info("Metrics on http://%s:%d/metrics", host, server.server_port)
+    return server
+
+
+# ══════════════════════════════════
+#  DATABASE  (WAL: пул читателей + один писатель)
+# ══════════════════════════════════
+DB_POOL_WAIT     = metrics.histogram(
+    "puwe_db_pool_wait_seconds", "Ожидание свободного читающего коннекта", ["proc"],
+    buckets=DB_LOCK_WAIT.buckets)
+DB_QUERY_SECONDS = metrics.histogram(
+    "puwe_db_query_seconds", "Время работы с коннектом SQLite (без ожидания)", ["proc", "kind"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+
+
+class Database:
+    """SQLite в WAL: до `readers` читающих коннектов (query_only) и один пишущий
+    под TimedLock. Читатели не ждут писателя и друг друга — это и даёт WAL.
+
+    with db.read() as c:  ...          — SELECT без общего лока
+    with db.write() as c: ...          — транзакция: commit на выходе, rollback на ошибке
+
+    Вложенные read()/write() в том же потоке получают тот же коннект
+    (read() внутри write() видит ещё не закоммиченное). Скомпилированные
+    запросы sqlite3 кэширует на коннекте (cached_statements), поэтому текст
+    SQL держим постоянным, а значения — только через параметры."""
+
+    def __init__(self, path: str, proc: str, readers: int = 4, statements: int = 256,
+                 timeout: float = 10.0, trace=None):
+        self.path       = path
+        self.proc       = proc
+        self.readers    = max(1, readers)
+        self.statements = statements
+        self.timeout    = timeout
+        self.trace      = trace
+        self.lock       = TimedLock(proc)  # ожидание → puwe_db_lock_wait_seconds
+        self._writer    = None
+        self._idle      = []  # свободные читатели, LIFO — тёплый кэш страниц
+        self._opened    = 0
+        self._cond      = threading.Condition()
+        self._local     = threading.local()
+        self.counters   = {"reads": 0, "writes": 0, "pool_waits": 0, "rollbacks": 0}
+
+    def _open(self, reader: bool) -> sqlite3.Connection:
+        c = sqlite3.connect(self.path, check_same_thread=False, timeout=self.timeout,
+                            cached_statements=self.statements)
+        c.row_factory = sqlite3.Row
+        if not reader:
+            c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        c.execute("PRAGMA cache_size=10000")
+        if reader:
+            c.execute("PRAGMA query_only=1")
+        if self.trace:
+            c.set_trace_callback(self.trace)
+        return c
+
+    def _writer_conn(self) -> sqlite3.Connection:
+        if self._writer is None:
+            self._writer = self._open(reader=False)  # создаёт файл и включает WAL
+        return self._writer
+
+    def _checkout(self) -> sqlite3.Connection:
+        with self._cond:
+            if self._idle:
+                return self._idle.pop()
+            if self._opened < self.readers:
+                self._opened += 1
+                new = True
+            else:
+                new = False
+                self.counters["pool_waits"] += 1
+                t = time.perf_counter()
+                while not self._idle:
+                    self._cond.wait()
+                DB_POOL_WAIT.observe(time.perf_counter() - t, proc=self.proc)
+                return self._idle.pop()
+        if new:
+            try:
+                if self._writer is None:
+                    with self.lock:
+                        self._writer_conn()
+                return self._open(reader=True)
+            except Exception:
+                with self._cond:
+                    self._opened -= 1
+                    self._cond.notify()
+                raise
+
+    def _checkin(self, c: sqlite3.Connection):
+        with self._cond:
+            self._idle.append(c)
+            self.counters["reads"] += 1
+            self._cond.notify()
+
+    @contextmanager
+    def read(self):
+        cur = getattr(self._local, "conn", None)
+        if cur is not None:
+            yield cur
+            return
+        c = self._checkout()
+        self._local.conn = c
+        t = time.perf_counter()
+        try:
+            yield c
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - t, proc=self.proc, kind="read")
+            self._local.conn = None
+            self._checkin(c)
+
+    @contextmanager
+    def write(self):
+        if getattr(self._local, "writing", False):
+            yield self._writer
+            return
+        with self.lock:
+            c = self._writer_conn()
+            outer, self._local.conn, self._local.writing = getattr(self._local, "conn", None), c, True
+            t = time.perf_counter()
+            try:
+                yield c
+                c.commit()
+            except BaseException:
+                c.rollback()
+                self.counters["rollbacks"] += 1
+                raise
+            finally:
+                DB_QUERY_SECONDS.observe(time.perf_counter() - t, proc=self.proc, kind="write")
+                self._local.conn, self._local.writing = outer, False
+                self.counters["writes"] += 1
+
+    # ── короткие формы для одиночных запросов ──
+    def one(self, sql: str, params=()):
+        with self.read() as c:
+            return c.execute(sql, params).fetchone()
+
+    def all(self, sql: str, params=()) -> list:
+        with self.read() as c:
+            return c.execute(sql, params).fetchall()
+
+    def execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        with self.write() as c:
+            return c.execute(sql, params)
+
+    def close(self):
+        with self.lock, self._cond:
+            for c in self._idle:
+                c.close()
+            self._opened -= len(self._idle)
+            self._idle.clear()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    def stats(self) -> dict:
+        with self._cond:
+            busy = self._opened - len(self._idle)
+            out = dict(self.counters, readers=self._opened, readers_busy=busy, readers_max=self.readers)
+        lw = DB_LOCK_WAIT.summary(proc=self.proc)
+        out["lock_wait_ms"] = lw["sum"] * 1000
+        out["lock_wait_p99_ms"] = (DB_LOCK_WAIT.quantile(.99, proc=self.proc) or 0) * 1000
+        for kind in ("read", "write"):
+            q = DB_QUERY_SECONDS.summary(proc=self.proc, kind=kind)
+            out[f"{kind}_avg_ms"] = q["sum"] / q["count"] * 1000 if q["count"] else 0.0
+            out[f"{kind}_p99_ms"] = (DB_QUERY_SECONDS.quantile(.99, proc=self.proc, kind=kind) or 0) * 1000
+        return out
+
+
+class AsyncDB:
+    """Фасад для asyncio: синхронные функции БД уходят в свой пул потоков,
+    event loop не ждёт SQLite. Пул отдельный от asyncio.to_thread — запросы
+    не стоят в очереди за yt-dlp. ContextVar'ы вызывающего видны в функции."""
+
+    def __init__(self, db: Database, workers: int | None = None):
+        self.db    = db
+        self._pool = ThreadPoolExecutor(max_workers=workers or db.readers + 1,
+                                        thread_name_prefix=f"db-{db.proc}")
+
+    async def run(self, fn, *args, **kwargs):
+        ctx = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._pool, functools.partial(ctx.run, fn, *args, **kwargs))
+
+    async def one(self, sql: str, params=()):
+        return await self.run(self.db.one, sql, params)
+
+    async def all(self, sql: str, params=()) -> list:
+        return await self.run(self.db.all, sql, params)
+
+    async def execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        return await self.run(self.db.execute, sql, params)
+
+
+def db_metrics(db: Database):
+    """Гейдж занятости пула читателей."""
+    def readers():
+        with db._cond:
+            return {(db.proc, "open"): db._opened, (db.proc, "busy"): db._opened - len(db._idle),
+                    (db.proc, "max"): db.readers}
+    metrics.gauge("puwe_db_readers", "Читающие коннекты SQLite: open/busy/max", ["proc", "state"],
+                  fn=readers, source=db.proc)
@@ -6,19 +6,34 @@ Endpoints:
   POST /api/auth/telegram   — авторизация через Telegram initData
   GET  /api/auth/me         — проверка токена
   POST /api/info            — получить инфо о видео
-  POST /api/download        — скачать и отдать ссылку
-  POST /api/search          — поиск YouTube/TikTok
+  POST /api/download        — скачать и отдать ссылку (ждёт задачу)
+  POST /api/jobs            — поставить загрузку в очередь → job_id
+  GET  /api/jobs/<id>       — состояние задачи (long-poll: ?wait=<version>)
+  GET  /api/jobs/<id>/events — прогресс задачи (Server-Sent Events, ?token=)
+  GET  /api/jobs/<id>/result — ссылка на файл готовой задачи
+  POST /api/search          — поиск YouTube/TikTok (постранично, cursor)
   POST /api/search-download — скачать из поиска
   GET  /api/limits          — лимиты пользователя
+  GET  /api/cache-stats     — статистика кэшей метаданных и поиска
   DELETE /api/delete/<id>   — удалить файл с сервера
-  GET  /api/file/<n>        — скачать файл (стриминг)
+  GET  /api/file/<id>/<n>   — скачать файл (стриминг)
+  GET  /api/stream          — скачать сразу в ответ (yt-dlp → pipe → chunked), ?url=&format_id=&mode=&token=
+  GET  /metrics             — метрики Prometheus (METRICS_TOKEN — Bearer/?token=)
   GET  /                    — miniapp.html
 """
 
-import os, hashlib, hmac, time, json, uuid, glob, logging, threading, sqlite3, mimetypes
+import os, sys, hashlib, hmac, time, json, logging, threading, sqlite3, mimetypes, secrets, gzip
+import re, select, signal, subprocess, tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse, parse_qsl
+from urllib.parse import urlparse, parse_qsl, quote
 from pathlib import Path
+from email.utils import formatdate
+try:
+    import brotli  # необязательно: без него отдаём только gzip
+except ImportError:
+    brotli = None
 from datetime import date
 from dotenv import load_dotenv
 
@@ -31,79 +46,92 @@ BASE_DIR       = Path(__file__).parent
 BOT_TOKEN      = os.getenv("BOT_TOKEN", "")
 BOT_DB         = str(BASE_DIR / "bot.db")
 DOWNLOADS_DIR  = str(BASE_DIR / "webapp_dl")
-SECRET_SALT    = "puwe_webapp_v1"
+# Ключ подписи сессионных токенов; без WEBAPP_SECRET выводится из BOT_TOKEN
+WEBAPP_SECRET  = os.getenv("WEBAPP_SECRET", "")
+TOKEN_TTL      = 3 * 86400
+TOKEN_CACHE_SIZE = 4096
 PORT           = int(os.getenv("WEBAPP_PORT", "80"))
 FREE_DL_DAY    = 3
 PREMIUM_DL_DAY = 12
 FILE_TTL_SEC   = 120
-# Размер чанка при стриминге файла клиенту (2 МБ)
-STREAM_CHUNK   = 2 * 1024 * 1024
+FILE_MAX_AGE   = 3600  # всё в DOWNLOADS_DIR старше — сирота (пережило рестарт)
+# Бюджет диска под webapp_dl: сверх него — LRU-вытеснение готовых файлов и ожидание
+MEDIA_BUDGET     = int(os.getenv("WEBAPP_MEDIA_BUDGET_MB", "2048")) << 20
+MEDIA_FREE_FLOOR = int(os.getenv("MEDIA_FREE_FLOOR_MB", "0")) << 20  # 0 — только бюджет
+MEDIA_ADMIT_WAIT = float(os.getenv("MEDIA_ADMIT_WAIT", "120"))
+INFO_CACHE_SIZE   = int(os.getenv("INFO_CACHE_SIZE", "256"))
+INFO_CACHE_SHARED = os.getenv("INFO_CACHE_SHARED", "1") == "1"  # общий с ботом через bot.db
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "512"))
+SEARCH_PAGE     = 10    # результатов на страницу
+SEARCH_MAX      = 100   # глубже не листаем
+SEARCH_SESSIONS = 256   # открытых постраничных поисков
+SEARCH_SESSION_TTL = 600
+# Фоновые загрузки: пул воркеров отдельно от HTTP-потоков
+JOB_WORKERS    = int(os.getenv("WEBAPP_JOB_WORKERS", "3"))
+JOBS_PER_USER  = 3     # одновременно в очереди/в работе
+JOB_KEEP_SEC   = 600   # сколько помним завершённую задачу
+# Потоковая отдача: yt-dlp пишет в pipe, ответ идёт клиенту по мере скачивания
+STREAM_MAX     = int(os.getenv("WEBAPP_STREAMS", "8"))  # одновременных потоков yt-dlp
+STREAM_CHUNK   = 64 * 1024
+STREAM_IDLE    = 60    # столько секунд без данных — поток обрывается
+METRICS_TOKEN  = os.getenv("METRICS_TOKEN", "")  # пусто — /metrics открыт
+DB_READERS     = int(os.getenv("WEBAPP_DB_READERS", "8"))  # читающих коннектов SQLite
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 log = logging.getLogger("webapp")
 
 os.makedirs(DOWNLOADS_DIR, exist_ok=True)
 
-# ── Login tokens ──
-import secrets as _secrets
-
-LOGIN_TOKENS_FILE = BASE_DIR / "login_tokens.json"
-_LT_LOCK = threading.Lock()
-
-def lt_load():
-    if not LOGIN_TOKENS_FILE.exists(): return {}
-    try: return json.loads(LOGIN_TOKENS_FILE.read_text("utf-8"))
-    except: return {}
-
-def lt_save(data):
-    LOGIN_TOKENS_FILE.write_text(json.dumps(data, ensure_ascii=False), "utf-8")
-
-def lt_consume(token: str):
-    with _LT_LOCK:
-        data = lt_load()
-        entry = data.pop(token, None)
-        if entry:
-            lt_save(data)
-    if not entry: return None
-    if entry["expires"] < time.time(): return None
-    return entry["uid"]
-
 import yt_dlp
+from common import (
+    InfoCache, download_with_info, plan_format, canonical_url, flight,
+    Workspace, SearchCache, iter_search, reaper, MediaStore, StoreFull, estimate_selector,
+    metrics, store_metrics, platform_of, METRICS_CONTENT_TYPE, Database, db_metrics,
+    GET_INFO_SECONDS, SEARCH_SECONDS, DOWNLOAD_SECONDS, DOWNLOADS_TOTAL, DOWNLOAD_BYTES,
+)
+
+info_cache   = InfoCache(INFO_CACHE_SIZE, BOT_DB if INFO_CACHE_SHARED else None)
+search_cache = SearchCache(SEARCH_CACHE_SIZE, BOT_DB if INFO_CACHE_SHARED else None)
+media_store  = MediaStore(DOWNLOADS_DIR, MEDIA_BUDGET, MEDIA_FREE_FLOOR,
+                          timeout=MEDIA_ADMIT_WAIT, reaper=reaper)
+store_metrics(media_store, "webapp")
+HTTP_SENT_BYTES = metrics.counter("puwe_http_sent_bytes_total", "Отдано клиентам, байт", ["route"])
+STREAMS_ACTIVE  = metrics.gauge("puwe_streams_active", "Потоковых отдач (yt-dlp → pipe) сейчас")
 
 # ══════════════════════════════════
 #  DATABASE
 # ══════════════════════════════════
 
-# Один глобальный коннект в WAL-режиме — быстрее чем открывать каждый раз
-_DB_CONN = None
-_DB_LOCK = threading.Lock()
-
-def _conn():
-    global _DB_CONN
-    if _DB_CONN is None:
-        c = sqlite3.connect(BOT_DB, check_same_thread=False)
-        c.row_factory = sqlite3.Row
-        c.execute("PRAGMA journal_mode=WAL")
-        c.execute("PRAGMA synchronous=NORMAL")
-        c.execute("PRAGMA cache_size=10000")
-        _DB_CONN = c
-    return _DB_CONN
+# Читатели из пула работают параллельно (WAL), запись — через один коннект
+db = Database(BOT_DB, "webapp", readers=DB_READERS)
+db_metrics(db)
+
+def lt_consume(token):
+    """Одноразовый токен входа из бота: забираем и удаляем одним запросом,
+    повторное использование (или второй процесс) получит None."""
+    if not token: return None
+    try:
+        with db.write() as c:
+            row = c.execute("DELETE FROM login_tokens WHERE token=? RETURNING user_id, expires_at",
+                            (token,)).fetchone()
+    except sqlite3.OperationalError as e:  # бот ещё не создал таблицу
+        log.warning("login token consume error: %s", e)
+        return None
+    if not row or row["expires_at"] < time.time(): return None
+    return row["user_id"]
 
 def db_get_user(uid):
-    with _DB_LOCK:
-        return _conn().execute("SELECT * FROM users WHERE user_id=?", (uid,)).fetchone()
+    return db.one("SELECT * FROM users WHERE user_id=?", (uid,))
 
 def db_upsert_user(uid, username, first_name):
     now = int(time.time())
-    with _DB_LOCK:
-        c = _conn()
+    with db.write() as c:
         if c.execute("SELECT 1 FROM users WHERE user_id=?", (uid,)).fetchone():
             c.execute("UPDATE users SET username=?,first_name=?,last_seen=? WHERE user_id=?",
                       (username, first_name, now, uid))
         else:
             c.execute("INSERT INTO users (user_id,username,first_name,joined_at,last_seen) VALUES (?,?,?,?,?)",
                       (uid, username, first_name, now, now))
-        c.commit()
 
 def is_premium(uid):
     u = db_get_user(uid)
@@ -112,43 +140,74 @@ def is_premium(uid):
     return pu == -1 or pu > int(time.time())
 
 def db_get_search_dl(uid):
-    today = date.today().isoformat()
-    with _DB_LOCK:
-        row = _conn().execute(
-            "SELECT count FROM search_downloads WHERE user_id=? AND date_str=?",
-            (uid, today)).fetchone()
-        return row[0] if row else 0
-
-def db_inc_search_dl(uid):
-    today = date.today().isoformat()
-    with _DB_LOCK:
-        c = _conn()
+    row = db.one("SELECT count FROM search_downloads WHERE user_id=? AND date_str=?",
+                 (uid, date.today().isoformat()))
+    return row[0] if row else 0
+
+def db_reserve_search_dl(uid, limit):
+    """Занимает слот дневного лимита одной транзакцией с проверкой: день,
+    на который записан слот, или None, если лимит уже исчерпан."""
+    day = date.today().isoformat()
+    with db.write() as c:
+        row = c.execute("SELECT count FROM search_downloads WHERE user_id=? AND date_str=?",
+                        (uid, day)).fetchone()
+        if row and row[0] >= limit: return None
         c.execute(
             "INSERT INTO search_downloads (user_id,date_str,count) VALUES (?,?,1) "
             "ON CONFLICT(user_id,date_str) DO UPDATE SET count=count+1",
-            (uid, today))
-        c.commit()
+            (uid, day))
+    return day
+
+def db_refund_search_dl(uid, day):
+    db.execute("UPDATE search_downloads SET count=MAX(count-1,0) WHERE user_id=? AND date_str=?",
+               (uid, day))
 
 # ══════════════════════════════════
 #  TOKENS
 # ══════════════════════════════════
-def make_token(uid):
-    raw = f"{uid}:{SECRET_SALT}:{int(time.time()//86400)}"
-    return hashlib.sha256(raw.encode()).hexdigest()
+# Формат: v2.<uid>.<exp>.<hmac> — uid и срок внутри токена, проверка одним HMAC
+def _token_key():
+    if WEBAPP_SECRET:
+        return WEBAPP_SECRET.encode()
+    if BOT_TOKEN:
+        return hmac.new(b"puwe-webapp-session", BOT_TOKEN.encode(), hashlib.sha256).digest()
+    log.warning("WEBAPP_SECRET и BOT_TOKEN не заданы — токены живут до рестарта")
+    return secrets.token_bytes(32)
+
+_TOKEN_KEY = _token_key()
+_TOKEN_CACHE = OrderedDict()  # token -> (uid, exp)
+_TOKEN_LOCK = threading.Lock()
+
+def _token_sig(payload):
+    return hmac.new(_TOKEN_KEY, payload.encode(), hashlib.sha256).hexdigest()
+
+def make_token(uid, ttl=TOKEN_TTL):
+    payload = f"v2.{int(uid)}.{int(time.time()) + ttl}"
+    return f"{payload}.{_token_sig(payload)}"
 
 def verify_token(token):
     if not token: return None
-    with _DB_LOCK:
-        rows = _conn().execute("SELECT user_id FROM users").fetchall()
-    for row in rows:
-        uid = row[0]
-        for offset in range(3):
-            day = int(time.time()//86400) - offset
-            raw = f"{uid}:{SECRET_SALT}:{day}"
-            expected = hashlib.sha256(raw.encode()).hexdigest()
-            if hmac.compare_digest(expected, token):
-                return uid
-    return None
+    now = time.time()
+    with _TOKEN_LOCK:
+        hit = _TOKEN_CACHE.get(token)
+        if hit:
+            if hit[1] > now:
+                _TOKEN_CACHE.move_to_end(token)
+                return hit[0]
+            del _TOKEN_CACHE[token]
+            return None
+    try:
+        ver, uid, exp, sig = token.split(".")
+        uid, exp = int(uid), int(exp)
+    except ValueError:
+        return None
+    if ver != "v2" or exp <= now: return None
+    if not hmac.compare_digest(_token_sig(f"v2.{uid}.{exp}"), sig): return None
+    with _TOKEN_LOCK:
+        _TOKEN_CACHE[token] = (uid, exp)
+        while len(_TOKEN_CACHE) > TOKEN_CACHE_SIZE:
+            _TOKEN_CACHE.popitem(last=False)
+    return uid
 
 # ══════════════════════════════════
 #  TELEGRAM INIT DATA
@@ -167,26 +226,6 @@ def verify_telegram_init_data(init_data):
         log.warning("initData verify error: %s", e)
         return None
 
-# ══════════════════════════════════
-#  AUTO-DELETE
-# ══════════════════════════════════
-def schedule_delete(path, delay):
-    def _del():
-        time.sleep(delay)
-        try:
-            if os.path.exists(path):
-                os.remove(path)
-                log.info("Auto-deleted: %s", path)
-        except Exception: pass
-    threading.Thread(target=_del, daemon=True).start()
-
-def cleanup_old_files():
-    now = time.time()
-    for f in glob.glob(os.path.join(DOWNLOADS_DIR, "*")):
-        if now - os.path.getmtime(f) > 3600:
-            try: os.remove(f)
-            except Exception: pass
-
 # ══════════════════════════════════
 #  YT-DLP ОПЦИИ (оптимизированные)
 # ══════════════════════════════════
@@ -215,13 +254,550 @@ def _base_opts(out_tpl):
         "noprogress":                   True,
     }
 
+class FetchError(Exception):
+    pass
+
+
+# Прогресс загрузки-лидера видят все задачи, ждущие ту же ссылку (single-flight)
+_WATCH_LOCK = threading.Lock()
+_WATCHERS = {}  # flight key -> [callback(progress_dict)]
+
+def _progress_hook(key):
+    def hook(d):
+        with _WATCH_LOCK:
+            subs = list(_WATCHERS.get(key, ()))
+        for cb in subs:
+            try: cb(d)
+            except Exception: pass
+    return hook
+
+def fetch_file(url, fmt, info=None, on_progress=None):
+    """Качает ссылку в свою папку DOWNLOADS_DIR/<file_id>/ → (file_id, filepath).
+    Одновременные запросы той же ссылки и формата ждут одну загрузку.
+    on_progress(d) получает словари progress_hooks yt-dlp."""
+    key = f"web|{canonical_url(url)}|{fmt}"
+
+    def _run():
+        ws = Workspace(DOWNLOADS_DIR, prefix="")
+        opts = _base_opts(ws.tpl(f"{ws.id}.%(ext)s"))
+        opts.update(ws.hook_opts())
+        opts["progress_hooks"] = opts["postprocessor_hooks"] = [_progress_hook(key)]
+        opts["format"] = fmt
+        if "+" in fmt:
+            opts["merge_output_format"] = "mp4"
+        platform, t0 = platform_of(url), time.perf_counter()
+        try:
+            with media_store.admit(estimate_selector(info, fmt)):
+                download_with_info(opts, url, info)
+        except BaseException as e:
+            ws.cleanup()
+            DOWNLOADS_TOTAL.inc(platform=platform, mode="file",
+                                outcome="rejected" if isinstance(e, StoreFull) else "error")
+            raise
+        DOWNLOAD_SECONDS.observe(time.perf_counter() - t0, platform=platform, mode="file")
+        files = ws.files()
+        if not files:
+            ws.cleanup()
+            DOWNLOADS_TOTAL.inc(platform=platform, mode="file", outcome="error")
+            raise FetchError("Файл не найден после загрузки")
+        DOWNLOADS_TOTAL.inc(platform=platform, mode="file", outcome="ok")
+        DOWNLOAD_BYTES.inc(os.path.getsize(files[0]), platform=platform, mode="file")
+        media_store.add(files[0])
+        return ws.id, files[0]
+
+    if on_progress:
+        with _WATCH_LOCK:
+            _WATCHERS.setdefault(key, []).append(on_progress)
+    try:
+        (file_id, filepath), shared = flight.do(key, _run)
+    finally:
+        if on_progress:
+            with _WATCH_LOCK:
+                subs = _WATCHERS.get(key, [])
+                if on_progress in subs: subs.remove(on_progress)
+                if not subs: _WATCHERS.pop(key, None)
+    if shared:
+        log.info("Coalesced download %s → %s", url, file_id)
+    return file_id, filepath
+
+
+# Один file_id могут получить несколько пользователей (single-flight): DELETE
+# одного снимает только его отметку, папка удаляется за последним
+_OWNERS_LOCK = threading.Lock()
+_OWNERS = {}  # file_id -> {uid}
+
+def claim_file(file_id, uid):
+    with _OWNERS_LOCK:
+        _OWNERS.setdefault(file_id, set()).add(uid)
+
+def unclaim_file(file_id, uid):
+    """True — больше никто не держит файл, можно удалять."""
+    with _OWNERS_LOCK:
+        owners = _OWNERS.get(file_id)
+        if owners is None:
+            return True
+        owners.discard(uid)
+        if owners:
+            return False
+        del _OWNERS[file_id]
+        return True
+
+def _forget_owners(path):
+    rel = os.path.relpath(path, DOWNLOADS_DIR)
+    if not rel.startswith(".."):
+        with _OWNERS_LOCK:
+            _OWNERS.pop(rel.split(os.sep)[0], None)
+
+reaper.on_delete.append(_forget_owners)
+
+
+def resolve_format(url, fmt_id="best", mode="video"):
+    """Селектор yt-dlp под кнопку мини-аппа → (fmt, info из кэша или None)."""
+    # Без лимита размера: уважаем выбор, video-only склеиваем с аудио
+    info = info_cache.get(url)
+    plan = None
+    if info is not None:
+        plan, _ = plan_format(info, fmt_id or "best", None, audio=mode == "audio")
+    if plan:
+        return plan, info
+    if mode == "audio":
+        return AUDIO_FORMAT, info
+    if fmt_id and fmt_id != "best":
+        # Пользователь выбрал конкретный формат
+        return fmt_id, info
+    return VIDEO_FORMAT, info
+
+
+# ══════════════════════════════════
+#  ПОТОКОВАЯ ОТДАЧА (без диска)
+# ══════════════════════════════════
+_STREAM_SLOTS = threading.BoundedSemaphore(STREAM_MAX)
+
+
+def streamable(fmt):
+    """В pipe можно писать только то, что не нужно склеивать ffmpeg'ом из двух файлов."""
+    return "+" not in fmt
+
+
+def stream_name(info, fmt, mode):
+    """(имя файла, Content-Type) для потоковой отдачи."""
+    f = None
+    if info:
+        f = next((x for x in info.get("formats") or [] if x.get("format_id") == fmt), None)
+    ext = (f or {}).get("ext") or ("m4a" if mode == "audio" else "mp4")
+    title = ((info or {}).get("title") or ("audio" if mode == "audio" else "video"))[:80]
+    title = "".join(c for c in title if c not in '\\/:*?"<>|\r\n').strip() or "video"
+    return f"{title}.{ext}", mimetypes.guess_type(f"x.{ext}")[0] or "application/octet-stream"
+
+
+class PipeStream:
+    """yt-dlp в отдельном процессе пишет файл в stdout. Читатель сам задаёт
+    темп: пока ответ клиенту не ушёл, read() не вызывается, pipe заполняется
+    и yt-dlp блокируется на записи — это и есть backpressure."""
+
+    def __init__(self, url, fmt):
+        self._err = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "yt_dlp", "--quiet", "--no-warnings", "--no-part",
+             "--no-playlist", "-f", fmt, "-o", "-", "--", url],
+            stdout=subprocess.PIPE, stderr=self._err, stdin=subprocess.DEVNULL,
+            start_new_session=True)  # ffmpeg-дети убиваются вместе с группой
+        self.fd = self.proc.stdout.fileno()
+        self.sent = 0
+
+    def read(self, timeout=STREAM_IDLE):
+        """Очередной кусок; b"" — конец потока; TimeoutError — yt-dlp молчит."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            raise TimeoutError("stream idle")
+        data = os.read(self.fd, STREAM_CHUNK)
+        self.sent += len(data)
+        return data
+
+    def ok(self):
+        """После EOF: yt-dlp завершился успешно."""
+        try:
+            return self.proc.wait(timeout=10) == 0
+        except subprocess.TimeoutExpired:
+            return False
+
+    def error(self):
+        self._err.seek(0)
+        lines = self._err.read()[-2000:].decode(errors="replace").strip().splitlines()
+        return lines[-1] if lines else "yt-dlp failed"
+
+    def close(self):
+        if self.proc.poll() is None:
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.proc.wait()
+        self.proc.stdout.close()
+        self._err.close()
+
+
+# ══════════════════════════════════
+#  ФОНОВЫЕ ЗАДАЧИ ЗАГРУЗКИ
+# ══════════════════════════════════
+class Job:
+    """Загрузка в пуле воркеров. Состояние: queued → running → processing
+    (склейка/постпроцессоры) → done | error. version растёт на каждом
+    изменении — по нему ждут long-poll и SSE."""
+
+    def __init__(self, uid, kind, url, fmt, info=None):
+        self.id       = secrets.token_urlsafe(9)
+        self.uid      = uid
+        self.kind     = kind   # download | search
+        self.url      = url
+        self.fmt      = fmt
+        self.info     = info
+        self.reserved = None   # день занятого слота лимита поиска
+        self.state    = "queued"
+        self.progress = {}
+        self.result   = None
+        self.error    = None
+        self.version  = 0
+        self.updated  = time.time()
+        self.cond     = threading.Condition()
+        self._last    = 0.0
+
+    @property
+    def finished(self):
+        return self.state in ("done", "error")
+
+    def update(self, **fields):
+        with self.cond:
+            for k, v in fields.items():
+                setattr(self, k, v)
+            self.version += 1
+            self.updated = time.time()
+            self.cond.notify_all()
+
+    def on_progress(self, d):
+        # "finished" загрузки — готова лишь одна часть (video+audio качаются по
+        # очереди); processing — когда пошли постпроцессоры: склейка, перенос
+        if d.get("postprocessor"):
+            if self.state == "running":
+                self.update(state="processing")
+            return
+        status = d.get("status")
+        if status != "downloading":
+            return
+        now = time.monotonic()
+        if now - self._last < 0.3:  # не чаще ~3 раз в секунду
+            return
+        self._last = now
+        done  = d.get("downloaded_bytes") or 0
+        total = d.get("total_bytes") or d.get("total_bytes_estimate")
+        self.update(state="running", progress={
+            "downloaded": done, "total": total,
+            "percent": round(done * 100 / total, 1) if total else None,
+            "speed": d.get("speed"), "eta": d.get("eta"),
+        })
+
+    def snapshot(self):
+        with self.cond:
+            return {"job_id": self.id, "state": self.state, "version": self.version,
+                    "progress": self.progress, "result": self.result, "error": self.error}
+
+    def wait(self, version, timeout):
+        """Снимок, как только version сменится (или задача закончится), либо по таймауту."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.version > version or self.finished, timeout)
+        return self.snapshot()
+
+
+_JOBS_LOCK = threading.Lock()
+_JOBS = {}  # id -> Job
+_POOL = ThreadPoolExecutor(JOB_WORKERS, thread_name_prefix="dljob")
+
+
+def _jobs_in(state):
+    with _JOBS_LOCK:
+        return sum(1 for j in _JOBS.values() if j.state == state)
+
+
+metrics.gauge("puwe_queue_depth", "Ждут слота загрузки", ["proc", "lane"],
+              fn=lambda: {("webapp", "jobs"): _jobs_in("queued")}, source="webapp")
+metrics.gauge("puwe_ytdlp_active", "Загрузок yt-dlp сейчас", ["proc"],
+              fn=lambda: {("webapp",): _jobs_in("running") + _jobs_in("processing") + STREAMS_ACTIVE.value()},
+              source="webapp")
+
+
+def _run_job(job):
+    job.update(state="running")
+    try:
+        file_id, filepath = fetch_file(job.url, job.fmt, job.info, job.on_progress)
+    except Exception as e:
+        if job.reserved:  # неудачная загрузка лимит не тратит
+            db_refund_search_dl(job.uid, job.reserved)
+        job.update(state="error", error=str(e)[:200])
+        return
+    claim_file(file_id, job.uid)
+    filename = os.path.basename(filepath)
+    result = {"file_id": file_id, "filename": filename, "size": os.path.getsize(filepath),
+              "download_url": f"/api/file/{file_id}/{filename}"}
+    if job.kind == "search":
+        result["used"]  = db_get_search_dl(job.uid)
+        result["limit"] = PREMIUM_DL_DAY if is_premium(job.uid) else FREE_DL_DAY
+    reaper.schedule(filepath, FILE_TTL_SEC)
+    job.info = None
+    job.update(state="done", result=result)
+
+
+def submit_job(uid, kind, url, fmt, info=None, reserved=None):
+    """Job или None, если у пользователя уже JOBS_PER_USER активных задач.
+    reserved — день занятого слота лимита поиска: при отказе он возвращается."""
+    now = time.time()
+    with _JOBS_LOCK:
+        for k in [k for k, j in _JOBS.items() if j.finished and now - j.updated > JOB_KEEP_SEC]:
+            del _JOBS[k]
+        busy = sum(1 for j in _JOBS.values() if j.uid == uid and not j.finished) >= JOBS_PER_USER
+        if not busy:
+            job = Job(uid, kind, url, fmt, info)
+            job.reserved = reserved
+            _JOBS[job.id] = job
+    if busy:
+        if reserved: db_refund_search_dl(uid, reserved)
+        return None
+    _POOL.submit(_run_job, job)
+    return job
+
+
+def _wait_done(job):
+    with job.cond:
+        job.cond.wait_for(lambda: job.finished)
+    return job.snapshot()
+
+
+def get_job(uid, jid):
+    with _JOBS_LOCK:
+        job = _JOBS.get(jid)
+    return job if job and job.uid == uid else None
+
+
+# ══════════════════════════════════
+#  ПОСТРАНИЧНЫЙ ПОИСК
+# ══════════════════════════════════
+class SearchSession:
+    """Состояние одного поиска: уже полученные записи + ленивый итератор
+    yt-dlp, который догружает страницы выдачи только по запросу."""
+
+    def __init__(self, uid, platform, query):
+        self.id       = secrets.token_urlsafe(9)
+        self.uid      = uid
+        self.platform = platform
+        self.query    = query
+        self.used     = time.time()
+        self.lock     = threading.Lock()
+        # Начало выдачи часто уже есть в кэше — итератор тогда пропустит эти записи
+        self.items    = list(search_cache.get(platform, query, SEARCH_PAGE) or [])[:SEARCH_MAX]
+        self.cached   = len(self.items)
+        self.done     = False
+        self._ydl     = None
+        self._gen     = None
+
+    def _pull(self):
+        if self._gen is None:
+            self._ydl, self._gen = iter_search(self.platform, self.query, SEARCH_MAX)
+            for _ in range(len(self.items)):
+                next(self._gen)
+        return next(self._gen)
+
+    def page(self, offset, size):
+        """(записи, есть_ещё). Ошибки yt-dlp — конец выдачи."""
+        with self.lock, SEARCH_SECONDS.time(platform=self.platform, source="page"):
+            self.used = time.time()
+            while not self.done and len(self.items) < min(offset + size + 1, SEARCH_MAX):
+                try:
+                    self.items.append(self._pull())
+                except StopIteration:
+                    self._finish()
+                except Exception as e:
+                    log.warning("Search page error (%s): %s", self.platform, e)
+                    self._finish()
+            if len(self.items) >= SEARCH_MAX and not self.done:
+                self._finish()
+            more = len(self.items) > offset + size
+            return self.items[offset:offset + size], more
+
+    def _finish(self):
+        self.done = True
+        self.close()
+        if len(self.items) > self.cached:
+            search_cache.put(self.platform, self.query, len(self.items), list(self.items))
+
+    def close(self):
+        if self._ydl is not None:
+            try:
+                self._ydl.close()
+            except Exception:
+                pass
+            self._ydl = self._gen = None
+
+
+_SEARCH_LOCK = threading.Lock()
+_SEARCHES = OrderedDict()  # id -> SearchSession
+
+
+def _expire_searches():
+    """Под _SEARCH_LOCK."""
+    now = time.time()
+    for k in [k for k, s in _SEARCHES.items() if now - s.used > SEARCH_SESSION_TTL]:
+        _SEARCHES.pop(k).close()
+
+def find_search_session(uid, sid):
+    """Сессия пользователя по id или None — новая здесь не создаётся."""
+    with _SEARCH_LOCK:
+        _expire_searches()
+        sess = _SEARCHES.get(sid) if sid else None
+        if not sess or sess.uid != uid:
+            return None
+        _SEARCHES.move_to_end(sid)
+        return sess
+
+def search_session(uid, platform, query):
+    """Новая сессия под запрос."""
+    sess = SearchSession(uid, platform, query)
+    with _SEARCH_LOCK:
+        _expire_searches()
+        _SEARCHES[sess.id] = sess
+        while len(_SEARCHES) > SEARCH_SESSIONS:
+            _SEARCHES.popitem(last=False)[1].close()
+    return sess
+
+
 # ══════════════════════════════════
 #  HTTP HANDLER
 # ══════════════════════════════════
+# ══════════════════════════════════
+#  СТАТИКА (в памяти, ETag/304, gzip/br)
+# ══════════════════════════════════
+STATIC_EXTS = (".html", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".ico", ".svg")
+_COMPRESSIBLE = ("text/", "image/svg+xml", "application/javascript", "application/json")
+
+
+class StaticAsset:
+    """Файл целиком в памяти + заранее сжатые варианты. У каждого варианта
+    свой сильный ETag (хэш содержимого + кодировка)."""
+
+    def __init__(self, path):
+        self.path = path
+        st = os.stat(path)
+        self.mtime, self.size = st.st_mtime, st.st_size
+        with open(path, "rb") as f:
+            self.body = f.read()
+        self.mime = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if self.mime.startswith("text/"):
+            self.mime += "; charset=utf-8"
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        tag = hashlib.sha256(self.body).hexdigest()[:20]
+        self.variants = {"identity": (self.body, f'"{tag}"')}
+        if self.mime.startswith(_COMPRESSIBLE) and len(self.body) > 512:
+            self.variants["gzip"] = (gzip.compress(self.body, 9, mtime=0), f'"{tag}-gz"')
+            if brotli is not None:
+                self.variants["br"] = (brotli.compress(self.body), f'"{tag}-br"')
+        # html перепроверяется каждый раз (дёшево: 304), картинки кэшируются на сутки
+        self.cache_control = "no-cache" if self.mime.startswith("text/html") else "public, max-age=86400"
+
+    @property
+    def compressible(self):
+        return len(self.variants) > 1
+
+    def pick(self, accept_encoding):
+        """(кодировка, тело, etag) по Accept-Encoding: br → gzip → как есть."""
+        accepted = set()
+        for part in (accept_encoding or "").split(","):
+            name, _, q = part.strip().partition(";")
+            if q.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                continue
+            accepted.add(name.strip().lower())
+        for enc in ("br", "gzip"):
+            if enc in self.variants and (enc in accepted or "*" in accepted):
+                return (enc, *self.variants[enc])
+        return ("identity", *self.variants["identity"])
+
+
+class StaticCache:
+    """Статика из BASE_DIR в памяти; файл перечитывается, если сменился mtime/размер
+    (проверка не чаще раза в STAT_EVERY секунд на файл)."""
+
+    STAT_EVERY = 1.0
+
+    def __init__(self, root):
+        self.root    = Path(root)
+        self._lock   = threading.Lock()
+        self._assets = {}  # name -> (checked_at, StaticAsset)
+
+    def preload(self):
+        for p in self.root.iterdir():
+            if p.is_file() and p.suffix.lower() in STATIC_EXTS:
+                self.get(p.name)
+        log.info("Static preloaded: %s", ", ".join(sorted(self._assets)))
+
+    def get(self, name):
+        if "/" in name or name.startswith(".") or Path(name).suffix.lower() not in STATIC_EXTS:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._assets.get(name)
+        if entry and now - entry[0] < self.STAT_EVERY:
+            return entry[1]
+        path = self.root / name
+        try:
+            st = os.stat(path)
+        except OSError:
+            with self._lock:
+                self._assets.pop(name, None)
+            return None
+        asset = entry[1] if entry else None
+        if asset is None or (st.st_mtime, st.st_size) != (asset.mtime, asset.size):
+            asset = StaticAsset(str(path))
+            if entry:
+                log.info("Static reloaded: %s", name)
+        with self._lock:
+            self._assets[name] = (now, asset)
+        return asset
+
+
+static_files = StaticCache(BASE_DIR)
+
+
+def _parse_range(header, size):
+    """Range: bytes=a-b → (start, end) включительно. None — диапазон вне файла
+    (416), False — не разобрать или несколько диапазонов (отдаём целиком)."""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return False
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return False
+    try:
+        if not first:  # bytes=-N — последние N байт
+            n = int(last)
+            if n <= 0 or not size:
+                return None
+            return max(0, size - n), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return False
+    if start >= size:
+        return None
+    if end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+# ?token= в строке запроса — токен сессии: в лог он не попадает
+_TOKEN_QS = re.compile(r"([?&]token=)[^&\s\"]*")
+
+
 class Handler(BaseHTTPRequestHandler):
 
     def log_message(self, fmt, *args):
-        log.info("%s - %s", self.address_string(), fmt % args)
+        log.info("%s - %s", self.address_string(), _TOKEN_QS.sub(r"\1***", fmt % args))
 
     def _cors(self):
         self.send_header("Access-Control-Allow-Origin", "*")
@@ -244,34 +820,211 @@ class Handler(BaseHTTPRequestHandler):
         except Exception: return {}
 
     def _require_auth(self):
-        uid = verify_token(self.headers.get("X-Token", ""))
+        # ?token= — для EventSource и прямых ссылок, где заголовок не поставить
+        token = self.headers.get("X-Token", "") or dict(parse_qsl(urlparse(self.path).query)).get("token", "")
+        uid = verify_token(token)
         if not uid:
             self._json(401, {"ok": False, "error": "Unauthorized"})
         return uid
 
-    def _stream_file(self, fpath, fname):
-        """Стриминг файла чанками — не грузит весь файл в память."""
-        size = os.path.getsize(fpath)
+    def _sse(self, job):
+        """Прогресс задачи как Server-Sent Events: progress … done | failed."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("X-Accel-Buffering", "no")  # nginx не должен буферизовать
+        self._cors()
+        self.end_headers()
+        version = -1
+        try:
+            while True:
+                snap = job.wait(version, timeout=15)
+                if snap["version"] == version and snap["state"] not in ("done", "error"):
+                    self.wfile.write(b": ping\n\n")
+                else:
+                    version = snap["version"]
+                    event = {"done": "done", "error": "failed"}.get(snap["state"], "progress")
+                    data = json.dumps(snap, ensure_ascii=False)
+                    self.wfile.write(f"event: {event}\ndata: {data}\n\n".encode())
+                self.wfile.flush()
+                if snap["state"] in ("done", "error"):
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send_static(self, asset):
+        """Статика из памяти: If-None-Match → 304, сжатый вариант по Accept-Encoding."""
+        enc, body, etag = asset.pick(self.headers.get("Accept-Encoding"))
+        inm = self.headers.get("If-None-Match")
+        if inm:
+            tags = {t.strip().removeprefix("W/") for t in inm.split(",")}
+            # 304 для любого варианта этого содержимого
+            if "*" in tags or tags & {v[1] for v in asset.variants.values()}:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", asset.cache_control)
+                if asset.compressible:
+                    self.send_header("Vary", "Accept-Encoding")
+                self.end_headers()
+                return
+
+        status, rng = 200, self.headers.get("Range")
+        start, end = 0, len(body) - 1
+        if rng and enc == "identity":
+            parsed = _parse_range(rng, len(body))
+            if parsed:
+                (start, end), status = parsed, 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", asset.mime)
+        self.send_header("Content-Length", end - start + 1)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", asset.last_modified)
+        self.send_header("Cache-Control", asset.cache_control)
+        if enc != "identity":
+            self.send_header("Content-Encoding", enc)
+        else:
+            self.send_header("Accept-Ranges", "bytes")
+        if asset.compressible:
+            self.send_header("Vary", "Accept-Encoding")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+        self._cors()
+        self.end_headers()
+        try:
+            self.wfile.write(body[start:end + 1] if status == 206 else body)
+            HTTP_SENT_BYTES.inc(end - start + 1, route="static")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _stream_file(self, fpath, fname, attachment=True):
+        """Отдаёт файл целиком (200) или запрошенный диапазон (Range/If-Range → 206).
+        Тело уходит через socket.sendfile: os.sendfile без копирования через
+        user space, а где его нет (TLS, не Linux) — обычный send()."""
+        st   = os.stat(fpath)
+        size = st.st_size
+        etag = f'"{int(st.st_mtime):x}-{size:x}"'
+        last_modified = formatdate(st.st_mtime, usegmt=True)
         mime, _ = mimetypes.guess_type(fname)
         content_type = mime or "application/octet-stream"
 
-        self.send_response(200)
+        start, end, status = 0, size - 1, 200
+        rng = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        # If-Range: диапазон только если файл не менялся, иначе — целиком
+        if rng and (not if_range or if_range in (etag, last_modified)):
+            parsed = _parse_range(rng, size)
+            if parsed is None:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", 0)
+                self._cors()
+                self.end_headers()
+                return
+            if parsed:
+                (start, end), status = parsed, 206
+        length = max(0, end - start + 1)
+
+        self.send_response(status)
         self.send_header("Content-Type", content_type)
-        self.send_header("Content-Disposition", f'attachment; filename="{fname}"')
-        self.send_header("Content-Length", size)
+        if attachment:
+            self.send_header("Content-Disposition", f'attachment; filename="{fname}"')
+        self.send_header("Content-Length", length)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
         self.send_header("Cache-Control", "public, max-age=120")
         self._cors()
         self.end_headers()
 
+        if not length:
+            return
         with open(fpath, "rb") as f:
-            while True:
-                chunk = f.read(STREAM_CHUNK)
-                if not chunk:
-                    break
+            try:
+                HTTP_SENT_BYTES.inc(self.connection.sendfile(f, start, length), route="file")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    def _relay(self, pipe, first, fname, content_type):
+        """Отдаёт PipeStream по мере чтения: HTTP/1.1 — chunked, HTTP/1.0 — до закрытия."""
+        chunked = self.request_version == "HTTP/1.1"
+        if chunked:
+            self.protocol_version = "HTTP/1.1"
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Disposition",
+                         f"attachment; filename=\"{fname.encode('ascii', 'replace').decode()}\"; "
+                         f"filename*=UTF-8''{quote(fname)}")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("X-Accel-Buffering", "no")
+        self.send_header("Connection", "close")
+        self._cors()
+        self.end_headers()
+        data = first
+        try:
+            while data:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data) if chunked else data)
+                data = pipe.read()
+            if pipe.ok():
+                if chunked:
+                    self.wfile.write(b"0\r\n\r\n")
+                return True
+            # Без завершающего чанка клиент увидит оборванную загрузку, а не битый файл
+            log.warning("Stream failed after %d bytes: %s", pipe.sent, pipe.error())
+        except TimeoutError:
+            log.warning("Stream idle for %ds after %d bytes", STREAM_IDLE, pipe.sent)
+        except (BrokenPipeError, ConnectionResetError):
+            log.info("Stream client gone after %d bytes", pipe.sent)
+        return False
+
+    def _stream_download(self, uid, url, fmt_id, mode):
+        """yt-dlp → pipe → клиент. Склейки ("+") и неудачный старт — через диск."""
+        fmt, info = resolve_format(url, fmt_id, mode)
+        if streamable(fmt) and _STREAM_SLOTS.acquire(blocking=False):
+            STREAMS_ACTIVE.inc()
+            platform, t0 = platform_of(url), time.perf_counter()
+            try:
+                pipe = PipeStream(url, fmt)
                 try:
-                    self.wfile.write(chunk)
-                except (BrokenPipeError, ConnectionResetError):
-                    break
+                    try:
+                        # Заголовки — только когда пошли данные: до этого ещё можно уйти на диск
+                        first = pipe.read(timeout=STREAM_IDLE * 2)
+                    except TimeoutError:
+                        first = b""
+                    if first:
+                        fname, ctype = stream_name(info, fmt, mode)
+                        log.info("Streaming %s (%s) to uid %s", url, fmt, uid)
+                        ok = self._relay(pipe, first, fname, ctype)
+                        DOWNLOAD_SECONDS.observe(time.perf_counter() - t0, platform=platform, mode="stream")
+                        DOWNLOADS_TOTAL.inc(platform=platform, mode="stream", outcome="ok" if ok else "error")
+                        DOWNLOAD_BYTES.inc(pipe.sent, platform=platform, mode="stream")
+                        HTTP_SENT_BYTES.inc(pipe.sent, route="stream")
+                        return
+                    log.warning("Stream start failed (%s), spooling: %s", pipe.error(), url)
+                    DOWNLOADS_TOTAL.inc(platform=platform, mode="stream", outcome="spooled")
+                finally:
+                    pipe.close()
+            finally:
+                STREAMS_ACTIVE.dec()
+                _STREAM_SLOTS.release()
+
+        # Диск: та же фоновая задача, что у /api/download, и сразу отдаём файл
+        job = submit_job(uid, "download", url, fmt, info)
+        if not job:
+            self._json(429, {"ok": False, "error": "Слишком много загрузок одновременно"}); return
+        snap = _wait_done(job)
+        if snap["state"] != "done":
+            self._json(502, {"ok": False, "error": snap["error"]}); return
+        fpath = os.path.join(DOWNLOADS_DIR, snap["result"]["file_id"], snap["result"]["filename"])
+        if not os.path.isfile(fpath):
+            self._json(410, {"ok": False, "error": "File expired"}); return
+        with media_store.holding(fpath):
+            self._stream_file(fpath, snap["result"]["filename"])
 
     # ── OPTIONS ──
     def do_OPTIONS(self):
@@ -285,32 +1038,88 @@ class Handler(BaseHTTPRequestHandler):
         path   = parsed.path.rstrip("/") or "/"
 
         if path in ("/", "/miniapp.html", ""):
-            fpath = BASE_DIR / "miniapp.html"
-            if not fpath.exists():
+            asset = static_files.get("miniapp.html")
+            if not asset:
                 self._json(404, {"error": "miniapp.html not found"}); return
-            self._stream_file(str(fpath), "miniapp.html")
+            self._send_static(asset)
             return
 
         # Статические файлы из корня
         if path.count("/") == 1:
             ext = Path(path).suffix.lower()
-            if ext in (".png", ".jpg", ".jpeg", ".gif", ".webp", ".ico", ".svg"):
-                fpath = BASE_DIR / path.lstrip("/")
-                if fpath.exists():
-                    self._stream_file(str(fpath), fpath.name)
+            if ext in STATIC_EXTS and ext != ".html":
+                asset = static_files.get(path.lstrip("/"))
+                if asset:
+                    self._send_static(asset)
                 return
 
-        # /api/file/<name>
+        if path == "/metrics":
+            if METRICS_TOKEN:
+                auth = self.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+                given = auth or dict(parse_qsl(parsed.query)).get("token", "")
+                if not hmac.compare_digest(given, METRICS_TOKEN):
+                    self._json(401, {"ok": False, "error": "Unauthorized"}); return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+            self.send_header("Content-Length", len(body))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        # /api/file/<file_id>/<name>
         if path.startswith("/api/file/"):
             uid = self._require_auth()
             if not uid: return
-            fname = os.path.basename(path[10:])
-            fpath = Path(DOWNLOADS_DIR) / fname
-            if not fpath.exists():
+            parts = [p for p in path[10:].split("/") if p]
+            fname = parts[-1] if parts else ""
+            bad = not parts or len(parts) > 2 or any(p in (".", "..") for p in parts)
+            fpath = None if bad else Path(DOWNLOADS_DIR).joinpath(*parts)
+            if not fpath or not fpath.is_file():
                 self._json(404, {"ok": False, "error": "Not found"}); return
-            self._stream_file(str(fpath), fname)
+            # Пока файл отдаётся, его не вытесняют и не удаляют; после — ещё linger на докачку
+            with media_store.holding(str(fpath)):
+                self._stream_file(str(fpath), fname)
+            return
+
+        # /api/stream?url=&format_id=&mode= — файл сразу в ответ, без ожидания загрузки
+        if path == "/api/stream":
+            uid = self._require_auth()
+            if not uid: return
+            q = dict(parse_qsl(parsed.query))
+            url = q.get("url", "").strip()
+            if not url:
+                self._json(400, {"ok": False, "error": "No URL"}); return
+            self._stream_download(uid, url, q.get("format_id", "best"), q.get("mode", "video"))
             return
 
+        # /api/jobs/<id>[/events|/result]
+        if path.startswith("/api/jobs/"):
+            uid = self._require_auth()
+            if not uid: return
+            parts = path[10:].split("/")
+            job = get_job(uid, parts[0])
+            if not job:
+                self._json(404, {"ok": False, "error": "Job not found"}); return
+            sub = parts[1] if len(parts) > 1 else ""
+            if sub == "events":
+                self._sse(job); return
+            if sub == "result":
+                snap = job.snapshot()
+                if snap["state"] == "done":
+                    self._json(200, {"ok": True, **snap["result"]})
+                elif snap["state"] == "error":
+                    self._json(200, {"ok": False, "error": snap["error"]})
+                else:
+                    self._json(202, {"ok": True, "state": snap["state"], "progress": snap["progress"]})
+                return
+            if sub == "":
+                q = dict(parse_qsl(parsed.query))
+                wait = int(q["wait"]) if q.get("wait", "").lstrip("-").isdigit() else None
+                snap = job.snapshot() if wait is None else job.wait(wait, timeout=25)
+                self._json(200, {"ok": True, **snap}); return
+            self._json(404, {"ok": False, "error": "not found"}); return
+
         # /login/<token>
         if path.startswith("/login/"):
             token = path[7:]
@@ -366,6 +1175,17 @@ class Handler(BaseHTTPRequestHandler):
             }})
             return
 
+        if path == "/api/cache-stats":
+            uid = self._require_auth()
+            if not uid: return
+            self._json(200, {"ok": True, "info_cache": info_cache.stats(),
+                             "search_cache": search_cache.stats(),
+                             "single_flight": flight.stats(),
+                             "reaper": reaper.stats(),
+                             "media_store": media_store.stats(),
+                             "db": db.stats()})
+            return
+
         if path == "/api/limits":
             uid = self._require_auth()
             if not uid: return
@@ -384,9 +1204,14 @@ class Handler(BaseHTTPRequestHandler):
             uid = self._require_auth()
             if not uid: return
             safe_id = os.path.basename(path[12:])[:16]
-            for f in glob.glob(os.path.join(DOWNLOADS_DIR, f"{safe_id}.*")):
-                try: os.remove(f); log.info("Deleted %s", f)
-                except Exception: pass
+            job_dir = os.path.join(DOWNLOADS_DIR, safe_id)
+            if safe_id not in ("", ".", "..") and os.path.isdir(job_dir) and unclaim_file(safe_id, uid):
+                # Удаляет Reaper: папка ждёт, пока файл отдаётся (holding / пин MediaStore)
+                for f in os.listdir(job_dir):
+                    reaper.cancel(os.path.join(job_dir, f))
+                reaper.cancel(job_dir)
+                reaper.schedule(job_dir, 0)
+                log.info("Delete requested %s", job_dir)
             self._json(200, {"ok": True})
             return
         self._json(404, {"error": "not found"})
@@ -417,16 +1242,20 @@ class Handler(BaseHTTPRequestHandler):
             url = body.get("url", "").strip()
             if not url:
                 self._json(400, {"ok": False, "error": "No URL"}); return
-            try:
-                with yt_dlp.YoutubeDL({
-                    "quiet": True, "no_warnings": True,
-                    "check_formats": False,  # быстрее без проверки
-                }) as ydl:
-                    info = ydl.extract_info(url, download=False)
-            except Exception as e:
-                self._json(200, {"ok": False, "error": str(e)[:200]}); return
-            if not info:
-                self._json(200, {"ok": False, "error": "Не удалось получить информацию"}); return
+            with GET_INFO_SECONDS.time(cached="1"):
+                info = info_cache.get(url)
+            if info is None:
+                try:
+                    with GET_INFO_SECONDS.time(cached="0"), yt_dlp.YoutubeDL({
+                        "quiet": True, "no_warnings": True,
+                        "check_formats": False,  # быстрее без проверки
+                    }) as ydl:
+                        info = ydl.extract_info(url, download=False)
+                except Exception as e:
+                    self._json(200, {"ok": False, "error": str(e)[:200]}); return
+                if not info:
+                    self._json(200, {"ok": False, "error": "Не удалось получить информацию"}); return
+                info = info_cache.put(url, info)
 
             dur = info.get("duration") or 0
             if dur:
@@ -454,132 +1283,94 @@ class Handler(BaseHTTPRequestHandler):
                 "formats": formats_out})
             return
 
-        # /api/download
-        if path == "/api/download":
+        # /api/jobs — загрузка в фоне, ответ сразу
+        if path == "/api/jobs":
             uid = self._require_auth()
             if not uid: return
-            url    = body.get("url", "").strip()
-            fmt_id = body.get("format_id", "best")
-            mode   = body.get("mode", "video")
+            url = body.get("url", "").strip()
             if not url:
                 self._json(400, {"ok": False, "error": "No URL"}); return
-
-            file_id = str(uuid.uuid4())[:8]
-            out_tpl = os.path.join(DOWNLOADS_DIR, f"{file_id}.%(ext)s")
-            opts = _base_opts(out_tpl)
-
-            if mode == "audio":
-                opts["format"] = AUDIO_FORMAT
-            elif fmt_id and fmt_id != "best":
-                # Пользователь выбрал конкретный формат
-                opts["format"] = fmt_id
+            kind, day = "search" if body.get("source") == "search" else "download", None
+            if kind == "search":
+                limit = PREMIUM_DL_DAY if is_premium(uid) else FREE_DL_DAY
+                day = db_reserve_search_dl(uid, limit)
+                if not day:
+                    self._json(429, {"ok": False, "error": f"Лимит {limit}/день исчерпан"}); return
+                fmt, info = VIDEO_FORMAT, info_cache.get(url)
             else:
-                opts["format"] = VIDEO_FORMAT
+                fmt, info = resolve_format(url, body.get("format_id", "best"), body.get("mode", "video"))
+            job = submit_job(uid, kind, url, fmt, info, reserved=day)
+            if not job:
+                self._json(429, {"ok": False, "error": "Слишком много загрузок одновременно"}); return
+            self._json(202, {"ok": True, "job_id": job.id, "state": job.state})
+            return
 
-            try:
-                yt_dlp.YoutubeDL(opts).download([url])
-            except Exception as e:
-                self._json(200, {"ok": False, "error": str(e)[:200]}); return
-
-            files = [f for f in glob.glob(os.path.join(DOWNLOADS_DIR, f"{file_id}.*"))
-                     if not f.endswith(".part") and os.path.getsize(f) > 1024]
-            if not files:
-                self._json(200, {"ok": False, "error": "Файл не найден после загрузки"}); return
-
-            filepath = sorted(files)[-1]
-            filename = os.path.basename(filepath)
-            size     = os.path.getsize(filepath)
-
-            schedule_delete(filepath, FILE_TTL_SEC)
-            self._json(200, {"ok": True, "file_id": file_id, "filename": filename,
-                             "size": size, "download_url": f"/api/file/{filename}"})
+        # /api/download — старый синхронный вариант: та же задача, но ждём её
+        if path == "/api/download":
+            uid = self._require_auth()
+            if not uid: return
+            url    = body.get("url", "").strip()
+            if not url:
+                self._json(400, {"ok": False, "error": "No URL"}); return
+            fmt, info = resolve_format(url, body.get("format_id", "best"), body.get("mode", "video"))
+            job = submit_job(uid, "download", url, fmt, info)
+            if not job:
+                self._json(429, {"ok": False, "error": "Слишком много загрузок одновременно"}); return
+            snap = _wait_done(job)
+            if snap["state"] != "done":
+                self._json(200, {"ok": False, "error": snap["error"]}); return
+            self._json(200, {"ok": True, **snap["result"]})
             return
 
         # /api/search
         if path == "/api/search":
             uid = self._require_auth()
             if not uid: return
-            query    = body.get("query", "").strip()
-            platform = body.get("platform", "yt")
-            if not query:
-                self._json(400, {"ok": False, "error": "No query"}); return
-
-            search_url = f"ytsearch100:{query}" if platform == "yt" else f"tiktok:search:{query}"
-            opts = {
-                "quiet": True, "no_warnings": True,
-                "extract_flat": True, "skip_download": True,
-                "check_formats": False,
-            }
-            results = []
+            # cursor = "<session>.<offset>" из прошлого ответа — следующая страница
+            cursor = str(body.get("cursor") or "")
             try:
-                with yt_dlp.YoutubeDL(opts) as ydl:
-                    info = ydl.extract_info(search_url, download=False)
-                    for e in (info.get("entries") or []):
-                        if not e: continue
-                        url = e.get("url") or e.get("webpage_url")
-                        if not url:
-                            eid = e.get("id")
-                            if platform == "yt" and eid:
-                                url = f"https://www.youtube.com/watch?v={eid}"
-                            elif eid:
-                                url = f"https://www.tiktok.com/@{e.get('uploader','user')}/video/{eid}"
-                        if not url: continue
-                        dur = e.get("duration") or 0
-                        dur_str = ""
-                        if dur:
-                            m, s = divmod(int(dur), 60); h, m = divmod(m, 60)
-                            dur_str = f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
-                        vc = e.get("view_count") or 0
-                        vs = (f"{vc/1e6:.1f}M 👁" if vc >= 1e6
-                              else f"{vc//1000}K 👁" if vc >= 1e3
-                              else f"{vc} 👁" if vc else "")
-                        results.append({"title": (e.get("title") or "Unknown")[:80],
-                            "url": url, "thumbnail": e.get("thumbnail"),
-                            "duration": dur_str, "views": vs})
-            except Exception as ex:
-                log.warning("Search error: %s", ex)
+                size = max(1, min(int(body.get("limit") or SEARCH_PAGE), 50))
+            except (TypeError, ValueError):
+                self._json(400, {"ok": False, "error": "Bad limit"}); return
+            if cursor:
+                sid, _, off = cursor.rpartition(".")
+                sess = find_search_session(uid, sid) if sid and off.isdigit() else None
+                if not sess:
+                    self._json(410, {"ok": False, "error": "Search expired"}); return
+                offset = int(off)
+            else:
+                query    = body.get("query", "").strip()
+                platform = body.get("platform", "yt")
+                if not query:
+                    self._json(400, {"ok": False, "error": "No query"}); return
+                sess, offset = search_session(uid, platform, query), 0
 
+            results, more = sess.page(offset, size)
             used  = db_get_search_dl(uid)
             limit = PREMIUM_DL_DAY if is_premium(uid) else FREE_DL_DAY
-            self._json(200, {"ok": True, "results": results[:100], "used": used, "limit": limit})
+            self._json(200, {"ok": True, "results": results, "used": used, "limit": limit,
+                             "next_cursor": f"{sess.id}.{offset + len(results)}" if more else None})
             return
 
         # /api/search-download
         if path == "/api/search-download":
             uid = self._require_auth()
             if not uid: return
-            prem  = is_premium(uid)
-            limit = PREMIUM_DL_DAY if prem else FREE_DL_DAY
-            used  = db_get_search_dl(uid)
-            if used >= limit:
-                self._json(429, {"ok": False, "error": f"Лимит {limit}/день исчерпан"}); return
             url = body.get("url", "").strip()
             if not url:
                 self._json(400, {"ok": False, "error": "No URL"}); return
+            limit = PREMIUM_DL_DAY if is_premium(uid) else FREE_DL_DAY
+            day   = db_reserve_search_dl(uid, limit)
+            if not day:
+                self._json(429, {"ok": False, "error": f"Лимит {limit}/день исчерпан"}); return
 
-            file_id = str(uuid.uuid4())[:8]
-            out_tpl = os.path.join(DOWNLOADS_DIR, f"{file_id}.%(ext)s")
-            opts = _base_opts(out_tpl)
-            opts["format"] = VIDEO_FORMAT
-
-            try:
-                yt_dlp.YoutubeDL(opts).download([url])
-            except Exception as e:
-                self._json(200, {"ok": False, "error": str(e)[:200]}); return
-
-            files = [f for f in glob.glob(os.path.join(DOWNLOADS_DIR, f"{file_id}.*"))
-                     if not f.endswith(".part") and os.path.getsize(f) > 1024]
-            if not files:
-                self._json(200, {"ok": False, "error": "Файл не найден"}); return
-
-            filepath = sorted(files)[-1]
-            filename = os.path.basename(filepath)
-            db_inc_search_dl(uid)
-            used += 1
-            schedule_delete(filepath, FILE_TTL_SEC)
-            self._json(200, {"ok": True, "file_id": file_id, "filename": filename,
-                             "download_url": f"/api/file/{filename}",
-                             "used": used, "limit": limit})
+            job = submit_job(uid, "search", url, VIDEO_FORMAT, info_cache.get(url), reserved=day)
+            if not job:
+                self._json(429, {"ok": False, "error": "Слишком много загрузок одновременно"}); return
+            snap = _wait_done(job)
+            if snap["state"] != "done":
+                self._json(200, {"ok": False, "error": snap["error"]}); return
+            self._json(200, {"ok": True, **snap["result"]})
             return
 
         self._json(404, {"error": "not found"})
@@ -599,8 +1390,15 @@ class ThreadedHTTPServer(HTTPServer):
         finally: self.shutdown_request(request)
 
 
+def setup():
+    """Подготовка перед стартом сервера (run() и /start_site в боте)."""
+    reaper.watch(DOWNLOADS_DIR, FILE_MAX_AGE)
+    media_store.scan()
+    static_files.preload()
+
+
 def run(port=None):
-    cleanup_old_files()
+    setup()
     p = port or PORT
     server = ThreadedHTTPServer(("0.0.0.0", p), Handler)
     log.info("🌐 Mini App running on http://0.0.0.0:%d", p)